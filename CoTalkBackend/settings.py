@@ -143,3 +143,55 @@ CHANNEL_LAYERS = {
         }
     }
 }
+
+# 缓存（jwt 盐等），各 worker 共享，登录更换盐后立即对所有 worker 生效
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379',
+        'KEY_PREFIX': 'cotalk',
+    }
+}
+
+# 在线状态注册表
+PRESENCE = {
+    'BACKEND': 'ws.presence.RedisPresence',
+    'CONFIG': {
+        'hosts': [('127.0.0.1', 6379)],
+        'ttl': 60,
+    }
+}
+
+# 公开论坛最近消息
+PIAZZA = {
+    'BACKEND': 'ws.piazza.RedisPiazzaHistory',
+    'CONFIG': {
+        'hosts': [('127.0.0.1', 6379)],
+        'size': 50,
+    }
+}
+
+# 未运行 redis 时（单元测试、压测），设置环境变量 LOCAL_LAYERS 改用进程内实现
+if os.getenv('LOCAL_LAYERS'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'ws.layers.LocalChannelLayer',
+        }
+    }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    PRESENCE = {
+        'BACKEND': 'ws.presence.LocalPresence',
+        'CONFIG': {
+            'ttl': 60,
+        }
+    }
+    PIAZZA = {
+        'BACKEND': 'ws.piazza.LocalPiazzaHistory',
+        'CONFIG': {
+            'size': 50,
+        }
+    }
@@ -12,11 +12,18 @@ class Chat(models.Model):
     :var chat_name: 聊天名称
     :var create_time: 聊天创建时间
     :var is_private: 是否为私聊
+    :var last_msg: 最新一条消息（冗余字段，随发送/撤回维护）
+    :var last_activity: 最近活跃时间（最新消息的发送时间）
+    :var last_seq: 最新聊天事件的序号，聊天内单调递增
     """
     chat_id = models.BigAutoField(primary_key=True)
     chat_name = models.CharField(max_length=MAX_NAME_LENGTH)
     create_time = models.FloatField(default=get_timestamp)
     is_private = models.BooleanField(default=True)
+    last_msg = models.ForeignKey('message.Message', on_delete=models.DO_NOTHING, db_constraint=False,
+                                 null=True, blank=True, related_name='+')
+    last_activity = models.FloatField(default=get_timestamp)
+    last_seq = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ('is_private', 'chat_name')
@@ -26,7 +33,8 @@ class Chat(models.Model):
             "chat_id": self.chat_id,
             "chat_name": self.chat_name,
             "create_time": self.create_time,
-            "is_private": self.is_private
+            "is_private": self.is_private,
+            "last_seq": self.last_seq
         }
 
     def get_memberships(self) -> models.QuerySet:
@@ -45,11 +53,19 @@ class Chat(models.Model):
         """
         return self.get_memberships().filter(privilege='A').all()
 
-    def get_messages(self, unable_to_see_user_id):
+    def get_messages(self, unable_to_see_user_id, before_msg_id=None, after_msg_id=None):
         """
         获取`user_id`对应用户可视的消息
+        :param unable_to_see_user_id: 用户id
+        :param before_msg_id: （可选）游标，只返回id小于该值的消息
+        :param after_msg_id: （可选）游标，只返回id大于该值的消息
         """
-        return self.chat_messages.exclude(unable_to_see_users__user_id=unable_to_see_user_id)
+        messages = self.chat_messages.exclude(unable_to_see_users__user_id=unable_to_see_user_id)
+        if before_msg_id is not None:
+            messages = messages.filter(msg_id__lt=before_msg_id)
+        if after_msg_id is not None:
+            messages = messages.filter(msg_id__gt=after_msg_id)
+        return messages
 
     def __str__(self) -> str:
         return f"{self.chat_name}"
@@ -62,15 +78,34 @@ class Membership(models.Model):
     :var chat: 群组
     :var privilege: 成员权限，包括群主(owner)、成员(member)、管理员(admin)
     :var update_time: 关系更新时间
+    :var last_read_msg_id: 已读水位线，id不大于该值的消息均视为已读
+    :var last_read_time: 水位线更新时间
+    :var unread_count: 未读消息数，随发送/已读/撤回增量维护
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_membership')
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='chat_membership')
     privilege = models.CharField(max_length=10, choices=(('M', 'member'), ('O', 'owner'), ('A', 'admin')))
     update_time = models.FloatField(default=get_timestamp)
     is_approved = models.BooleanField(default=False)
+    last_read_msg_id = models.BigIntegerField(default=0)
+    last_read_time = models.FloatField(default=0)
+    unread_count = models.IntegerField(default=0)
 
     class Meta:
         unique_together = ('user', 'chat')
+        indexes = [
+            models.Index(fields=['user', 'is_approved']),  # 用户的聊天
+            models.Index(fields=['chat', 'is_approved', 'privilege']),  # 聊天成员/群主/管理员
+            models.Index(fields=['user', 'update_time']),  # 增量同步
+        ]
+
+    def count_unread(self) -> int:
+        """
+        根据已读水位线统计未读消息数（不含自己发送的消息）
+        """
+        return self.chat.get_messages(unable_to_see_user_id=self.user_id, after_msg_id=self.last_read_msg_id) \
+            .exclude(sender_id=self.user_id).count()
 
     def __str__(self) -> str:
         return f"{self.user.user_name} is {self.privilege} of {self.chat.chat_name}"
+
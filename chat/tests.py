@@ -1,11 +1,12 @@
 from django.test import TestCase
+from utils.utils_test import QueryPlanMixin
 from user.models import User
 from chat.models import Chat, Membership
 from message.models import Notification, Message
 from django.contrib.auth.hashers import make_password
 
 
-class ChatTestCase(TestCase):
+class ChatTestCase(QueryPlanMixin, TestCase):
 
     def setUp(self):
         self.socrates = User.objects.create(
@@ -624,6 +625,63 @@ class ChatTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json()['messages']), 2)
 
+    def test_get_message_list_cursor(self):
+        plato_token = self.client.post('/api/user/login',
+                                       data={'user_name': 'plato', 'password': 'plato_pwd'},
+                                       content_type='application/json').json()['token']
+
+        msg_ids = [Message.objects.create(sender_id=self.socrates.user_id, chat_id=self.athens.chat_id,
+                                          msg_text=f'Message #{i}', msg_type='T').msg_id
+                   for i in range(5)]
+
+        # newest page
+        response = self.client.get(f'/api/chat/{self.athens.chat_id}/messages',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'limit': 2,
+                                   }, HTTP_AUTHORIZATION=plato_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([msg['msg_id'] for msg in response.json()['messages']], msg_ids[3:])
+        self.assertEqual(response.json()['next_cursor'], msg_ids[3])
+
+        # older page
+        response = self.client.get(f'/api/chat/{self.athens.chat_id}/messages',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'limit': 2,
+                                       'before_msg_id': response.json()['next_cursor'],
+                                   }, HTTP_AUTHORIZATION=plato_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([msg['msg_id'] for msg in response.json()['messages']], msg_ids[1:3])
+
+        # last page
+        response = self.client.get(f'/api/chat/{self.athens.chat_id}/messages',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'limit': 2,
+                                       'before_msg_id': response.json()['next_cursor'],
+                                   }, HTTP_AUTHORIZATION=plato_token)
+        self.assertEqual([msg['msg_id'] for msg in response.json()['messages']], msg_ids[:1])
+        self.assertIsNone(response.json()['next_cursor'])
+
+        # newer messages
+        response = self.client.get(f'/api/chat/{self.athens.chat_id}/messages',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'limit': 3,
+                                       'after_msg_id': msg_ids[0],
+                                   }, HTTP_AUTHORIZATION=plato_token)
+        self.assertEqual([msg['msg_id'] for msg in response.json()['messages']], msg_ids[1:4])
+        self.assertEqual(response.json()['next_cursor'], msg_ids[3])
+
+        # invalid limit
+        response = self.client.get(f'/api/chat/{self.athens.chat_id}/messages',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'limit': 0,
+                                   }, HTTP_AUTHORIZATION=plato_token)
+        self.assertEqual(response.status_code, 400)
+
     def test_get_message_list_bad_request(self):
         plato_token = self.client.post('/api/user/login',
                                        data={'user_name': 'plato', 'password': 'plato_pwd'},
@@ -702,3 +760,17 @@ class ChatTestCase(TestCase):
                                        'user_id': 1283912,
                                    }, HTTP_AUTHORIZATION=plato_token)
         self.assertEqual(response.status_code, 404)
+
+    # === query plans ===
+    def test_hot_queries_use_index(self):
+        self.assert_uses_index(Membership.objects.filter(chat_id=self.athens.chat_id, user_id=self.plato.user_id,
+                                                         is_approved=True))
+        self.assert_uses_index(self.athens.get_memberships())
+        self.assert_uses_index(self.athens.get_admins())
+        self.assert_uses_index(self.athens.get_memberships().filter(privilege='O'))
+        messages = self.athens.get_messages(unable_to_see_user_id=self.plato.user_id)
+        self.assert_uses_index(messages.order_by('-msg_id')[:50])
+        self.assert_uses_index(messages.filter(msg_id__lt=100).order_by('-msg_id')[:50])
+        self.assert_uses_index(messages.filter(sender_id=self.socrates.user_id))
+        self.assert_uses_index(messages.filter(create_time__lt=1000, create_time__gt=100))
+        self.assert_uses_index(messages.filter(msg_type='T'))
@@ -1,20 +1,24 @@
 from utils.utils_require import (require, CheckError, MAX_DESCRIPTION_LENGTH, MAX_EMAIL_LENGTH, MAX_NAME_LENGTH,
-                                 NOT_FOUND_USER_ID, NOT_FOUND_CHAT_ID, UNAUTHORIZED_JWT, NO_MANAGEMENT_PRIVILEGE)
+                                 NOT_FOUND_USER_ID, NOT_FOUND_CHAT_ID, UNAUTHORIZED_JWT, NO_MANAGEMENT_PRIVILEGE,
+                                 DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
 from django.http import HttpRequest, JsonResponse
 from utils.utils_request import (BAD_METHOD, request_success, request_failed, BAD_REQUEST,
                                  CONFLICT, SERVER_ERROR, NOT_FOUND, UNAUTHORIZED, PRECONDITION_FAILED, return_field)
-from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt
+from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt, Authenticate, check_user
+from utils.utils_time import get_timestamp
 import json
 from user.models import User
 from .models import Chat, Membership
-from message.models import Message, Notification, kick_a_person, join_a_chat, change_privilege
-from ws.models import Client
+from message.models import (Message, Notification, kick_a_person, join_a_chat, change_privilege,
+                            serialize_messages, search_messages)
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from utils.utils_require import msg_type_translation
+from utils.utils_websocket import subscribe_chat, unsubscribe_chat
 
 
 @CheckError
+@Authenticate
 def create_a_chat(req: HttpRequest):
     """
     创建聊天视图
@@ -28,11 +32,10 @@ def create_a_chat(req: HttpRequest):
     chat_name = require(body, 'chat_name', 'string')
     members = require(body, 'members', 'array', is_essential=False)
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    verify_a_user(salt=user.jwt_token_salt, user_id=user_id, req=req)
+    user = req.cotalk_user
 
     # verification passed
     if Chat.objects.filter(chat_name=chat_name).exists():
@@ -43,6 +46,7 @@ def create_a_chat(req: HttpRequest):
     # create a membership (Owner)
     membership = Membership.objects.create(user=user, chat=chat, privilege='O', is_approved=True)
     membership.save()
+    subscribe_chat(user_id, chat.chat_id)
     # notify the members
     if members is not None:
         for member in members:
@@ -56,12 +60,10 @@ def create_a_chat(req: HttpRequest):
             }
             Membership.objects.create(user_id=member, chat_id=chat.chat_id, privilege='M', is_approved=False)
             # 动态websocket
-            if Client.objects.filter(user_id=member).exists():
-                channel_name = Client.objects.get(user_id=member).channel_name
-                async_to_sync(get_channel_layer().send)(
-                    channel_name,
-                    notification_dict
-                )
+            async_to_sync(get_channel_layer().group_send)(
+                f'user_{member}',
+                notification_dict
+            )
             # 静态notification
             # else:
             Notification.objects.create(sender_id=user_id, receiver_id=member, content=str(notification_dict))
@@ -100,6 +102,7 @@ def get_chat_detail(req: HttpRequest, chat_id):
 
 
 @CheckError
+@Authenticate
 def chat_members(req: HttpRequest, chat_id):
     """
     聊天成员获取/邀请视图
@@ -125,12 +128,10 @@ def chat_members(req: HttpRequest, chat_id):
     except ValueError:
         return BAD_REQUEST("User id must be an integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    SALT = user.jwt_token_salt
-    verify_a_user(salt=SALT, user_id=user.user_id, req=req)
+    user = req.cotalk_user
 
     if not Membership.objects.filter(user_id=user_id, chat_id=chat_id).exists():
         return NOT_FOUND('Invalid chat id or user not in chat')  # 404
@@ -165,12 +166,6 @@ def chat_members(req: HttpRequest, chat_id):
         if not User.objects.filter(user_id=member_id).exists():
             return NOT_FOUND('Invalid member id')  # 404
 
-        # 尝试获取对应websocket
-        if Client.objects.filter(user_id=member_id).exists():
-            channel_name = Client.objects.get(user_id=member_id).channel_name
-        else:
-            channel_name = None
-
         notification_dict = None
         # 判断请求情况
         if Membership.objects.filter(user_id=member_id, chat_id=chat_id).exists():
@@ -181,6 +176,7 @@ def chat_members(req: HttpRequest, chat_id):
                             and membership.privilege != 'O':
                         # have privilege and the other user is not the owner
                         membership.delete()
+                        unsubscribe_chat(member_id, chat_id)
                         # 新建系统消息
                         kick_a_person(admin_id=user_id, member_id=member_id, chat_id=chat_id)
                         # 新建系统通知
@@ -198,7 +194,9 @@ def chat_members(req: HttpRequest, chat_id):
                 if user_id == member_id:  # accept / reject
                     if approve:  # accept invitation
                         membership.is_approved = True
+                        membership.update_time = get_timestamp()
                         membership.save()
+                        subscribe_chat(user_id, chat_id)
                         # 新建系统消息
                         join_a_chat(user_id=user_id, chat_id=chat_id)
                     else:  # reject invitation
@@ -220,12 +218,11 @@ def chat_members(req: HttpRequest, chat_id):
             }
 
         if notification_dict is not None:
-            if channel_name is not None:
-                # 动态websocket
-                async_to_sync(get_channel_layer().send)(
-                    channel_name,
-                    notification_dict
-                )
+            # 动态websocket
+            async_to_sync(get_channel_layer().group_send)(
+                f'user_{member_id}',
+                notification_dict
+            )
             # else:
             # 静态Notification
             Notification.objects.create(sender_id=user_id, receiver_id=member_id, content=str(notification_dict))
@@ -234,6 +231,7 @@ def chat_members(req: HttpRequest, chat_id):
 
 
 @CheckError
+@Authenticate
 def chat_management(req: HttpRequest, chat_id):
     """
     聊天成员权限更改视图
@@ -252,17 +250,15 @@ def chat_management(req: HttpRequest, chat_id):
     member_id = require(body, 'member_id', 'int')
     change_to = require(body, 'change_to', 'string')
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
+    user = req.cotalk_user
     if not Membership.objects.filter(user_id=user_id, chat_id=chat_id).exists():
         return NOT_FOUND("Invalid chat id or user not in chat")  # 404
 
-    # Verification
+    # Verification passed
     user_privilege = Membership.objects.get(user_id=user_id, chat_id=chat_id).privilege
-    SALT = user.jwt_token_salt
-    verify_a_user(salt=SALT, user_id=user.user_id, req=req)
 
     if not User.objects.filter(user_id=member_id).exists():
         return NOT_FOUND("Invalid member id")  # 404
@@ -279,6 +275,7 @@ def chat_management(req: HttpRequest, chat_id):
         # check privilege
         if user_privilege == 'O' or user_privilege == 'A':
             membership.privilege = 'M'
+            membership.update_time = get_timestamp()
             membership.save()
         else:
             return UNAUTHORIZED(NO_MANAGEMENT_PRIVILEGE)  # 401
@@ -287,16 +284,19 @@ def chat_management(req: HttpRequest, chat_id):
             if len(Chat.objects.get(chat_id=chat_id).get_admins()) == 3:
                 return PRECONDITION_FAILED("There are already 3 admins")  # 412
             membership.privilege = 'A'
+            membership.update_time = get_timestamp()
             membership.save()
         else:
             return UNAUTHORIZED(NO_MANAGEMENT_PRIVILEGE)  # 401
     elif change_to == 'owner':
         if user_privilege == 'O':
             membership.privilege = 'O'
+            membership.update_time = get_timestamp()
             membership.save()
             # the former owner now becomes a member
             user_membership = Membership.objects.get(user_id=user_id, chat_id=chat_id)
             user_membership.privilege = 'M'
+            user_membership.update_time = get_timestamp()
             user_membership.save()
         else:
             return UNAUTHORIZED(NO_MANAGEMENT_PRIVILEGE)  # 401
@@ -316,12 +316,10 @@ def chat_management(req: HttpRequest, chat_id):
         'is_approved': True
     }
 
-    if Client.objects.filter(user_id=member_id).exists():
-        channel_name = Client.objects.get(user_id=member_id).channel_name
-        async_to_sync(get_channel_layer().send)(
-            channel_name,
-            notification_dict
-        )
+    async_to_sync(get_channel_layer().group_send)(
+        f'user_{member_id}',
+        notification_dict
+    )
     # else:
     Notification.objects.create(sender_id=user_id,
                                 receiver_id=member_id,
@@ -331,7 +329,13 @@ def chat_management(req: HttpRequest, chat_id):
 
 
 @CheckError
+@Authenticate
 def get_messages(req: HttpRequest, chat_id):
+    """
+    获取聊天消息列表
+    若提供 `before_msg_id` / `after_msg_id` / `limit` 中任意一个，则按消息id进行游标分页，
+    并在响应中返回 `next_cursor`（没有更多消息时为 None）
+    """
     if req.method != 'GET':
         return BAD_METHOD  # 405
 
@@ -342,30 +346,40 @@ def get_messages(req: HttpRequest, chat_id):
 
     user_id = require(req.GET, 'user_id', 'int', req=req)
 
-    # user check
-    if not User.objects.filter(user_id=user_id).exists():
+    # user check & verification
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
     # chat check
     if not Chat.objects.filter(chat_id=chat_id).exists():
         return NOT_FOUND(NOT_FOUND_CHAT_ID)
 
-    user = User.objects.get(user_id=user_id)
     chat = Chat.objects.get(chat_id=chat_id)
-    verify_a_user(salt=user.jwt_token_salt, user_id=user_id, req=req)
 
     # membership check
     if not Membership.objects.filter(chat_id=chat_id, user_id=user_id, is_approved=True).exists():
         return UNAUTHORIZED(f"Unauthorized : user {user_id} not in chat {chat_id}")
 
-    messages = chat.get_messages(unable_to_see_user_id=user_id)
+    # cursor
+    before_msg_id = require(req.GET, 'before_msg_id', 'int', is_essential=False, req=req)
+    after_msg_id = require(req.GET, 'after_msg_id', 'int', is_essential=False, req=req)
+    limit = require(req.GET, 'limit', 'int', is_essential=False, req=req)
+    is_paginated = before_msg_id is not None or after_msg_id is not None or limit is not None
+
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return BAD_REQUEST(f"Invalid limit : must be between 1 and {MAX_PAGE_SIZE}")  # 400
+
+    messages = chat.get_messages(unable_to_see_user_id=user_id, before_msg_id=before_msg_id,
+                                 after_msg_id=after_msg_id)
 
     # filter
     filter_info = "Success"
     filter_text = require(req.GET, 'filter_text', 'string', is_essential=False, req=req)
 
     if filter_text is not None:
-        messages = messages.filter(msg_text__contains=filter_text)
+        messages = search_messages(messages, filter_text)
         filter_info += ", filter_text: " + filter_text
 
     filter_user = require(req.GET, 'filter_user', 'int', is_essential=False, req=req)
@@ -392,26 +406,43 @@ def get_messages(req: HttpRequest, chat_id):
         messages = messages.filter(msg_type=msg_type_translation[filter_type])
         filter_info += ", filter_type: " + filter_type
 
-    return request_success({
-        "messages": [
-            return_field(
-                message.serialize(),
-                [
-                    "msg_id",
-                    "sender_id",
-                    "chat_id",
-
-                    "msg_text",
-                    "msg_type",
-
-                    "create_time",
-                    "update_time",
-
-                    "read_users",
-
-                    "reply_to",
-                    "is_system",
-                    "msg_file_url"]
-            ) for message in messages
-        ]
-    }, info=filter_info)
+    # paginate
+    next_cursor = None
+    if is_paginated:
+        if after_msg_id is not None:  # 向后翻页，从旧到新
+            messages = list(messages.order_by('msg_id')[:limit + 1])
+            if len(messages) > limit:
+                messages = messages[:limit]
+                next_cursor = messages[-1].msg_id
+        else:  # 向前翻页，从新到旧取，再按时间顺序返回
+            messages = list(messages.order_by('-msg_id')[:limit + 1])
+            if len(messages) > limit:
+                messages = messages[:limit]
+                next_cursor = messages[-1].msg_id
+            messages.reverse()
+
+    data = {
+        "messages": serialize_messages(
+            messages,
+            [
+                "msg_id",
+                "sender_id",
+                "chat_id",
+
+                "msg_text",
+                "msg_type",
+
+                "create_time",
+                "update_time",
+
+                "read_users",
+
+                "reply_to",
+                "is_system",
+                "msg_file_url"]
+        )
+    }
+    if is_paginated:
+        data["next_cursor"] = next_cursor
+
+    return request_success(data, info=filter_info)
@@ -1,7 +1,11 @@
-from django.db import models
+import json
+from django.db import models, connection, transaction
+from django.db.models import F, Count, Subquery
+from django.db.models.functions import Coalesce
 from user.models import User
-from chat.models import Chat
-from utils.utils_require import MAX_MESSAGE_LENGTH
+from chat.models import Chat, Membership
+from utils.utils_require import MAX_MESSAGE_LENGTH, MAX_QUERY_PARAMS, MAX_CLIENT_MSG_ID_LENGTH, MAX_PUSH_PAYLOAD_SIZE
+from utils.utils_request import return_field
 from utils.utils_time import get_timestamp
 
 
@@ -16,10 +20,11 @@ class Message(models.Model):
     :var msg_type: 消息类型（从 'text', 'group_notice', 'image', 'audio', 'video', 'others' 大写首字母中选择）
     :var create_time: 消息创建时间
     :var update_time: 消息状态更新时间
-    :var read_users: 已经读取消息的用户
+    :var read_users: （派生属性）已经读取消息的用户，由成员的已读水位线`Membership.last_read_msg_id`得出
     :var unable_to_see_users: 不可视该消息的用户 （用户在前端标记删除）
     :var reply_to : 回复某消息，默认为-1，表示没有指定回复
     :var is_system: 是否为系统消息
+    :var client_msg_id: （可选）客户端生成的消息id，用于发送确认与去重，同一发送者内唯一
     """
     msg_id = models.BigAutoField(primary_key=True)
 
@@ -34,18 +39,37 @@ class Message(models.Model):
     create_time = models.FloatField(default=get_timestamp)
     update_time = models.FloatField(default=get_timestamp)
 
-    read_users = models.ManyToManyField(User, related_name='read_messages')
     unable_to_see_users = models.ManyToManyField(User, related_name='unable_to_see_messages')
 
     reply_to = models.IntegerField(default=-1)
 
     is_system = models.BooleanField(default=False)
 
-    def serialize(self):
+    client_msg_id = models.CharField(max_length=MAX_CLIENT_MSG_ID_LENGTH, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'create_time']),  # 按时间筛选
+            models.Index(fields=['chat', 'sender']),  # 按发送者筛选
+            models.Index(fields=['chat', 'update_time']),  # 增量同步
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_msg_id'], name='unique_client_msg_id'),  # 去重
+        ]
+
+    def serialize(self, read_users=None, unable_to_see_users=None):
+        """
+        :param read_users: （可选）已查询好的已读用户id列表，提供时不再额外查询
+        :param unable_to_see_users: （可选）已查询好的不可视用户id列表，提供时不再额外查询
+        """
+        if read_users is None:
+            read_users = self.get_read_users()
+        if unable_to_see_users is None:
+            unable_to_see_users = [user.user_id for user in self.unable_to_see_users.all()]
         return {
             'msg_id': self.msg_id,
-            'sender_id': self.sender.user_id,
-            'chat_id': self.chat.chat_id,
+            'sender_id': self.sender_id,
+            'chat_id': self.chat_id,
 
             'msg_text': self.msg_text,
             'msg_file_url': "",
@@ -54,19 +78,311 @@ class Message(models.Model):
             'create_time': self.create_time,
             'update_time': self.update_time,
 
-            'read_users': [user.user_id for user in self.read_users.all()],
-            'unable_to_see_users': [user.user_id for user in self.unable_to_see_users.all()],
+            'read_users': read_users,
+            'unable_to_see_users': unable_to_see_users,
 
             'reply_to': self.reply_to,
             'is_system': self.is_system
         }
 
+    def get_read_users(self) -> list:
+        """
+        获取已读该消息的用户id，即已读水位线不小于该消息id的聊天成员
+        """
+        return list(Membership.objects.filter(chat_id=self.chat_id, is_approved=True,
+                                              last_read_msg_id__gte=self.msg_id).values_list('user_id', flat=True))
+
     def __str__(self) -> str:
         if self.is_system:
             return f"system information {self.msg_text}"
         return f"{self.msg_id}'s type is {self.msg_type}, content is {self.msg_text}"
 
 
+class WithdrawnMessage(models.Model):
+    """
+    已撤回消息记录（消息本身已删除），供增量同步使用
+    :var msg_id: 被撤回的消息id
+    :var chat: 所属聊天
+    :var withdraw_time: 撤回时间
+    """
+    msg_id = models.BigIntegerField(primary_key=True)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='withdrawn_messages')
+    withdraw_time = models.FloatField(default=get_timestamp)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'withdraw_time']),  # 增量同步
+        ]
+
+    def serialize(self):
+        return {
+            'msg_id': self.msg_id,
+            'chat_id': self.chat_id,
+            'withdraw_time': self.withdraw_time
+        }
+
+
+# 每个聊天至少保留的最近事件数，断线期间错过更多事件时需重新同步
+MAX_CHAT_EVENTS = 200
+
+
+class ChatEvent(models.Model):
+    """
+    聊天事件记录（发送/已读/撤回消息等 `chat_<id>` 群组通知），供断线重连后按序号重放
+    :var chat: 所属聊天
+    :var seq: 事件序号，聊天内单调递增
+    :var content: 事件内容（JSON）
+    :var create_time: 事件时间
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='chat_events')
+    seq = models.BigIntegerField()
+    content = models.TextField()
+    create_time = models.FloatField(default=get_timestamp)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='unique_chat_seq'),  # 按序号重放
+        ]
+
+
+class MatchLookup(models.Lookup):
+    """
+    全文索引匹配 `field__match=query`
+    """
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class FullTextField(models.TextField):
+    pass
+
+
+FullTextField.register_lookup(MatchLookup)
+
+
+class MessageIndex(models.Model):
+    """
+    消息全文索引 model (SQLite FTS5 虚表，由 message/signals.py 创建并通过触发器同步)
+    :var message: 对应消息
+    :var msg_text: 消息内容
+    :var rank: 匹配相关度 (bm25，越小越相关)，仅在匹配查询中有效
+    """
+    message = models.OneToOneField(Message, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                   db_constraint=False, related_name='search_index')
+    msg_text = FullTextField()
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'message_fts'
+
+
+# trigram 分词的最短关键词长度
+MIN_SEARCH_LENGTH = 3
+
+
+def search_messages(messages, text, rank=False):
+    """
+    在消息中搜索包含`text`的消息
+    SQLite 下使用全文索引，关键词过短或其他数据库时退化为子串匹配
+    :param messages: 消息 QuerySet
+    :param text: 关键词
+    :param rank: 是否按相关度排序（否则保持原顺序）
+    :return: 消息 QuerySet
+    """
+    if connection.vendor != 'sqlite' or len(text) < MIN_SEARCH_LENGTH:
+        messages = messages.filter(msg_text__contains=text)
+        return messages.order_by('-msg_id') if rank else messages
+
+    # 作为短语匹配，即子串匹配
+    phrase = '"' + text.replace('"', '""') + '"'
+    messages = messages.filter(search_index__msg_text__match=phrase)
+    return messages.order_by('search_index__rank', '-msg_id') if rank else messages
+
+
+# 搜索摘要的上下文长度
+SNIPPET_CONTEXT_LENGTH = 20
+
+
+def generate_snippet(msg_text, text):
+    """
+    生成搜索结果摘要：关键词及其前后的上下文
+    :param msg_text: 消息内容
+    :param text: 关键词
+    :return: 摘要
+    """
+    pos = msg_text.lower().find(text.lower())
+    if pos == -1:
+        return msg_text[:2 * SNIPPET_CONTEXT_LENGTH]
+    start = max(0, pos - SNIPPET_CONTEXT_LENGTH)
+    end = pos + len(text) + SNIPPET_CONTEXT_LENGTH
+    return ('...' if start > 0 else '') + msg_text[start:end] + ('...' if end < len(msg_text) else '')
+
+
+def serialize_messages(messages, field_list):
+    """
+    批量序列化消息，只查询`field_list`中需要的关系，每个关系只需一次查询
+    :param messages: 消息 QuerySet 或列表
+    :param field_list: 需要返回的字段
+    :return: 序列化后的消息字典列表
+    """
+    messages = list(messages)
+    msg_ids = [message.msg_id for message in messages]
+
+    relations = {
+        'read_users': {msg_id: [] for msg_id in msg_ids},
+        'unable_to_see_users': {msg_id: [] for msg_id in msg_ids},
+    }
+
+    if 'read_users' in field_list:
+        # 各聊天成员的已读水位线，从高到低排列
+        watermarks = {}
+        for chat_id, user_id, last_read_msg_id in Membership.objects.filter(
+                chat_id__in={message.chat_id for message in messages}, is_approved=True) \
+                .order_by('-last_read_msg_id').values_list('chat_id', 'user_id', 'last_read_msg_id'):
+            watermarks.setdefault(chat_id, []).append((last_read_msg_id, user_id))
+        for message in messages:
+            for last_read_msg_id, user_id in watermarks.get(message.chat_id, []):
+                if last_read_msg_id < message.msg_id:
+                    break
+                relations['read_users'][message.msg_id].append(user_id)
+
+    if 'unable_to_see_users' in field_list:
+        through = Message.unable_to_see_users.through
+        # 分批查询，避免超出数据库的参数个数限制
+        for i in range(0, len(msg_ids), MAX_QUERY_PARAMS):
+            for msg_id, user_id in through.objects.filter(
+                    message_id__in=msg_ids[i:i + MAX_QUERY_PARAMS]).values_list('message_id', 'user_id'):
+                relations['unable_to_see_users'][msg_id].append(user_id)
+
+    return [
+        return_field(
+            message.serialize(read_users=relations['read_users'][message.msg_id],
+                              unable_to_see_users=relations['unable_to_see_users'][message.msg_id]),
+            field_list
+        ) for message in messages
+    ]
+
+
+# 返回给前端的消息字段
+MESSAGE_FIELDS = [
+    "msg_id",
+    "sender_id",
+    "chat_id",
+
+    "msg_text",
+    "msg_type",
+
+    "create_time",
+    "update_time",
+
+    "read_users",
+    "unable_to_see_users",
+
+    "reply_to",
+    "is_system",
+    "msg_file_url"]
+
+
+def generate_send_event(message):
+    """
+    生成新消息的“发送消息”websocket 通知，附带完整消息（只序列化一次），成员无需再请求消息详情；
+    超过推送大小限制时不附带
+    """
+    websocket_dict = {
+        'type': 'chat.message',
+        'status': 'send message',
+        'user_id': message.sender_id,
+        'chat_id': message.chat_id,
+        'msg_id': message.msg_id,
+        'update_time': get_timestamp()
+    }
+    # 新消息仅发送者已读，且无人隐藏，无需查询
+    payload = return_field(message.serialize(read_users=[message.sender_id], unable_to_see_users=[]), MESSAGE_FIELDS)
+    if len(json.dumps(payload)) <= MAX_PUSH_PAYLOAD_SIZE:
+        websocket_dict['message'] = payload
+    return websocket_dict
+
+
+def record_chat_event(event):
+    """
+    为聊天事件分配序号（聊天内单调递增）并记录，旧事件定期清理
+    :param event: 聊天事件，需包含 `chat_id`，将被加上 `seq`
+    :return: event
+    """
+    chat_id = event['chat_id']
+    with transaction.atomic():
+        Chat.objects.filter(chat_id=chat_id).update(last_seq=F('last_seq') + 1)
+        seq = Chat.objects.filter(chat_id=chat_id).values_list('last_seq', flat=True).get()
+        event['seq'] = seq
+        ChatEvent.objects.create(chat_id=chat_id, seq=seq, content=json.dumps(event))
+        # 清理旧事件，保留最近 MAX_CHAT_EVENTS ~ 2 * MAX_CHAT_EVENTS 条
+        if seq % MAX_CHAT_EVENTS == 0:
+            ChatEvent.objects.filter(chat_id=chat_id, seq__lte=seq - MAX_CHAT_EVENTS).delete()
+    return event
+
+
+def get_chat_events(chat_id, last_seq):
+    """
+    获取序号大于`last_seq`的聊天事件
+    :return: 按序号排列的事件列表；错过的事件已被清理时返回 None，需重新同步
+    """
+    events = list(ChatEvent.objects.filter(chat_id=chat_id, seq__gt=last_seq).order_by('seq')
+                  .values_list('seq', 'content'))
+    if len(events) > 0 and events[0][0] != last_seq + 1:
+        return None
+    return [json.loads(content) for _, content in events]
+
+
+def read_messages(user_id, chat_id, msg_id) -> bool:
+    """
+    将用户在聊天中的已读水位线推进到`msg_id`（只进不退），并同步未读数，只需一次 UPDATE
+    :param user_id: 用户id
+    :param chat_id: 聊天id
+    :param msg_id: 已读的最新消息id
+    :return: 水位线是否前进
+    """
+    unread = Message.objects.filter(chat_id=chat_id, msg_id__gt=msg_id) \
+        .exclude(sender_id=user_id).exclude(unable_to_see_users__user_id=user_id) \
+        .order_by().values('chat_id').annotate(count=Count('msg_id')).values('count')
+    return Membership.objects.filter(user_id=user_id, chat_id=chat_id, last_read_msg_id__lt=msg_id) \
+        .update(last_read_msg_id=msg_id, last_read_time=get_timestamp(),
+                unread_count=Coalesce(Subquery(unread), 0)) > 0
+
+
+def uncount_unread_message(message, user_id=None):
+    """
+    消息被撤回或被用户删除时，从尚未读到该消息的成员的未读数中扣除
+    需在撤回（删除消息）或删除（加入`unable_to_see_users`）之前调用
+    :param message: 消息
+    :param user_id: 删除消息的用户id；为 None 时表示撤回，扣除所有成员
+    """
+    memberships = Membership.objects.filter(chat_id=message.chat_id, is_approved=True, unread_count__gt=0,
+                                            last_read_msg_id__lt=message.msg_id) \
+        .exclude(user_id=message.sender_id)
+    if user_id is not None:
+        memberships = memberships.filter(user_id=user_id)
+    else:
+        memberships = memberships.exclude(user__unable_to_see_messages=message)
+    memberships.update(unread_count=F('unread_count') - 1)
+
+
+def refresh_last_message(chat_id):
+    """
+    最新消息被撤回后，重新确定聊天的最新消息
+    :param chat_id: 聊天id
+    """
+    message = Message.objects.filter(chat_id=chat_id).order_by('-msg_id').first()
+    if message is None:
+        Chat.objects.filter(chat_id=chat_id).update(last_msg_id=None)
+    else:
+        Chat.objects.filter(chat_id=chat_id).update(last_msg_id=message.msg_id, last_activity=message.create_time)
+
+
 class Notification(models.Model):
     """
     通知（主要隶属关系）
@@ -85,11 +401,17 @@ class Notification(models.Model):
     create_time = models.FloatField(default=get_timestamp)
     is_read = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['receiver', 'is_read', 'create_time']),  # 通知列表
+            models.Index(fields=['receiver', 'create_time']),  # 通知列表/增量同步
+        ]
+
     def serialize(self):
         return {
             'notification_id': self.notification_id,
-            'receiver_id': self.receiver.user_id,
-            'sender_id': self.sender.user_id,
+            'receiver_id': self.receiver_id,
+            'sender_id': self.sender_id,
             'content': self.content,
             'create_time': self.create_time,
             'is_read': self.is_read
@@ -110,8 +432,7 @@ def withdraw_a_message(user_id, chat_id):
     chat = Chat.objects.get(chat_id=chat_id)
     message = Message.objects.create(sender=system_user, chat_id=chat_id, is_system=True,
                                      msg_text=f'{user.user_name} withdrawn a message.')
-    message.read_users.add(user)
-    message.save()
+    read_messages(user_id=user_id, chat_id=chat_id, msg_id=message.msg_id)
 
 
 def kick_a_person(admin_id, member_id, chat_id):
@@ -126,8 +447,7 @@ def kick_a_person(admin_id, member_id, chat_id):
     member = User.objects.get(user_id=member_id)
     message = Message.objects.create(sender=system_user, chat_id=chat_id, is_system=True,
                                      msg_text=f'{admin.user_name} kicked {member.user_name} out of the chat.')
-    message.read_users.add(admin)
-    message.save()
+    read_messages(user_id=admin_id, chat_id=chat_id, msg_id=message.msg_id)
 
 
 def join_a_chat(user_id, chat_id):
@@ -140,8 +460,7 @@ def join_a_chat(user_id, chat_id):
     user = User.objects.get(user_id=user_id)
     message = Message.objects.create(sender=system_user, chat_id=chat_id, is_system=True,
                                      msg_text=f'{user.user_name} joined the chat.')
-    message.read_users.add(user)
-    message.save()
+    read_messages(user_id=user_id, chat_id=chat_id, msg_id=message.msg_id)
 
 
 def change_privilege(admin_id, member_id, chat_id, privilege):
@@ -157,8 +476,7 @@ def change_privilege(admin_id, member_id, chat_id, privilege):
     member = User.objects.get(user_id=member_id)
     message = Message.objects.create(sender=system_user, chat_id=chat_id, is_system=True,
                                      msg_text=f'{admin.user_name} changed {member.user_name}\'s privilege to {privilege}.')
-    message.read_users.add(admin)
-    message.save()
+    read_messages(user_id=admin_id, chat_id=chat_id, msg_id=message.msg_id)
 
 
 def leave_chat(user_id, chat_id):
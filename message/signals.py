@@ -0,0 +1,62 @@
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.signals import post_migrate, post_save
+from django.dispatch import receiver
+from chat.models import Chat, Membership
+from message.models import Message, MessageIndex
+
+
+@receiver(post_migrate)
+def create_message_index(sender, using='default', **kwargs):
+    """
+    建立消息全文索引 (SQLite FTS5, trigram 分词，支持中文子串搜索)
+    索引表通过触发器与消息表同步，覆盖发送、撤回与删除
+    """
+    if sender.name != 'message':
+        return
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+
+    message_table = Message._meta.db_table
+    index_table = MessageIndex._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [index_table])
+        if cursor.fetchone() is not None:
+            return
+
+        cursor.execute(f"CREATE VIRTUAL TABLE {index_table} USING fts5("
+                       f"msg_text, content='{message_table}', content_rowid='msg_id', tokenize='trigram')")
+        cursor.execute(f"CREATE TRIGGER {index_table}_insert AFTER INSERT ON {message_table} BEGIN "
+                       f"INSERT INTO {index_table}(rowid, msg_text) VALUES (new.msg_id, new.msg_text); END")
+        cursor.execute(f"CREATE TRIGGER {index_table}_delete AFTER DELETE ON {message_table} BEGIN "
+                       f"INSERT INTO {index_table}({index_table}, rowid, msg_text) "
+                       f"VALUES ('delete', old.msg_id, old.msg_text); END")
+        cursor.execute(f"CREATE TRIGGER {index_table}_update AFTER UPDATE OF msg_text ON {message_table} BEGIN "
+                       f"INSERT INTO {index_table}({index_table}, rowid, msg_text) "
+                       f"VALUES ('delete', old.msg_id, old.msg_text); "
+                       f"INSERT INTO {index_table}(rowid, msg_text) VALUES (new.msg_id, new.msg_text); END")
+        # 为已有消息建立索引
+        cursor.execute(f"INSERT INTO {index_table}({index_table}) VALUES ('rebuild')")
+        print("Message index created successfully.")
+
+
+@receiver(post_save, sender=Message)
+def count_unread_message(sender, instance, created, **kwargs):
+    """
+    新消息计入聊天中其他成员的未读数
+    """
+    if created:
+        Membership.objects.filter(chat_id=instance.chat_id, is_approved=True) \
+            .exclude(user_id=instance.sender_id).update(unread_count=F('unread_count') + 1)
+
+
+@receiver(post_save, sender=Message)
+def update_last_message(sender, instance, created, **kwargs):
+    """
+    新消息成为聊天的最新消息
+    """
+    if created:
+        Chat.objects.filter(Q(last_msg_id__isnull=True) | Q(last_msg_id__lt=instance.msg_id),
+                            chat_id=instance.chat_id) \
+            .update(last_msg_id=instance.msg_id, last_activity=instance.create_time)
@@ -1,13 +1,16 @@
 from django.test import TestCase
+from utils.utils_test import QueryPlanMixin
 from user.models import User
 from chat.models import Chat, Membership
-from message.models import Message, Notification
+from message.models import (Message, Notification, serialize_messages, search_messages, record_chat_event,
+                            get_chat_events, ChatEvent, MAX_CHAT_EVENTS)
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.hashers import make_password
+from django.db.models import Max, Count
 import os
 
 
-class MessageTestCase(TestCase):
+class MessageTestCase(QueryPlanMixin, TestCase):
     def setUp(self):
         self.socrates = User.objects.create(
             user_name='socrates',
@@ -674,6 +677,149 @@ class MessageTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json()['read_users']), 2)
 
+    def test_read_message_watermark(self):
+        msg_ids = []
+        for i in range(3):
+            response = self.client.post('/api/message/send',
+                                        data={
+                                            'user_id': self.socrates.user_id,
+                                            'chat_id': self.athens.chat_id,
+                                            'msg_text': f'Message #{i}',
+                                            'msg_type': 'text',
+                                        }, format='multipart', HTTP_AUTHORIZATION=self.socrates_token)
+            self.assertEqual(response.status_code, 200)
+            msg_ids.append(response.json()['msg_id'])
+
+        plato_membership = Membership.objects.get(user=self.plato, chat=self.athens)
+        self.assertEqual(plato_membership.count_unread(), 3)
+        # the sender has read his own messages
+        self.assertEqual(Membership.objects.get(user=self.socrates, chat=self.athens).count_unread(), 0)
+
+        # reading the second message marks the first one as read as well
+        response = self.client.put(f'/api/message/{msg_ids[1]}/management',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 200)
+        plato_membership.refresh_from_db()
+        self.assertEqual(plato_membership.last_read_msg_id, msg_ids[1])
+        self.assertEqual(plato_membership.count_unread(), 1)
+
+        # the watermark never moves backwards
+        response = self.client.put(f'/api/message/{msg_ids[0]}/management',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 200)
+        plato_membership.refresh_from_db()
+        self.assertEqual(plato_membership.last_read_msg_id, msg_ids[1])
+
+        self.assertEqual(sorted(Message.objects.get(msg_id=msg_ids[0]).get_read_users()),
+                         sorted([self.socrates.user_id, self.plato.user_id]))
+        self.assertEqual(Message.objects.get(msg_id=msg_ids[2]).get_read_users(), [self.socrates.user_id])
+
+    def test_read_messages_in_bulk(self):
+        rome = Chat.objects.create(chat_name='Rome', is_private=False)
+        Membership.objects.create(user=self.plato, chat=rome, is_approved=True, privilege='O')
+        Membership.objects.create(user=self.socrates, chat=rome, is_approved=True, privilege='M')
+
+        athens_msgs = [Message.objects.create(sender=self.socrates, chat=self.athens, msg_text=f'Athens #{i}')
+                       for i in range(3)]
+        rome_msgs = [Message.objects.create(sender=self.socrates, chat=rome, msg_text=f'Rome #{i}')
+                     for i in range(3)]
+
+        # mark these ids read
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'msg_ids': [athens_msgs[0].msg_id, athens_msgs[1].msg_id, rome_msgs[0].msg_id],
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted((chat['chat_id'], chat['last_read_msg_id']) for chat in response.json()['chats']),
+                         sorted([(self.athens.chat_id, athens_msgs[1].msg_id), (rome.chat_id, rome_msgs[0].msg_id)]))
+        self.assertEqual(Membership.objects.get(user=self.plato, chat=self.athens).unread_count, 1)
+        self.assertEqual(Membership.objects.get(user=self.plato, chat=rome).unread_count, 2)
+
+        # mark the whole chat read
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'chat_id': rome.chat_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Membership.objects.get(user=self.plato, chat=rome).last_read_msg_id, rome_msgs[2].msg_id)
+        self.assertEqual(Membership.objects.get(user=self.plato, chat=rome).unread_count, 0)
+
+        # nothing new to read
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'chat_id': rome.chat_id,
+                                       'msg_id': rome_msgs[1].msg_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.json()['chats'], [])
+
+        # aristotle is not in rome
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.aristotle.user_id,
+                                       'msg_ids': [athens_msgs[0].msg_id, rome_msgs[0].msg_id],
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.aristotle_token)
+        self.assertEqual(response.status_code, 401)
+
+        # aristotle is not in an empty chat either
+        carthage = Chat.objects.create(chat_name='Carthage', is_private=False)
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.aristotle.user_id,
+                                       'chat_id': carthage.chat_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.aristotle_token)
+        self.assertEqual(response.status_code, 401)
+
+        # plato deleted the message
+        athens_msgs[2].unable_to_see_users.add(self.plato)
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'msg_ids': [athens_msgs[2].msg_id],
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Membership.objects.get(user=self.plato, chat=self.athens).last_read_msg_id,
+                         athens_msgs[1].msg_id)
+
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                       'msg_ids': [1029384],
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.put('/api/message/read',
+                                   data={
+                                       'user_id': self.plato.user_id,
+                                   },
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 400)
+
     def test_read_message_bad_method(self):
         response = self.client.post('/api/message/send',
                                     data={
@@ -692,3 +838,184 @@ class MessageTestCase(TestCase):
                                     content_type='application/json',
                                     HTTP_AUTHORIZATION=self.socrates_token)
         self.assertEqual(response.status_code, 405)
+
+    # === serialize messages ===
+    def test_serialize_messages_query_count(self):
+        for i in range(20):
+            message = Message.objects.create(sender_id=self.socrates.user_id, chat_id=self.athens.chat_id,
+                                             msg_text=f'Message #{i}', msg_type='T')
+            message.unable_to_see_users.add(self.aristotle)
+        Membership.objects.filter(user__in=[self.socrates, self.plato]).update(last_read_msg_id=message.msg_id)
+
+        # messages + read_users
+        with self.assertNumQueries(2):
+            serialized = serialize_messages(Message.objects.filter(chat_id=self.athens.chat_id), ['msg_id', 'sender_id', 'chat_id', 'read_users'])
+        self.assertEqual(len(serialized), 20)
+        self.assertEqual(sorted(serialized[0]['read_users']), sorted([self.socrates.user_id, self.plato.user_id]))
+        self.assertNotIn('unable_to_see_users', serialized[0])
+
+        # messages + read_users + unable_to_see_users
+        with self.assertNumQueries(3):
+            serialized = serialize_messages(Message.objects.filter(chat_id=self.athens.chat_id), ['msg_id', 'read_users', 'unable_to_see_users'])
+        self.assertEqual(serialized[0]['unable_to_see_users'], [self.aristotle.user_id])
+
+        messages = Message.objects.filter(chat_id=self.athens.chat_id)
+
+        self.assertEqual(serialize_messages(messages, ['msg_id', 'read_users', 'unable_to_see_users']),
+                         [{'msg_id': message.msg_id,
+                           'read_users': message.serialize()['read_users'],
+                           'unable_to_see_users': message.serialize()['unable_to_see_users']}
+                          for message in messages])
+
+    # === search messages ===
+    def test_search_messages(self):
+        hello = Message.objects.create(sender_id=self.socrates.user_id, chat_id=self.athens.chat_id,
+                                       msg_text='Hello World!', msg_type='T')
+        hello_hello = Message.objects.create(sender_id=self.plato.user_id, chat_id=self.athens.chat_id,
+                                             msg_text='hello hello hello', msg_type='T')
+        chinese = Message.objects.create(sender_id=self.plato.user_id, chat_id=self.athens.chat_id,
+                                         msg_text='苏格拉底是一位哲学家', msg_type='T')
+
+        messages = Message.objects.filter(chat_id=self.athens.chat_id)
+        self.assertEqual(set(search_messages(messages, 'hello')), {hello, hello_hello})
+        self.assertEqual(list(search_messages(messages, 'hello', rank=True)), [hello_hello, hello])
+        self.assertEqual(list(search_messages(messages, '一位哲学')), [chinese])
+        # short keyword
+        self.assertEqual(list(search_messages(messages, '哲学')), [chinese])
+        # quote
+        self.assertEqual(list(search_messages(messages, '"hello')), [])
+
+        # withdraw
+        hello.delete()
+        self.assertEqual(list(search_messages(messages, 'World')), [])
+
+    def test_search_endpoint(self):
+        rome = Chat.objects.create(chat_name='Rome', is_private=False)
+        Membership.objects.create(user_id=self.plato.user_id, chat_id=rome.chat_id, is_approved=True, privilege='O')
+        sparta = Chat.objects.create(chat_name='Sparta', is_private=False)
+        Membership.objects.create(user_id=self.plato.user_id, chat_id=sparta.chat_id, is_approved=False,
+                                  privilege='M')
+
+        athens_msg = Message.objects.create(sender_id=self.socrates.user_id, chat_id=self.athens.chat_id,
+                                            msg_text='Know thyself, said the philosopher', msg_type='T')
+        rome_msg = Message.objects.create(sender_id=self.plato.user_id, chat_id=rome.chat_id,
+                                          msg_text='philosopher king', msg_type='T')
+        hidden_msg = Message.objects.create(sender_id=self.plato.user_id, chat_id=rome.chat_id,
+                                            msg_text='a hidden philosopher', msg_type='T')
+        hidden_msg.unable_to_see_users.add(self.plato)
+        # not approved
+        Message.objects.create(sender_id=self.plato.user_id, chat_id=sparta.chat_id,
+                               msg_text='spartan philosopher', msg_type='T')
+
+        response = self.client.get('/api/message/search',
+                                   data={'user_id': self.plato.user_id, 'search_text': 'philosopher'},
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 200)
+        hits = response.json()['messages']
+        self.assertEqual({hit['msg_id'] for hit in hits}, {athens_msg.msg_id, rome_msg.msg_id})
+        self.assertEqual({hit['chat_id'] for hit in hits}, {self.athens.chat_id, rome.chat_id})
+        self.assertIn('philosopher', hits[0]['snippet'])
+        self.assertIsNone(response.json()['next_offset'])
+
+        # pagination
+        response = self.client.get('/api/message/search',
+                                   data={'user_id': self.plato.user_id, 'search_text': 'philosopher', 'limit': 1},
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(len(response.json()['messages']), 1)
+        self.assertEqual(response.json()['next_offset'], 1)
+        response = self.client.get('/api/message/search',
+                                   data={'user_id': self.plato.user_id, 'search_text': 'philosopher', 'limit': 1,
+                                         'offset': 1},
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(len(response.json()['messages']), 1)
+        self.assertIsNone(response.json()['next_offset'])
+
+        # chat restriction
+        response = self.client.get('/api/message/search',
+                                   data={'user_id': self.plato.user_id, 'search_text': 'philosopher',
+                                         'chat_id': rome.chat_id},
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual([hit['msg_id'] for hit in response.json()['messages']], [rome_msg.msg_id])
+
+        # unauthorized
+        response = self.client.get('/api/message/search',
+                                   data={'user_id': self.plato.user_id, 'search_text': 'philosopher'},
+                                   HTTP_AUTHORIZATION=self.socrates_token)
+        self.assertEqual(response.status_code, 401)
+
+        # bad request
+        response = self.client.get('/api/message/search', data={'user_id': self.plato.user_id},
+                                   HTTP_AUTHORIZATION=self.plato_token)
+        self.assertEqual(response.status_code, 400)
+
+    # === query plans ===
+    def test_chat_event_seq(self):
+        # 发送消息时记录带序号的事件
+        response = self.client.post('/api/message/send',
+                                    data={
+                                        'user_id': self.socrates.user_id,
+                                        'chat_id': self.athens.chat_id,
+                                        'msg_text': 'Know thyself',
+                                        'msg_type': 'text',
+                                    }, format='multipart',
+                                    HTTP_AUTHORIZATION=self.socrates_token)
+        self.assertEqual(response.status_code, 200)
+        self.athens.refresh_from_db()
+        self.assertEqual(self.athens.last_seq, 1)
+        events = get_chat_events(self.athens.chat_id, 0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['seq'], 1)
+        self.assertEqual(events[0]['status'], 'send message')
+        self.assertEqual(events[0]['msg_id'], response.json()['msg_id'])
+
+        # 序号在聊天内单调递增
+        for i in range(2):
+            record_chat_event({'type': 'chat.message', 'status': 'read message', 'chat_id': self.athens.chat_id})
+        self.assertEqual([event['seq'] for event in get_chat_events(self.athens.chat_id, 1)], [2, 3])
+        self.assertEqual(get_chat_events(self.athens.chat_id, 3), [])
+        rome = Chat.objects.create(chat_name='Rome', is_private=False)
+        self.assertEqual(record_chat_event({'chat_id': rome.chat_id})['seq'], 1)
+
+        # 记录事件失败时，消息与事件一同回滚
+        rome.refresh_from_db()
+        ChatEvent.objects.create(chat=rome, seq=rome.last_seq + 1, content='{}')
+        Membership.objects.create(user=self.socrates, chat=rome, privilege='O', is_approved=True)
+        message_count = Message.objects.count()
+        response = self.client.post('/api/message/send',
+                                    data={
+                                        'user_id': self.socrates.user_id,
+                                        'chat_id': rome.chat_id,
+                                        'msg_text': 'Veni, vidi, vici',
+                                        'msg_type': 'text',
+                                    }, format='multipart',
+                                    HTTP_AUTHORIZATION=self.socrates_token)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(Message.objects.count(), message_count)
+        self.assertEqual(Chat.objects.get(chat_id=rome.chat_id).last_seq, rome.last_seq)
+        ChatEvent.objects.filter(chat=rome).delete()
+
+        # 旧事件被清理后需重新同步
+        for i in range(2 * MAX_CHAT_EVENTS):
+            record_chat_event({'chat_id': rome.chat_id})
+        self.assertIsNone(get_chat_events(rome.chat_id, 0))
+        self.assertEqual(len(get_chat_events(rome.chat_id, MAX_CHAT_EVENTS)), MAX_CHAT_EVENTS + 1)
+
+    def test_hot_queries_use_index(self):
+        self.assert_uses_index(Message.objects.filter(msg_id=1))
+        self.assert_uses_index(Membership.objects.filter(chat_id=self.athens.chat_id, user_id=self.plato.user_id,
+                                                         is_approved=True))
+        self.assert_uses_index(Message.objects.filter(msg_id__in=[1, 2, 3]).order_by().values('chat_id')
+                               .annotate(max_msg_id=Max('msg_id'), count=Count('msg_id')))
+        self.assert_uses_index(Message.objects.filter(chat_id=self.athens.chat_id, msg_id__lte=100)
+                               .order_by('-msg_id')[:1])
+        # 未读数
+        self.assert_uses_index(Message.objects.filter(chat_id=self.athens.chat_id, msg_id__gt=100)
+                               .exclude(sender_id=self.plato.user_id)
+                               .exclude(unable_to_see_users__user_id=self.plato.user_id))
+        self.assert_uses_index(Membership.objects.filter(chat_id=self.athens.chat_id, is_approved=True)
+                               .exclude(user_id=self.plato.user_id))
+        # 搜索
+        self.assert_uses_index(search_messages(
+            Message.objects.filter(chat__chat_membership__user_id=self.plato.user_id,
+                                   chat__chat_membership__is_approved=True)
+            .exclude(unable_to_see_users__user_id=self.plato.user_id), 'philosopher', rank=True)[:50])
@@ -3,5 +3,7 @@ from . import views
 
 urlpatterns = [
      path('<message_id>/management', views.message_management),
-     path('send', views.post_message)
+     path('send', views.post_message),
+     path('search', views.search),
+     path('read', views.read_messages_in_bulk)
 ]
\ No newline at end of file
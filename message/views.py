@@ -1,14 +1,18 @@
 from utils.utils_require import (require, CheckError, MAX_DESCRIPTION_LENGTH, MAX_EMAIL_LENGTH, MAX_NAME_LENGTH,
                                  NOT_FOUND_USER_ID, NOT_FOUND_CHAT_ID, UNAUTHORIZED_JWT, NOT_FOUND_MESSAGE_ID,
-                                 NO_MANAGEMENT_PRIVILEGE, MAX_MESSAGE_LENGTH)
+                                 NO_MANAGEMENT_PRIVILEGE, MAX_MESSAGE_LENGTH, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
 from django.http import HttpRequest, JsonResponse
 from utils.utils_request import (BAD_METHOD, request_success, request_failed, BAD_REQUEST,
                                  CONFLICT, SERVER_ERROR, NOT_FOUND, UNAUTHORIZED, PRECONDITION_FAILED, return_field)
-from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt
+from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt, Authenticate, check_user
 from utils.utils_time import get_timestamp
 import json
+from django.db import transaction
+from django.db.models import Max, Count
 from user.models import User
-from .models import Message, withdraw_a_message
+from .models import (Message, WithdrawnMessage, withdraw_a_message, search_messages, generate_snippet, read_messages,
+                     uncount_unread_message, refresh_last_message, generate_send_event, MESSAGE_FIELDS,
+                     record_chat_event)
 from chat.models import Chat, Membership
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
@@ -16,6 +20,7 @@ from utils.utils_require import msg_type_translation
 
 
 @CheckError
+@Authenticate
 def message_management(req: HttpRequest, message_id):
     """
     消息的获取/删除/标记已读
@@ -31,13 +36,10 @@ def message_management(req: HttpRequest, message_id):
 
     user_id = require(req.GET, 'user_id', 'int', req=req)
 
-    # user check
-    if not User.objects.filter(user_id=user_id).exists():
+    # user check & verification
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    verify_a_user(salt=user.jwt_token_salt, user_id=user_id, req=req)
-
     websocket_dict = None
 
     # message check
@@ -57,85 +59,73 @@ def message_management(req: HttpRequest, message_id):
 
     # get
     if req.method == 'GET':
-        return request_success(return_field(
-            message.serialize(),
-            [
-                "msg_id",
-                "sender_id",
-                "chat_id",
-
-                "msg_text",
-                "msg_type",
-
-                "create_time",
-                "update_time",
-
-                "read_users",
-                "unable_to_see_users",
-
-                "reply_to",
-                "is_system",
-                "msg_file_url"]
-        ))
-    # put
-    elif req.method == 'PUT':
-        if not message.read_users.filter(user_id=user_id).exists():
-            message.read_users.add(user_id)
-            message.update_time = get_timestamp()
-            message.save()
-            # 发送已读消息通知
-            websocket_dict = {
-                'type': 'chat.message',
-                'status': 'read message',
-                'user_id': user_id,
-                'chat_id': chat_id,
-                'msg_id': message_id,
-                'update_time': message.update_time
-            }
-    # delete
-    else:
-        body = json.loads(req.body.decode('utf-8'))
-        is_remove = require(body, 'is_remove', 'bool')
-        if is_remove:  # 撤回
-            # check privilege
-            if user_id != message.sender_id:
-                return UNAUTHORIZED("Unauthorized : the user is not the sender of the message")
-
-            # check time
-            if get_timestamp() > message.create_time + 300:
-                return PRECONDITION_FAILED("Precondition Failed : time exceed")
-
-            # 发送撤回消息通知
-            websocket_dict = {
-                'type': 'chat.message',
-                'status': 'withdraw message',
-                'user_id': user_id,
-                'chat_id': chat_id,
-                'msg_id': message_id,
-                'update_time': get_timestamp()
-            }
-
-            # 新建“撤回消息”系统通知
-            withdraw_a_message(user_id=user_id, chat_id=chat_id)
-
-            # delete
-            message.delete()
-
-        else:  # 删除
-            message.unable_to_see_users.add(user_id)
-            message.save()
+        return request_success(return_field(message.serialize(), MESSAGE_FIELDS))
+
+    # 修改与对应的聊天事件在同一事务中提交
+    with transaction.atomic():
+        # put
+        if req.method == 'PUT':
+            # 推进已读水位线，该消息及之前的消息均视为已读
+            if read_messages(user_id=user_id, chat_id=chat_id, msg_id=message_id):
+                # 发送已读消息通知
+                websocket_dict = {
+                    'type': 'chat.message',
+                    'status': 'read message',
+                    'user_id': user_id,
+                    'chat_id': chat_id,
+                    'msg_id': message_id,
+                    'update_time': get_timestamp()
+                }
+        # delete
+        else:
+            body = json.loads(req.body.decode('utf-8'))
+            is_remove = require(body, 'is_remove', 'bool')
+            if is_remove:  # 撤回
+                # check privilege
+                if user_id != message.sender_id:
+                    return UNAUTHORIZED("Unauthorized : the user is not the sender of the message")
+
+                # check time
+                if get_timestamp() > message.create_time + 300:
+                    return PRECONDITION_FAILED("Precondition Failed : time exceed")
+
+                # 发送撤回消息通知
+                websocket_dict = {
+                    'type': 'chat.message',
+                    'status': 'withdraw message',
+                    'user_id': user_id,
+                    'chat_id': chat_id,
+                    'msg_id': message_id,
+                    'update_time': get_timestamp()
+                }
+
+                # 新建“撤回消息”系统通知
+                withdraw_a_message(user_id=user_id, chat_id=chat_id)
+
+                # delete
+                uncount_unread_message(message)
+                WithdrawnMessage.objects.create(msg_id=message_id, chat_id=chat_id)
+                message.delete()
+                if Chat.objects.filter(chat_id=chat_id, last_msg_id=message_id).exists():
+                    refresh_last_message(chat_id)
+
+            else:  # 删除
+                uncount_unread_message(message, user_id=user_id)
+                message.unable_to_see_users.add(user_id)
+                message.save()
+
+        if websocket_dict is not None:
+            record_chat_event(websocket_dict)
 
     # 发送websocket通知到对应群组
     if websocket_dict is not None:
-        async_to_sync(get_channel_layer().group_send)(
-            f'chat_{chat_id}',
-            websocket_dict
-        )
+        async_to_sync(get_channel_layer().group_send)(f'chat_{chat_id}', websocket_dict)
 
     return request_success()
 
 
 @CheckError
+@Authenticate
 def post_message(req: HttpRequest):
     """
     前端向后端发送消息
@@ -149,8 +139,8 @@ def post_message(req: HttpRequest):
     msg_text = require(req.POST, 'msg_text', 'string', req=req)
     msg_type = require(req.POST, 'msg_type', 'string', req=req)
 
-    # user check
-    if not User.objects.filter(user_id=user_id).exists():
+    # user check & verification
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
     # chat check
@@ -162,11 +152,6 @@ def post_message(req: HttpRequest):
         return UNAUTHORIZED(f"Unauthorized : user {user_id} not in chat {chat_id}")
     membership = Membership.objects.get(chat_id=chat_id, user_id=user_id, is_approved=True)
 
-    # verification
-
-    user = User.objects.get(user_id=user_id)
-    verify_a_user(salt=user.jwt_token_salt, user_id=user_id, req=req)
-
     # get reply to
     reply_to = require(req.POST, 'reply_to', 'int', is_essential=False, req=req)
     if reply_to is not None:
@@ -178,44 +163,182 @@ def post_message(req: HttpRequest):
     if len(msg_text) > MAX_MESSAGE_LENGTH:
         return BAD_REQUEST("Invalid msg_text : msg_text length exceed")  # 400
 
-    # check msg_type
-    if msg_type == 'text':
-        message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text, msg_type='T')
-    elif msg_type == 'group_notice':
-        # check privilege
-        if membership.privilege == 'A' or membership.privilege == 'O':
-            message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text, msg_type='G')
+    # 新消息与对应的聊天事件在同一事务中提交
+    with transaction.atomic():
+        # check msg_type
+        if msg_type == 'text':
+            message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text, msg_type='T')
+        elif msg_type == 'group_notice':
+            # check privilege
+            if membership.privilege == 'A' or membership.privilege == 'O':
+                message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text, msg_type='G')
+            else:
+                return UNAUTHORIZED("Unauthorized : the user is neither the owner nor the admin of the chat")
+        elif msg_type == 'image' or msg_type == 'audio' or msg_type == 'video' or msg_type == 'others':
+            msg_file = require(req.FILES, 'msg_file', msg_type)
+            message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text,
+                                             msg_type=msg_type_translation[msg_type],
+                                             msg_file=msg_file)
         else:
-            return UNAUTHORIZED("Unauthorized : the user is neither the owner nor the admin of the chat")
-    elif msg_type == 'image' or msg_type == 'audio' or msg_type == 'video' or msg_type == 'others':
-        msg_file = require(req.FILES, 'msg_file', msg_type)
-        message = Message.objects.create(sender_id=user_id, chat_id=chat_id, msg_text=msg_text,
-                                         msg_type=msg_type_translation[msg_type],
-                                         msg_file=msg_file)
-    else:
-        return BAD_REQUEST(
-            "Invalid msg_type : msg_type not in ['text', 'group_notice', 'image', 'audio', 'video', 'others']")
+            return BAD_REQUEST(
+                "Invalid msg_type : msg_type not in ['text', 'group_notice', 'image', 'audio', 'video', 'others']")
 
-    if reply_to is not None:
-        message.reply_to = reply_to.msg_id
-        message.save()
+        if reply_to is not None:
+            message.reply_to = reply_to.msg_id
+            message.save()
 
-    # 发送“发送消息”通知
-    websocket_dict = {
-        'type': 'chat.message',
-        'status': 'send message',
-        'user_id': user_id,
-        'chat_id': chat_id,
-        'msg_id': message.msg_id,
-        'update_time': get_timestamp()
-    }
+        # 发送者已读自己的消息
+        read_messages(user_id=user_id, chat_id=chat_id, msg_id=message.msg_id)
+        event = record_chat_event(generate_send_event(message))
 
-    async_to_sync(get_channel_layer().group_send)(
-        f'chat_{chat_id}',
-        websocket_dict
-    )
+    # 发送“发送消息”通知
+    async_to_sync(get_channel_layer().group_send)(f'chat_{chat_id}', event)
 
     return request_success({
         'msg_id': message.msg_id,
         'create_time': message.create_time
     })
+
+
+@CheckError
+@Authenticate
+def search(req: HttpRequest):
+    """
+    在用户加入的所有聊天中搜索消息，按相关度排序并分页
+    """
+    if req.method != 'GET':
+        return BAD_METHOD  # 405
+
+    user_id = require(req.GET, 'user_id', 'int', req=req)
+    search_text = require(req.GET, 'search_text', 'string', req=req)
+    chat_id = require(req.GET, 'chat_id', 'int', is_essential=False, req=req)
+    offset = require(req.GET, 'offset', 'int', is_essential=False, req=req)
+    limit = require(req.GET, 'limit', 'int', is_essential=False, req=req)
+
+    if offset is None:
+        offset = 0
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if offset < 0:
+        return BAD_REQUEST("Invalid offset : must be non-negative")  # 400
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return BAD_REQUEST(f"Invalid limit : must be between 1 and {MAX_PAGE_SIZE}")  # 400
+    if len(search_text) == 0:
+        return BAD_REQUEST("Invalid search_text : must not be empty")  # 400
+
+    # user check & verification
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
+
+    # 用户可视的、已加入聊天中的消息
+    messages = Message.objects.filter(chat__chat_membership__user_id=user_id,
+                                      chat__chat_membership__is_approved=True) \
+        .exclude(unable_to_see_users__user_id=user_id)
+    if chat_id is not None:
+        messages = messages.filter(chat_id=chat_id)
+
+    messages = list(search_messages(messages, search_text, rank=True)[offset:offset + limit + 1])
+    next_offset = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_offset = offset + limit
+
+    return request_success({
+        'messages': [
+            {
+                'msg_id': message.msg_id,
+                'chat_id': message.chat_id,
+                'sender_id': message.sender_id,
+                'msg_type': message.msg_type,
+                'create_time': message.create_time,
+                'snippet': generate_snippet(message.msg_text, search_text),
+            }
+            for message in messages
+        ],
+        'next_offset': next_offset
+    })
+
+
+@CheckError
+@Authenticate
+def read_messages_in_bulk(req: HttpRequest):
+    """
+    批量标记已读：`msg_ids`中的消息，或`chat_id`中直到`msg_id`（默认为最新消息）的消息
+    每个聊天只推进一次已读水位线，并只发送一条已读通知
+    """
+    if req.method != 'PUT':
+        return BAD_METHOD  # 405
+
+    body = json.loads(req.body.decode('utf-8'))
+    user_id = require(body, 'user_id', 'int')
+    msg_ids = require(body, 'msg_ids', 'array', is_essential=False)
+    chat_id = require(body, 'chat_id', 'int', is_essential=False)
+    msg_id = require(body, 'msg_id', 'int', is_essential=False)
+
+    if msg_ids is None and chat_id is None:
+        return BAD_REQUEST("Invalid parameters. Expected `msg_ids` or `chat_id`.")  # 400
+
+    # user check & verification
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
+
+    # 各聊天需要推进到的水位线
+    watermarks = {}
+    if msg_ids is not None:
+        try:
+            msg_ids = {int(_id) for _id in msg_ids}
+        except (TypeError, ValueError):
+            return BAD_REQUEST("Invalid msg_ids : must be integers")  # 400
+        found = 0
+        for item in Message.objects.filter(msg_id__in=msg_ids).exclude(unable_to_see_users__user_id=user_id) \
+                .order_by().values('chat_id').annotate(max_msg_id=Max('msg_id'), count=Count('msg_id')):
+            watermarks[item['chat_id']] = item['max_msg_id']
+            found += item['count']
+        if found != len(msg_ids):
+            # message check & unseen (delete) check
+            if Message.objects.filter(msg_id__in=msg_ids).count() != len(msg_ids):
+                return NOT_FOUND(NOT_FOUND_MESSAGE_ID)  # 404
+            return UNAUTHORIZED("Unauthorized : the user cannot see the message")  # 401
+    if chat_id is not None:
+        messages = Message.objects.filter(chat_id=chat_id).exclude(unable_to_see_users__user_id=user_id)
+        if msg_id is not None:
+            messages = messages.filter(msg_id__lte=msg_id)
+        max_msg_id = messages.aggregate(max_msg_id=Max('msg_id'))['max_msg_id']
+        if max_msg_id is not None:
+            watermarks[chat_id] = max(watermarks.get(chat_id, 0), max_msg_id)
+
+    # membership check（包括`chat_id`中没有可读消息的情况）
+    chat_ids = set(watermarks.keys())
+    if chat_id is not None:
+        chat_ids.add(chat_id)
+    if Membership.objects.filter(user_id=user_id, chat_id__in=chat_ids, is_approved=True).count() != len(chat_ids):
+        return UNAUTHORIZED("Unauthorized : the user cannot see the message")  # 401
+
+    # 已读水位线与对应的聊天事件在同一事务中提交，每个聊天只记录一条已读通知
+    read_chats = []
+    events = []
+    update_time = get_timestamp()
+    with transaction.atomic():
+        for _chat_id, _msg_id in watermarks.items():
+            if read_messages(user_id=user_id, chat_id=_chat_id, msg_id=_msg_id):
+                read_chats.append((_chat_id, _msg_id))
+                events.append(record_chat_event({
+                    'type': 'chat.message',
+                    'status': 'read message',
+                    'user_id': user_id,
+                    'chat_id': _chat_id,
+                    'msg_id': _msg_id,
+                    'update_time': update_time
+                }))
+
+    for event in events:
+        async_to_sync(get_channel_layer().group_send)(f'chat_{event["chat_id"]}', event)
+
+    return request_success({
+        'chats': [
+            {
+                'chat_id': _chat_id,
+                'last_read_msg_id': _msg_id
+            }
+            for _chat_id, _msg_id in read_chats]
+    })
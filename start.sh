@@ -3,6 +3,10 @@
 # Set the password securely
 export DJANGO_SUPERUSER_PASSWORD='concord'
 
+# start a redis server (the cache used by migrate and the channel layer)
+redis-server --port 6379 --bind 127.0.0.1 &
+sleep 1
+
 python3 manage.py makemigrations user
 python3 manage.py makemigrations message
 python3 manage.py makemigrations chat
@@ -22,9 +26,8 @@ else
 fi
 
 
-
-# start a redis server
-redis-server --port 6379 --bind 127.0.0.1 &
+# clear websocket state left by the previous run
+python3 manage.py cleanup_websocket --all
 
 python3 manage.py runserver 0.0.0.0:80
 
@@ -1,5 +1,6 @@
-from django.db import models
-from django.db.models.signals import pre_delete
+from django.db import models, transaction
+from django.core.cache import cache
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
 from imagekit.models import ProcessedImageField
 from imagekit.processors import ResizeToFit
@@ -9,6 +10,9 @@ from utils.utils_require import MAX_NAME_LENGTH, MAX_EMAIL_LENGTH, MAX_DESCRIPTI
 
 import os
 
+# jwt 盐缓存的过期时间（秒）
+JWT_SALT_CACHE_TIMEOUT = 60
+
 
 class User(models.Model):
     """
@@ -99,6 +103,63 @@ class Friendship(models.Model):
 
     class Meta:
         unique_together = ('user', 'friend')  # 每一条需要独一无二
+        indexes = [
+            models.Index(fields=['user', 'is_approved']),  # 好友列表
+            models.Index(fields=['user', 'update_time']),  # 增量同步
+        ]
 
     def __str__(self) -> str:
         return f"{self.user.user_name} and {self.friend.user_name} are friends"
+
+
+def get_jwt_salt_cache_key(user_id):
+    return f'jwt_salt:{user_id}'
+
+
+def get_jwt_salt(user_id, use_cache=True):
+    """
+    获取用户的 jwt 盐，优先从缓存中读取，缓存未命中时查询数据库并写入缓存
+    :param user_id: 用户 id
+    :param use_cache: 是否读取缓存，为 False 时直接查询数据库
+    :return: 盐，用户不存在时返回 None
+    """
+    if use_cache:
+        try:
+            salt = cache.get(get_jwt_salt_cache_key(user_id))
+        except Exception as e:
+            print(f"Failed to read jwt salt cache: {e}")
+            salt = None
+        if salt is not None:
+            return salt
+    salt = User.objects.filter(user_id=user_id).values_list('jwt_token_salt', flat=True).first()
+    if salt is None:
+        return None
+    salt = bytes(salt)
+    set_jwt_salt_cache(user_id, salt)
+    return salt
+
+
+def set_jwt_salt_cache(user_id, salt):
+    """
+    写入（`salt`为 None 时删除）jwt 盐缓存；缓存不可用时忽略，验证时回退到数据库
+    """
+    try:
+        if salt is None:
+            cache.delete(get_jwt_salt_cache_key(user_id))
+        else:
+            cache.set(get_jwt_salt_cache_key(user_id), salt, JWT_SALT_CACHE_TIMEOUT)
+    except Exception as e:
+        print(f"Failed to update jwt salt cache: {e}")
+
+
+# 用户保存（如登录时更换盐）或删除的事务提交后，更新 jwt 盐缓存，避免回滚后缓存中残留未保存的盐
+@receiver(post_save, sender=User)
+def update_jwt_salt_cache(sender, instance, **kwargs):
+    user_id, salt = instance.user_id, bytes(instance.jwt_token_salt)
+    transaction.on_commit(lambda: set_jwt_salt_cache(user_id, salt))
+
+
+@receiver(post_delete, sender=User)
+def delete_jwt_salt_cache(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: set_jwt_salt_cache(user_id, None))
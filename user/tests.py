@@ -1,14 +1,18 @@
-from django.test import TestCase
-from .models import User
-from utils.utils_security import generate_jwt_token
+from django.test import TestCase, override_settings
+from django.db import transaction, IntegrityError
+from utils.utils_test import QueryPlanMixin
+from django.core.cache import cache, caches
+from .models import User, Friendship, get_jwt_salt_cache_key, JWT_SALT_CACHE_TIMEOUT
+from utils.utils_security import generate_jwt_token, generate_salt, verify_user_id
 from utils.utils_time import get_timestamp
 from chat.models import Chat, Membership
 from message.models import Notification, Message
 from django.contrib.auth.hashers import make_password
 import json
+import os
 
 
-class UserTestCase(TestCase):
+class UserTestCase(QueryPlanMixin, TestCase):
 
     def setUp(self):
         self.admin = User.objects.create(
@@ -167,6 +171,69 @@ class UserTestCase(TestCase):
         self.assertEqual(response.json()['user_name'], 'admin')
         self.assertTrue(response.json()['token'])
 
+    def test_login_rotates_cached_salt(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            token = self.login(user_name='admin', password='admin_pwd').json()['token']
+        # 缓存命中时验证不查询数据库
+        with self.assertNumQueries(0):
+            self.assertTrue(verify_user_id(self.admin.user_id, None, token=token))
+        # 重新登录更换盐，旧 token 失效
+        with self.captureOnCommitCallbacks(execute=True):
+            new_token = self.login(user_name='admin', password='admin_pwd').json()['token']
+        with self.assertNumQueries(0):
+            self.assertTrue(verify_user_id(self.admin.user_id, None, token=new_token))
+        with self.assertRaises(ValueError):
+            verify_user_id(self.admin.user_id, None, token=token)
+        # 其他 worker（独立的缓存连接）同样读到新的盐
+        if not os.getenv('LOCAL_LAYERS'):
+            other_cache = caches.create_connection('default')
+            self.assertEqual(other_cache.get(get_jwt_salt_cache_key(self.admin.user_id)),
+                             bytes(User.objects.get(user_id=self.admin.user_id).jwt_token_salt))
+        # 其他进程更换盐时，缓存的盐验证失败后重新读取数据库
+        cache.set(get_jwt_salt_cache_key(self.admin.user_id), b'stale', JWT_SALT_CACHE_TIMEOUT)
+        self.assertTrue(verify_user_id(self.admin.user_id, None, token=new_token))
+        # 用户删除后
+        user_id = self.admin.user_id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admin.delete()
+        self.assertFalse(verify_user_id(user_id, None, token=new_token))
+
+    def test_salt_cache_is_best_effort(self):
+        key = get_jwt_salt_cache_key(self.admin.user_id)
+        cache.delete(key)
+        # 事务回滚后缓存中不残留未保存的盐
+        try:
+            with transaction.atomic():
+                self.admin.jwt_token_salt = generate_salt()
+                self.admin.save()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertIsNone(cache.get(key))
+        # 缓存不可用时保存用户与验证均回退到数据库
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://127.0.0.1:1',
+        }}):
+            with self.captureOnCommitCallbacks(execute=True):
+                token = self.login(user_name='admin', password='admin_pwd').json()['token']
+            self.assertTrue(verify_user_id(self.admin.user_id, None, token=token))
+
+    def test_authenticate(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            admin_token = self.login(user_name='admin', password='admin_pwd').json()['token']
+            guest_token = self.login(user_name='guest', password='guest_pwd').json()['token']
+        url = f'/api/user/private/{self.admin.user_id}/unread'
+        # 认证一次：用户 + 未读数
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=guest_token).status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='bad.token').status_code, 401)
+        self.assertEqual(self.client.get('/api/user/private/99999/unread',
+                                         HTTP_AUTHORIZATION=admin_token).status_code, 404)
+
     def test_login_user_not_found(self):
         response = self.login(user_name='admin1', password='admin_pwd')
         self.assertEqual(response.status_code, 404)
@@ -529,6 +596,176 @@ class UserTestCase(TestCase):
         self.assertEqual(len(chats), 1)
         self.assertEqual(chats[0]['chat_name'], 'Admin_chat')
 
+    def test_unread_count_success(self):
+        admin_response = self.login(user_name='admin', password='admin_pwd')
+        admin_token = admin_response.json()['token']
+        admin_id = admin_response.json()['user_id']
+
+        guest_token = self.login(user_name='guest', password='guest_pwd').json()['token']
+
+        chatA = Chat.objects.create(chat_name='Admin_chat', is_private=False)
+        chatB = Chat.objects.create(chat_name='Guest_chat', is_private=False)
+        for chat in (chatA, chatB):
+            Membership.objects.create(user_id=admin_id, chat=chat, privilege='O', is_approved=True)
+            Membership.objects.create(user=self.guest, chat=chat, privilege='M', is_approved=True)
+
+        messages = [Message.objects.create(sender=self.guest, chat=chatA, msg_text=f'Message #{i}')
+                    for i in range(3)]
+        Message.objects.create(sender=self.guest, chat=chatB, msg_text='Hello')
+        Message.objects.create(sender_id=admin_id, chat=chatB, msg_text='Hi')
+
+        response = self.client.get(path=f"/api/user/private/{admin_id}/chats", HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({chat['chat_id']: chat['unread_count'] for chat in response.json()['chats']},
+                         {chatA.chat_id: 3, chatB.chat_id: 1})
+
+        response = self.client.get(path=f"/api/user/private/{admin_id}/unread", HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['unread_count'], 4)
+
+        # read up to the second message
+        response = self.client.put(f'/api/message/{messages[1].msg_id}/management', data={'user_id': admin_id},
+                                   content_type='application/json', HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Membership.objects.get(user_id=admin_id, chat=chatA).unread_count, 1)
+
+        # the guest withdraws the last unread message
+        response = self.client.delete(f'/api/message/{messages[2].msg_id}/management',
+                                      data={'user_id': self.guest.user_id, 'is_remove': True},
+                                      content_type='application/json', HTTP_AUTHORIZATION=guest_token)
+        self.assertEqual(response.status_code, 200)
+        # the system message replaces the withdrawn one
+        admin_membership = Membership.objects.get(user_id=admin_id, chat=chatA)
+        self.assertEqual(admin_membership.unread_count, 1)
+        self.assertEqual(admin_membership.unread_count, admin_membership.count_unread())
+
+        response = self.client.get(path=f"/api/user/private/{admin_id}/unread", HTTP_AUTHORIZATION=guest_token)
+        self.assertEqual(response.status_code, 401)
+
+    def test_sync_success(self):
+        admin_response = self.login(user_name='admin', password='admin_pwd')
+        admin_token = admin_response.json()['token']
+        admin_id = admin_response.json()['user_id']
+        guest_token = self.login(user_name='guest', password='guest_pwd').json()['token']
+
+        chatA = Chat.objects.create(chat_name='Admin_chat', is_private=False, create_time=1000)
+        Membership.objects.create(user_id=admin_id, chat=chatA, privilege='O', is_approved=True, update_time=1000)
+        Membership.objects.create(user=self.guest, chat=chatA, privilege='M', is_approved=True, update_time=1000)
+        old_msg = Message.objects.create(sender=self.guest, chat=chatA, msg_text='old', create_time=1000,
+                                         update_time=1000)
+        withdrawn_msg = Message.objects.create(sender=self.guest, chat=chatA, msg_text='withdrawn')
+        since = get_timestamp() - 1
+
+        new_msgs = [Message.objects.create(sender=self.guest, chat=chatA, msg_text=f'new #{i}') for i in range(3)]
+        response = self.client.delete(f'/api/message/{withdrawn_msg.msg_id}/management',
+                                      data={'user_id': self.guest.user_id, 'is_remove': True},
+                                      content_type='application/json', HTTP_AUTHORIZATION=guest_token)
+        self.assertEqual(response.status_code, 200)
+        chatB = Chat.objects.create(chat_name='Invitation', is_private=False)
+        Membership.objects.create(user_id=admin_id, chat=chatB, privilege='M', is_approved=False)
+        Notification.objects.create(sender=self.guest, receiver_id=admin_id, content='invitation')
+
+        response = self.client.get(f'/api/user/private/{admin_id}/sync', data={'since': since},
+                                   HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        msg_ids = [msg['msg_id'] for msg in data['messages']]
+        self.assertNotIn(old_msg.msg_id, msg_ids)
+        self.assertEqual(msg_ids[:3], [msg.msg_id for msg in new_msgs])
+        # the system message of the withdrawal
+        self.assertEqual(len(msg_ids), 4)
+        self.assertEqual(data['withdrawn_messages'][0]['msg_id'], withdrawn_msg.msg_id)
+        self.assertEqual(data['chat_ids'], [chatA.chat_id])
+        self.assertEqual([(chat['chat_id'], chat['is_approved']) for chat in data['chats']],
+                         [(chatB.chat_id, False)])
+        self.assertEqual(len(data['notifications']), 1)
+        self.assertFalse(data['has_more'])
+
+        # paged delta
+        response = self.client.get(f'/api/user/private/{admin_id}/sync', data={'since': since, 'limit': 2},
+                                   HTTP_AUTHORIZATION=admin_token)
+        self.assertTrue(response.json()['has_more'])
+        self.assertEqual(len(response.json()['messages']), 2)
+        response = self.client.get(f'/api/user/private/{admin_id}/sync',
+                                   data={'since': response.json()['sync_time'],
+                                         'since_msg_id': response.json()['sync_msg_id'], 'limit': 2},
+                                   HTTP_AUTHORIZATION=admin_token)
+        self.assertFalse(response.json()['has_more'])
+        self.assertIsNone(response.json()['sync_msg_id'])
+        self.assertEqual(len(response.json()['messages']), 2)
+
+        # nothing changed since the last sync
+        response = self.client.get(f'/api/user/private/{admin_id}/sync', data={'since': data['sync_time']},
+                                   HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.json()['messages'], [])
+        self.assertEqual(response.json()['notifications'], [])
+
+        response = self.client.get(f'/api/user/private/{admin_id}/sync', HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 400)
+
+        # messages sharing the update time of the page boundary are not skipped
+        chatC = Chat.objects.create(chat_name='Same_time', is_private=False)
+        Membership.objects.create(user_id=admin_id, chat=chatC, privilege='O', is_approved=True)
+        update_time = get_timestamp() + 100
+        same_time_msgs = [Message.objects.create(sender_id=admin_id, chat=chatC, msg_text=f'same #{i}',
+                                                 update_time=update_time) for i in range(3)]
+        synced_ids = []
+        cursor = {'since': update_time - 1}
+        while True:
+            response = self.client.get(f'/api/user/private/{admin_id}/sync', data={**cursor, 'limit': 2},
+                                       HTTP_AUTHORIZATION=admin_token)
+            self.assertEqual(response.status_code, 200)
+            synced_ids += [msg['msg_id'] for msg in response.json()['messages']]
+            if not response.json()['has_more']:
+                break
+            cursor = {'since': response.json()['sync_time'], 'since_msg_id': response.json()['sync_msg_id']}
+        self.assertEqual(synced_ids, [msg.msg_id for msg in same_time_msgs])
+
+    def test_inbox_success(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            admin_response = self.login(user_name='admin', password='admin_pwd')
+        admin_token = admin_response.json()['token']
+        admin_id = admin_response.json()['user_id']
+        guest_token = self.login(user_name='guest', password='guest_pwd').json()['token']
+
+        chats = []
+        for i in range(3):
+            chat = Chat.objects.create(chat_name=f'Chat #{i}', is_private=False)
+            Membership.objects.create(user_id=admin_id, chat=chat, privilege='O', is_approved=True)
+            Membership.objects.create(user=self.guest, chat=chat, privilege='M', is_approved=True)
+            chats.append(chat)
+
+        Message.objects.create(sender=self.guest, chat=chats[1], msg_text='first')
+        Message.objects.create(sender=self.guest, chat=chats[0], msg_text='second' * 20)
+        last_msg = Message.objects.create(sender=self.guest, chat=chats[0], msg_text='third')
+
+        # 认证命中 jwt 盐缓存，不再查询用户是否存在
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/user/private/{admin_id}/inbox', HTTP_AUTHORIZATION=admin_token)
+        self.assertEqual(response.status_code, 200)
+        inbox = response.json()['chats']
+        self.assertEqual([chat['chat_id'] for chat in inbox][:2], [chats[0].chat_id, chats[1].chat_id])
+        self.assertEqual(inbox[0]['last_message']['msg_id'], last_msg.msg_id)
+        self.assertEqual(inbox[0]['unread_count'], 2)
+        self.assertEqual(inbox[1]['last_message']['msg_text'], 'first')
+        self.assertIsNone(inbox[2]['last_message'])
+
+        # withdraw the last message
+        response = self.client.delete(f'/api/message/{last_msg.msg_id}/management',
+                                      data={'user_id': self.guest.user_id, 'is_remove': True},
+                                      content_type='application/json', HTTP_AUTHORIZATION=guest_token)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f'/api/user/private/{admin_id}/inbox', data={'limit': 1},
+                                   HTTP_AUTHORIZATION=admin_token)
+        self.assertTrue(response.json()['chats'][0]['last_message']['msg_text'].endswith('withdrawn a message.'))
+        self.assertEqual(response.json()['next_offset'], 1)
+
+        # preview is truncated
+        long_msg = Message.objects.get(msg_text__startswith='second')
+        Chat.objects.filter(chat_id=chats[0].chat_id).update(last_msg_id=long_msg.msg_id)
+        response = self.client.get(f'/api/user/private/{admin_id}/inbox', HTTP_AUTHORIZATION=admin_token)
+        self.assertLess(len(response.json()['chats'][0]['last_message']['msg_text']), len('second' * 20))
+
     def test_exit_chat_success(self):
         admin_response = self.login(user_name='admin', password='admin_pwd')
         admin_token = admin_response.json()['token']
@@ -897,3 +1134,19 @@ class UserTestCase(TestCase):
             path=f"/api/user/private/100000/notification/{Notification.objects.get(sender_id=admin_id).notification_id}",
             data={}, content_type='application/json', HTTP_AUTHORIZATION=admin_token)
         self.assertEqual(response.status_code, 404)
+
+    # === query plans ===
+    def test_hot_queries_use_index(self):
+        self.assert_uses_index(self.admin.get_memberships())
+        self.assert_uses_index(self.admin.get_memberships().select_related('chat', 'chat__last_msg')
+                               .order_by('-chat__last_activity', '-chat_id')[:50])
+        self.assert_uses_index(self.admin.get_friends())
+        self.assert_uses_index(Friendship.objects.filter(user_id=self.admin.user_id, friend__user_id=self.guest.user_id))
+        self.assert_uses_index(Notification.objects.filter(receiver=self.admin, is_read=False, create_time__gte=0))
+        self.assert_uses_index(Notification.objects.filter(receiver=self.admin, create_time__gte=0))
+        # 增量同步
+        self.assert_uses_index(Message.objects.filter(chat_id__in=[1, 2, 3], update_time__gt=0)
+                               .exclude(unable_to_see_users__user_id=self.admin.user_id)
+                               .order_by('update_time', 'msg_id')[:50])
+        self.assert_uses_index(self.admin.user_membership.filter(update_time__gt=0))
+        self.assert_uses_index(self.admin.user_friendship.filter(update_time__gt=0))
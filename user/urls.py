@@ -8,6 +8,9 @@ urlpatterns = [
     path('private/<user_id>', views.user_management),
     path('private/<user_id>/friends', views.friend_management),
     path('private/<user_id>/chats', views.user_chats_management),
+    path('private/<user_id>/inbox', views.get_inbox),
+    path('private/<user_id>/unread', views.get_unread_count),
+    path('private/<user_id>/sync', views.sync),
     path('private/<user_id>/avatar', views.get_user_avatar),
     path('private/<user_id>/notifications', views.get_notification_list),
     path('private/<user_id>/notification/<notification_id>', views.notification_detail_or_delete_or_read),
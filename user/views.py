@@ -1,20 +1,23 @@
 from utils.utils_require import (require, CheckError, MAX_DESCRIPTION_LENGTH, MAX_EMAIL_LENGTH, MAX_NAME_LENGTH,
-                                 NOT_FOUND_USER_ID, NOT_FOUND_CHAT_ID, NOT_FOUND_NOTIFICATION_ID, UNAUTHORIZED_JWT)
+                                 NOT_FOUND_USER_ID, NOT_FOUND_CHAT_ID, NOT_FOUND_NOTIFICATION_ID, UNAUTHORIZED_JWT,
+                                 MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE, MAX_PREVIEW_LENGTH)
 from django.http import HttpRequest, JsonResponse, FileResponse
 from utils.utils_request import (BAD_METHOD, request_success, request_failed, BAD_REQUEST,
                                  CONFLICT, SERVER_ERROR, NOT_FOUND, UNAUTHORIZED, PRECONDITION_FAILED, return_field)
-from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt, generate_code
+from utils.utils_security import generate_jwt_token, verify_a_user, generate_salt, generate_code, Authenticate, check_user
 from utils.utils_time import get_timestamp
 import json
 import re
 from .models import User, Friendship
 from channels.layers import get_channel_layer
-from ws.models import Client
 from asgiref.sync import async_to_sync
+from utils.utils_websocket import subscribe_chat, unsubscribe_chat
 from chat.models import Chat, Membership
-from message.models import Notification, leave_chat, change_privilege
+from message.models import (Message, Notification, WithdrawnMessage, leave_chat, change_privilege,
+                            serialize_messages)
 from .email_sender import send_email, generate_email_content
 from django.contrib.auth.hashers import make_password, check_password
+from django.db.models import Q
 
 
 @CheckError
@@ -134,13 +137,15 @@ def get_user_avatar(req: HttpRequest, user_id):
     except ValueError:
         return BAD_REQUEST("User id must be an integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
+    user = User.objects.filter(user_id=user_id).first()
+    if user is None:
         return NOT_FOUND("Invalid user id")  # 404
 
-    return FileResponse(User.objects.get(user_id=user_id).user_icon)
+    return FileResponse(user.user_icon)
 
 
 @CheckError
+@Authenticate
 def user_management(req: HttpRequest, user_id):
     """
     用户详细信息获取/更新/删除视图
@@ -155,16 +160,16 @@ def user_management(req: HttpRequest, user_id):
     except ValueError:
         return BAD_REQUEST("User id must be an integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
-        return NOT_FOUND("Invalid user id")  # 404
-
-    user = User.objects.get(user_id=user_id)
-    SALT = user.jwt_token_salt
-
-    if req.method == "GET":  # 获取用户信息
+    if req.method == "GET":  # 获取用户信息（无需验证）
+        user = User.objects.filter(user_id=user_id).first()
+        if user is None:
+            return NOT_FOUND("Invalid user id")  # 404
         return request_success(user.serialize())
 
-    verify_a_user(salt=SALT, user_id=user.user_id, req=req)
+    if not check_user(req, user_id):
+        return NOT_FOUND("Invalid user id")  # 404
+
+    user = req.cotalk_user
 
     # passed all security check, update user
     if req.method == "POST":
@@ -202,7 +207,7 @@ def user_management(req: HttpRequest, user_id):
             if user_name is not None:
                 if len(user_name) > MAX_NAME_LENGTH:
                     return BAD_REQUEST("Username length error")
-                if user_name != User.objects.get(user_id=user_id).user_name and User.objects.filter(
+                if user_name != user.user_name and User.objects.filter(
                         user_name=user_name).exists():
                     return CONFLICT("Username conflict")
                 if len(user_name) > 0:
@@ -233,6 +238,8 @@ def user_management(req: HttpRequest, user_id):
         for chat in private_chats:
             if (chat.get_memberships()[0].user.user_id == user_id
                     or chat.get_memberships()[1].user.user_id == user_id):
+                for membership in chat.get_memberships():
+                    unsubscribe_chat(membership.user_id, chat.chat_id)
                 chat.get_memberships().delete()
                 chat.delete()
         # passed all security check, delete user
@@ -241,6 +248,7 @@ def user_management(req: HttpRequest, user_id):
 
 
 @CheckError
+@Authenticate
 def friend_management(req: HttpRequest, user_id):
     """
     好友管理/好友列表获取视图
@@ -253,17 +261,14 @@ def friend_management(req: HttpRequest, user_id):
     except ValueError:
         return BAD_REQUEST("User id must be an integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    SALT = user.jwt_token_salt
-
-    verify_a_user(salt=SALT, user_id=user.user_id, req=req)
+    user = req.cotalk_user
 
     # verification passed
     if req.method == 'GET':
-        friends = User.objects.get(user_id=user_id).get_friends()
+        friends = user.get_friends()
         return request_success({
             "friends": [
                 {**return_field(User.objects.get(user_id=friend['friend']).serialize(),
@@ -284,12 +289,6 @@ def friend_management(req: HttpRequest, user_id):
         if not User.objects.filter(user_id=friend_id).exists():
             return NOT_FOUND("Invalid friend id : friend not found")
 
-        # 尝试获取对应websocket
-        if Client.objects.filter(user_id=friend_id).exists():
-            channel_name = Client.objects.get(user_id=friend_id).channel_name
-        else:
-            channel_name = None
-
         # 判断是哪种情况
         abFriendship = Friendship.objects.filter(user_id=user_id, friend__user_id=friend_id)
         baFriendship = Friendship.objects.filter(user_id=friend_id, friend__user_id=user_id)
@@ -310,17 +309,23 @@ def friend_management(req: HttpRequest, user_id):
                         'is_approved': approve,
                     }
                     # 删除私聊
-                    Chat.objects.filter(chat_name=f"Private {user_id}&{friend_id}", is_private=True).delete()
-                    Chat.objects.filter(chat_name=f"Private {friend_id}&{user_id}", is_private=True).delete()
+                    private_chats = Chat.objects.filter(Q(chat_name=f"Private {user_id}&{friend_id}")
+                                                        | Q(chat_name=f"Private {friend_id}&{user_id}"),
+                                                        is_private=True)
+                    for chat_id in private_chats.values_list('chat_id', flat=True):
+                        unsubscribe_chat(user_id, chat_id)
+                        unsubscribe_chat(friend_id, chat_id)
+                    private_chats.delete()
                 elif group is not None:  # 更改分组
-                    abFriendship.update(group=group)
+                    abFriendship.update(group=group, update_time=get_timestamp())
             else:  # 响应好友请求
                 if approve:  # 同意请求
-                    abFriendship = Friendship.objects.create(user=User.objects.get(user_id=user_id),
+                    abFriendship = Friendship.objects.create(user=user,
                                                              friend=User.objects.get(user_id=friend_id),
                                                              is_approved=True)
                     baFriendship = baFriendship.first()
                     baFriendship.is_approved = True
+                    baFriendship.update_time = get_timestamp()
                     baFriendship.save()
                     notification_dict = {
                         'type': 'user.friend.request',
@@ -337,6 +342,8 @@ def friend_management(req: HttpRequest, user_id):
                     chat = Chat.objects.create(chat_name=f"Private {user_id}&{friend_id}", is_private=True)
                     Membership.objects.create(user_id=user_id, privilege='O', chat=chat, is_approved=True)
                     Membership.objects.create(user_id=friend_id, privilege='M', chat=chat, is_approved=True)
+                    subscribe_chat(user_id, chat.chat_id)
+                    subscribe_chat(friend_id, chat.chat_id)
                 else:  # 拒绝请求
                     baFriendship.delete()
                     notification_dict = {
@@ -347,7 +354,7 @@ def friend_management(req: HttpRequest, user_id):
                         'is_approved': approve,
                     }
         else:  # 发起请求
-            abFriendship = Friendship.objects.create(user=User.objects.get(user_id=user_id),
+            abFriendship = Friendship.objects.create(user=user,
                                                      friend=User.objects.get(user_id=friend_id),
                                                      is_approved=False)  # 首次请求的APPROVE应该是False
             notification_dict = {
@@ -364,11 +371,11 @@ def friend_management(req: HttpRequest, user_id):
 
         if notification_dict is not None:
             # 执行通知
-            if channel_name is not None:  # websocket 通知
-                async_to_sync(get_channel_layer().send)(
-                    channel_name,
-                    notification_dict
-                )
+            # websocket 通知
+            async_to_sync(get_channel_layer().group_send)(
+                f'user_{friend_id}',
+                notification_dict
+            )
             # else:
             # 静态 notification
             Notification.objects.create(
@@ -405,6 +412,7 @@ def search(req: HttpRequest):
 
 
 @CheckError
+@Authenticate
 def user_chats_management(req: HttpRequest, user_id):
     """
     获取聊天列表/退出聊天
@@ -417,24 +425,21 @@ def user_chats_management(req: HttpRequest, user_id):
     except ValueError:
         return BAD_REQUEST("User id must be an integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    verify_a_user(salt=user.jwt_token_salt, user_id=user_id, req=req)
+    user = req.cotalk_user
 
     # verification passed
     if req.method == 'GET':  # 获取聊天列表
-        chats = user.get_chats()
-        if len(chats) == 0:
-            return request_success({'chats': []})
-        else:
-            return request_success({
-                'chats': [
-                    return_field(Chat.objects.get(chat_id=chat['chat']).serialize(),
-                                 ['chat_id', 'chat_name', 'create_time', 'is_private'])
-                    for chat in chats]
-            })
+        memberships = user.get_memberships().select_related('chat')
+        return request_success({
+            'chats': [
+                {**return_field(membership.chat.serialize(),
+                                ['chat_id', 'chat_name', 'create_time', 'is_private', 'last_seq']),
+                 'unread_count': membership.unread_count}
+                for membership in memberships]
+        })
     else:  # DELETE
         body = json.loads(req.body.decode('utf-8'))
         chat_id = require(body, 'chat_id', "int")
@@ -445,6 +450,7 @@ def user_chats_management(req: HttpRequest, user_id):
 
             is_owner = membership.privilege == 'O'
             membership.delete()
+            unsubscribe_chat(user_id, chat_id)
             chat = Chat.objects.get(chat_id=chat_id)
             if len(chat.get_memberships()) == 0:  # no people left, delete the chat
                 chat.delete()
@@ -461,6 +467,7 @@ def user_chats_management(req: HttpRequest, user_id):
                     user=new_owner,
                     chat_id=chat_id)
                 membership_owner.privilege = 'O'
+                membership_owner.update_time = get_timestamp()
                 membership_owner.save()
                 # 新建系统消息
                 change_privilege(admin_id=user_id, member_id=new_owner.user_id, chat_id=chat_id, privilege='owner')
@@ -473,6 +480,195 @@ def user_chats_management(req: HttpRequest, user_id):
 
 
 @CheckError
+@Authenticate
+def get_inbox(req: HttpRequest, user_id):
+    """
+    获取收件箱：按最近活跃时间排序的聊天列表，附带最新消息预览与未读数，分页返回
+    """
+    if req.method != 'GET':
+        return BAD_METHOD  # 405
+
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return BAD_REQUEST("User id must be an integer")  # 400
+
+    offset = require(req.GET, 'offset', 'int', is_essential=False, req=req)
+    limit = require(req.GET, 'limit', 'int', is_essential=False, req=req)
+    if offset is None:
+        offset = 0
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if offset < 0:
+        return BAD_REQUEST("Invalid offset : must be non-negative")  # 400
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return BAD_REQUEST(f"Invalid limit : must be between 1 and {MAX_PAGE_SIZE}")  # 400
+
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
+
+    user = req.cotalk_user
+
+    memberships = list(user.get_memberships().select_related('chat', 'chat__last_msg')
+                       .order_by('-chat__last_activity', '-chat_id')[offset:offset + limit + 1])
+    next_offset = None
+    if len(memberships) > limit:
+        memberships = memberships[:limit]
+        next_offset = offset + limit
+
+    return request_success({
+        'chats': [
+            {**return_field(membership.chat.serialize(), ['chat_id', 'chat_name', 'create_time', 'is_private', 'last_seq']),
+             'last_activity': membership.chat.last_activity,
+             'unread_count': membership.unread_count,
+             'last_message': None if membership.chat.last_msg is None else {
+                 'msg_id': membership.chat.last_msg.msg_id,
+                 'sender_id': membership.chat.last_msg.sender_id,
+                 'msg_type': membership.chat.last_msg.msg_type,
+                 'msg_text': membership.chat.last_msg.msg_text[:MAX_PREVIEW_LENGTH],
+                 'create_time': membership.chat.last_msg.create_time,
+             }}
+            for membership in memberships],
+        'next_offset': next_offset
+    })
+
+
+@CheckError
+@Authenticate
+def get_unread_count(req: HttpRequest, user_id):
+    """
+    获取未读消息总数（角标）及各聊天的未读数
+    """
+    if req.method != 'GET':
+        return BAD_METHOD  # 405
+
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return BAD_REQUEST("User id must be an integer")  # 400
+
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
+
+    user = req.cotalk_user
+
+    unread_counts = list(user.get_memberships().filter(unread_count__gt=0).values_list('chat_id', 'unread_count'))
+    return request_success({
+        'unread_count': sum(unread_count for _, unread_count in unread_counts),
+        'chats': [
+            {
+                'chat_id': chat_id,
+                'unread_count': unread_count
+            }
+            for chat_id, unread_count in unread_counts]
+    })
+
+
+@CheckError
+@Authenticate
+def sync(req: HttpRequest, user_id):
+    """
+    增量同步：返回`since`之后新增/更新的消息、撤回的消息、成员关系、好友关系与通知
+    消息过多时只返回最早的一批，`has_more`为真，客户端以返回的`sync_time`与`sync_msg_id`作为
+    `since`与`since_msg_id`继续同步（同一`update_time`的消息按`msg_id`分页，不会遗漏）
+    """
+    if req.method != 'GET':
+        return BAD_METHOD  # 405
+
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return BAD_REQUEST("User id must be an integer")  # 400
+
+    since = require(req.GET, 'since', 'float', req=req)
+    since_msg_id = require(req.GET, 'since_msg_id', 'int', is_essential=False, req=req)
+    limit = require(req.GET, 'limit', 'int', is_essential=False, req=req)
+    if limit is None:
+        limit = MAX_PAGE_SIZE
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return BAD_REQUEST(f"Invalid limit : must be between 1 and {MAX_PAGE_SIZE}")  # 400
+
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
+
+    user = req.cotalk_user
+
+    # 先记录同步时间，避免遗漏同步期间发生的变化
+    sync_time = get_timestamp()
+    chat_ids = list(user.get_memberships().values_list('chat_id', flat=True))
+
+    cursor = Q(update_time__gt=since)
+    if since_msg_id is not None:
+        cursor |= Q(update_time=since, msg_id__gt=since_msg_id)
+    messages = list(Message.objects.filter(cursor, chat_id__in=chat_ids)
+                    .exclude(unable_to_see_users__user_id=user_id)
+                    .order_by('update_time', 'msg_id')[:limit + 1])
+    has_more = len(messages) > limit
+    sync_msg_id = None
+    if has_more:
+        messages = messages[:limit]
+        sync_time = messages[-1].update_time
+        sync_msg_id = messages[-1].msg_id
+
+    withdrawn_messages = WithdrawnMessage.objects.filter(chat_id__in=chat_ids, withdraw_time__gt=since,
+                                                         withdraw_time__lte=sync_time)
+    memberships = user.user_membership.filter(update_time__gt=since, update_time__lte=sync_time) \
+        .select_related('chat')
+    friendships = user.user_friendship.filter(update_time__gt=since, update_time__lte=sync_time)
+    notifications = user.receiver_notifications.filter(create_time__gt=since, create_time__lte=sync_time)
+
+    return request_success({
+        'sync_time': sync_time,
+        'sync_msg_id': sync_msg_id,
+        'has_more': has_more,
+        'messages': serialize_messages(messages, [
+            "msg_id",
+            "sender_id",
+            "chat_id",
+
+            "msg_text",
+            "msg_type",
+
+            "create_time",
+            "update_time",
+
+            "read_users",
+
+            "reply_to",
+            "is_system",
+            "msg_file_url"]),
+        'withdrawn_messages': [withdrawn_message.serialize() for withdrawn_message in withdrawn_messages],
+        # 当前加入的全部聊天，客户端据此删除已退出的聊天
+        'chat_ids': chat_ids,
+        'chats': [
+            {**return_field(membership.chat.serialize(), ['chat_id', 'chat_name', 'create_time', 'is_private', 'last_seq']),
+             'privilege': membership.privilege,
+             'is_approved': membership.is_approved,
+             'unread_count': membership.unread_count,
+             'update_time': membership.update_time}
+            for membership in memberships],
+        'friends': [
+            {
+                'friend_id': friendship.friend_id,
+                'group': friendship.group,
+                'is_approved': friendship.is_approved,
+                'update_time': friendship.update_time
+            }
+            for friendship in friendships],
+        'notifications': [
+            return_field(notification.serialize(), [
+                'notification_id',
+                'sender_id',
+                'content',
+                'create_time',
+                'is_read',
+            ])
+            for notification in notifications],
+    })
+
+
+@CheckError
+@Authenticate
 def get_notification_list(req: HttpRequest, user_id):
     """
     获取通知列表
@@ -494,12 +690,10 @@ def get_notification_list(req: HttpRequest, user_id):
     if later_than is None:
         later_than = 0
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-
-    verify_a_user(salt=user.jwt_token_salt, req=req, user_id=user_id)
+    user = req.cotalk_user
 
     if only_unread:
         notifications = Notification.objects.filter(receiver=user, is_read=False, create_time__gte=later_than)
@@ -520,6 +714,7 @@ def get_notification_list(req: HttpRequest, user_id):
 
 
 @CheckError
+@Authenticate
 def notification_detail_or_delete_or_read(req: HttpRequest, user_id, notification_id):
     """
     获取通知详情/删除通知
@@ -533,16 +728,14 @@ def notification_detail_or_delete_or_read(req: HttpRequest, user_id, notificatio
     except ValueError as e:
         return BAD_REQUEST("Invalid user id or notification id : must be integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
-        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
-
     if not Notification.objects.filter(notification_id=notification_id).exists():
         return NOT_FOUND(NOT_FOUND_NOTIFICATION_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-    notification = Notification.objects.get(notification_id=notification_id)
+    if not check_user(req, user_id):
+        return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    verify_a_user(salt=user.jwt_token_salt, req=req, user_id=user_id)
+    user = req.cotalk_user
+    notification = Notification.objects.get(notification_id=notification_id)
 
     if req.method == 'GET':
         return request_success({
@@ -560,6 +753,7 @@ def notification_detail_or_delete_or_read(req: HttpRequest, user_id, notificatio
     return request_success()
 
 
+@Authenticate
 def user_verification(req: HttpRequest, user_id):
     """
     向绑定邮箱发送验证码
@@ -572,12 +766,10 @@ def user_verification(req: HttpRequest, user_id):
     except ValueError as e:
         return BAD_REQUEST("Invalid user id : must be integer")  # 400
 
-    if not User.objects.filter(user_id=user_id).exists():
+    if not check_user(req, user_id):
         return NOT_FOUND(NOT_FOUND_USER_ID)  # 404
 
-    user = User.objects.get(user_id=user_id)
-
-    verify_a_user(salt=user.jwt_token_salt, req=req, user_id=user_id)
+    user = req.cotalk_user
 
     # send code
     code = generate_code(6)
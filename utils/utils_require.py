@@ -8,6 +8,16 @@ MAX_MESSAGE_LENGTH = 1000
 MAX_NAME_LENGTH = 50
 MAX_EMAIL_LENGTH = 100
 MAX_DESCRIPTION_LENGTH = 100
+MAX_PREVIEW_LENGTH = 50
+MAX_CLIENT_MSG_ID_LENGTH = 64
+
+# 分页限制
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_QUERY_PARAMS = 500
+
+# 推送限制（字节），超过时 websocket 通知中不再携带完整消息
+MAX_PUSH_PAYLOAD_SIZE = 4096
 
 # 字符串
 NOT_FOUND_USER_ID = "Invalid user id : user not found"
@@ -6,8 +6,10 @@ import json
 import base64
 import random
 import secrets
+from functools import wraps
 from typing import Optional
 from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject
 
 # c.f. https://thuse-course.github.io/course-index/basic/jwt/#jwt
 # !Important! Change this to your own salt, better randomly generated!"
@@ -125,3 +127,90 @@ def verify_a_user(salt, user_id, req, token=None):
     if int(jwt_data["user_id"]) != int(user_id):
         print(f"User ID mismatch, expected {user_id}, got {jwt_data['user_id']}")
         raise ValueError("Unauthorized : User ID mismatch, Unauthorized")
+
+
+def verify_user_id(user_id, req, token=None) -> bool:
+    """
+    使用缓存的盐验证用户，缓存命中时无需查询数据库；
+    缓存（各 worker 共享，登录更换盐时更新）中的盐验证失败时（缓存可能落后于数据库），重新从数据库读取后再验证一次
+    :param user_id: 用户 id
+    :param req: HTTP请求
+    :param token: JWT token，未提供时从请求头中获取
+    :return: 用户是否存在，验证失败时抛出异常（同 `verify_a_user`）
+    """
+    # 避免循环导入
+    from user.models import get_jwt_salt
+
+    salt = get_jwt_salt(user_id)
+    if salt is None:
+        return False
+    try:
+        verify_a_user(salt=salt, user_id=user_id, req=req, token=token)
+        return True
+    except ValueError:
+        salt = get_jwt_salt(user_id, use_cache=False)
+        if salt is None:
+            return False
+        verify_a_user(salt=salt, user_id=user_id, req=req, token=token)
+        return True
+
+
+def get_token_user_id(token: str) -> int:
+    """
+    读取 JWT token 中的用户 id（不验证签名）
+    :raise: ValueError
+    """
+    try:
+        return int(json.loads(b64url_decode(token.split(".")[1]))["data"]["user_id"])
+    except Exception:
+        raise ValueError("Unauthorized : Expired or wrong-formatted JWT token")
+
+
+def Authenticate(view_fn):
+    """
+    认证装饰器（与 `CheckError` 一同使用）：根据 Authorization 请求头认证一次，认证成功时设置
+    `req.cotalk_user_id` 与 `req.cotalk_user`（惰性加载，首次访问时才查询数据库），
+    认证失败时不直接拒绝请求，由视图调用 `check_user` 按原有顺序返回错误
+    """
+
+    @wraps(view_fn)
+    def decorated(req, *args, **kwargs):
+        # 避免循环导入
+        from user.models import User
+
+        req.cotalk_user_id = None
+        req.cotalk_user = None
+        req.cotalk_auth_error = None
+        try:
+            jwt_token = req.headers.get("Authorization")
+            if jwt_token is None:
+                raise KeyError("Missing Authorization header")
+            user_id = get_token_user_id(jwt_token)
+            if not verify_user_id(user_id, req, token=jwt_token):
+                raise ValueError("Unauthorized : User not found")
+            req.cotalk_user_id = user_id
+            req.cotalk_user = SimpleLazyObject(lambda: User.objects.get(user_id=user_id))
+        except (KeyError, ValueError) as e:
+            req.cotalk_auth_error = e
+        return view_fn(req, *args, **kwargs)
+
+    return decorated
+
+
+def check_user(req, user_id) -> bool:
+    """
+    检查 `user_id` 是否为当前请求已认证的用户（视图需使用 `Authenticate` 装饰器），
+    是则可直接使用 `req.cotalk_user`
+    :return: 用户是否存在，用户存在但认证失败时抛出认证错误（同 `verify_a_user`）
+    """
+    # 避免循环导入
+    from user.models import User
+
+    if req.cotalk_user_id is not None and req.cotalk_user_id == int(user_id):
+        return True
+    if not User.objects.filter(user_id=user_id).exists():
+        return False
+    if req.cotalk_auth_error is not None:
+        raise req.cotalk_auth_error
+    print(f"User ID mismatch, expected {user_id}, got {req.cotalk_user_id}")
+    raise ValueError("Unauthorized : User ID mismatch, Unauthorized")
@@ -0,0 +1,17 @@
+from django.db import connection
+
+
+class QueryPlanMixin:
+    """
+    单元测试混入类：检查查询计划
+    """
+
+    def assert_uses_index(self, queryset):
+        """
+        断言查询的每张表都通过索引访问，而不是全表扫描
+        """
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN output is SQLite-specific')
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            self.assertNotRegex(line, r'\bSCAN\b(?!.*VIRTUAL TABLE)', msg=f'Full scan in query plan:\n{plan}')
@@ -0,0 +1,30 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def subscribe_chat(user_id, chat_id):
+    """
+    通知用户的所有在线连接加入聊天群组 `chat_<chat_id>`
+    """
+    async_to_sync(get_channel_layer().group_send)(
+        f'user_{user_id}',
+        {
+            'type': 'chat.subscription',
+            'chat_id': chat_id,
+            'subscribe': True
+        }
+    )
+
+
+def unsubscribe_chat(user_id, chat_id):
+    """
+    通知用户的所有在线连接退出聊天群组 `chat_<chat_id>`
+    """
+    async_to_sync(get_channel_layer().group_send)(
+        f'user_{user_id}',
+        {
+            'type': 'chat.subscription',
+            'chat_id': chat_id,
+            'subscribe': False
+        }
+    )
@@ -1,5 +1,3 @@
 from django.contrib import admin
-from .models import Client
 
 # Register your models here.
-admin.site.register(Client)
\ No newline at end of file
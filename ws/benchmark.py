@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import io
+import time
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.test import Client
+
+from chat.models import Chat, Membership
+from user.models import User
+from utils.utils_security import generate_jwt_token, generate_salt
+from .consumers import WSConsumer
+
+BENCHMARK_MSG_TEXT = 'benchmark'
+
+
+def percentile(values, p):
+    """
+    :param values: 已排序的数据
+    :param p: 百分位（0 ~ 100）
+    """
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+@database_sync_to_async
+def create_fixtures(connections, chats):
+    """
+    创建`connections`个用户与`chats`个群聊，第 i 个用户加入第 i % chats 个群聊，每个群聊的第一个成员为群主
+    :return: [(user_id, token)], [(chat_id, owner index, [member index])]
+    """
+    users = []
+    for index in range(connections):
+        user = User.objects.create(user_name=f'benchmark_{index}_{time.time_ns()}', password='benchmark',
+                                   jwt_token_salt=generate_salt())
+        users.append((user.user_id, generate_jwt_token(salt=user.jwt_token_salt, user_id=user.user_id)))
+    chat_list = []
+    for chat_index in range(chats):
+        members = list(range(chat_index, connections, chats))
+        if len(members) == 0:
+            continue
+        chat = Chat.objects.create(chat_name=f'benchmark_{chat_index}', is_private=False)
+        Membership.objects.bulk_create([Membership(user_id=users[member][0], chat=chat,
+                                                   privilege='O' if member == members[0] else 'M',
+                                                   is_approved=True) for member in members])
+        chat_list.append((chat.chat_id, members[0], members))
+    return users, chat_list
+
+
+async def receive_messages(communicator, count, received):
+    """
+    接收`count`条压测消息，记录 (msg_text, 到达时间)
+    """
+    while count > 0:
+        data = await communicator.receive_json_from(timeout=60)
+        message = data.get('message')
+        if data.get('status') == 'send message' and message is not None \
+                and message['msg_text'].startswith(BENCHMARK_MSG_TEXT):
+            received.append((message['msg_text'], time.perf_counter()))
+            count -= 1
+
+
+async def run_fanout_benchmark(connections=100, chats=10, messages=50, consumer=WSConsumer, verbose=False):
+    """
+    WebSocket 扇出压测：建立`connections`个`WSConsumer`连接，分布在`chats`个群聊中，
+    依次通过`/api/message/send`发送`messages`条消息，统计消息从发送到各成员收到的延迟与投递吞吐量；
+    需在测试数据库中运行
+    :return: 统计结果
+    """
+    users, chat_list = await create_fixtures(connections, chats)
+    client = Client()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        communicators = []
+        for user_id, token in users:
+            communicator = WebsocketCommunicator(consumer.as_asgi(), f'/ws/main/{user_id}/{token}')
+            communicator.scope['url_route'] = {'kwargs': {'user_id': user_id, 'token': token}}
+            connected, _ = await communicator.connect()
+            assert connected, f'user {user_id} failed to connect'
+            communicators.append(communicator)
+
+        # 每条消息依次发往各群聊
+        plan = [chat_list[index % len(chat_list)] for index in range(messages)]
+        expected = [0] * connections
+        for _, _, members in plan:
+            for member in members:
+                expected[member] += 1
+        received = []
+        receivers = [asyncio.create_task(receive_messages(communicator, count, received))
+                     for communicator, count in zip(communicators, expected)]
+
+        send_times = {}
+        start = time.perf_counter()
+        for index, (chat_id, owner, _) in enumerate(plan):
+            msg_text = f'{BENCHMARK_MSG_TEXT} {index}'
+            send_times[msg_text] = time.perf_counter()
+            response = await sync_to_async(client.post)('/api/message/send', data={
+                'user_id': users[owner][0],
+                'chat_id': chat_id,
+                'msg_text': msg_text,
+                'msg_type': 'text',
+            }, HTTP_AUTHORIZATION=users[owner][1])
+            assert response.status_code == 200, response.content
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    latencies = sorted((receive_time - send_times[msg_text]) * 1000 for msg_text, receive_time in received)
+    return {
+        'connections': connections,
+        'chats': len(chat_list),
+        'messages': messages,
+        'deliveries': len(latencies),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if len(latencies) > 0 else 0,
+    }
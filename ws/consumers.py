@@ -1,18 +1,49 @@
+import asyncio
 import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.generic.websocket import WebsocketConsumer
 from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
 import urllib.parse
-from .models import Client
+from .presence import get_presence, sweep_stale_connections, PING_INTERVAL, IDLE_TIMEOUT
+from .groups import group_add_many, group_discard_many
+from .outbound import OutboundQueue, RESYNC_MARKER
+from .protocol import JSONCodec, select_codec
+from .piazza import RateLimiter, get_shard_group, get_shard_groups, get_piazza_history
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, IntegrityError
 from user.models import User
-from message.models import Message
+from chat.models import Membership
+from message.models import Message, read_messages, generate_send_event, record_chat_event, get_chat_events
 from utils.utils_security import verify_a_user
-from utils.utils_require import require
+from utils.utils_require import require, MAX_MESSAGE_LENGTH, MAX_CLIENT_MSG_ID_LENGTH
 from django.utils import timezone
 
+# 同一连接在同一聊天中“正在输入”通知的最小间隔（秒）
+TYPING_INTERVAL = 3
+
 
 class WSConsumer(AsyncWebsocketConsumer):
+    heartbeat_task = None
+    writer_task = None
+    ping_interval = PING_INTERVAL
+    idle_timeout = IDLE_TIMEOUT
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 当前连接已加入的聊天群组
+        self.chat_ids = set()
+        # 发送队列
+        self.outbound = OutboundQueue()
+        # 编码方式，连接时按子协议协商
+        self.codec = JSONCodec()
+        # 最近一次收到前端数据的时间
+        self.last_seen = time.monotonic()
+        # 好友，用于推送上下线通知
+        self.friend_ids = []
+        # 各聊天最近一次转发“正在输入”的时间
+        self.typing = {}
 
     async def connect(self):
         try:
@@ -24,29 +55,37 @@ class WSConsumer(AsyncWebsocketConsumer):
 
             self.user: User = await self.get_user(user_id=user_id)
 
-            exists = await self.client_exists(user_id=user_id)
-
             # 检查用户身份
             verify_a_user(salt=self.user.jwt_token_salt, user_id=user_id, req=None, token=jwt_token)
 
-            # 如果不存在连接，则建立
-            if not exists:
-                print(f'Channel {self.channel_name} connected, user id: {user_id}')
-                # 从数据库中提取群聊
-                chat_ids = await self.get_chat_ids(user=self.user)
-                if chat_ids is not None:
-                    # 加入群组
-                    for chat_id in chat_ids:
-                        await self.channel_layer.group_add(
-                            f'chat_{chat_id}',
-                            self.channel_name)
-
-                await self.accept()
-                await self.create_client(user_id=user_id)
-            else:
-                # 否则，关闭连接
-                print('User already connected')
-                await self.close()
+            print(f'Channel {self.channel_name} connected, user id: {user_id}')
+            # 从数据库中提取群聊
+            chat_ids = await self.get_chat_ids(user=self.user)
+            if chat_ids is not None:
+                self.chat_ids.update(chat_ids)
+            # 批量加入用户群组（同一用户的多个设备共享该群组）与聊天群组
+            await group_add_many(self.channel_layer,
+                                 [f'user_{user_id}', *[f'chat_{chat_id}' for chat_id in self.chat_ids]],
+                                 self.channel_name)
+
+            # 登记在线状态
+            connections = await get_presence().async_register(user_id, self.channel_name)
+            self.friend_ids = await self.get_friend_ids(user=self.user)
+            # 协商编码方式
+            self.codec = select_codec(self.scope.get('subprotocols'))
+            await self.accept(self.codec.subprotocol)
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+            self.writer_task = asyncio.create_task(self.writer())
+            # 在线好友列表（没有在线好友时不发送），以及（首个设备上线时）通知在线好友
+            online_friend_ids = await get_presence().async_get_online_users(self.friend_ids)
+            if len(online_friend_ids) > 0:
+                self.outbound.put({'type': 'user.presence.list', 'user_ids': online_friend_ids})
+            if connections == 1:
+                await self.broadcast_presence('online', online_friend_ids)
+            # 断线重连时，重放错过的聊天事件
+            last_seqs = self.get_last_seqs()
+            if last_seqs is not None:
+                await self.replay(last_seqs)
 
         except Exception as e:
             if isinstance(e, ValueError) and str(e).startswith('Unauthorized'):
@@ -56,20 +95,194 @@ class WSConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         try:
-            # 从数据库中提取群聊
-            chat_ids = await self.get_chat_ids(user=self.user)
-            # 退出群组
-            if chat_ids is not None:
-                for chat_id in chat_ids:
-                    await self.channel_layer.group_discard(
-                        f'chat_{chat_id}',
-                        self.channel_name)
-            await self.delete_client()
-            print(f'Channel {self.channel_name} disconnected, user_id:{self.user.user_id}')
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+            if self.writer_task is not None:
+                self.writer_task.cancel()
+            # 退出已加入的群组
+            await group_discard_many(self.channel_layer,
+                                     [f'user_{self.user.user_id}', *[f'chat_{chat_id}' for chat_id in self.chat_ids]],
+                                     self.channel_name)
+            await get_presence().async_unregister(self.user.user_id, self.channel_name)
+            # 结束未停止的“正在输入”
+            await asyncio.gather(*[self.channel_layer.group_send(f'chat_{chat_id}',
+                                                                 self.typing_event(chat_id, 'stopped typing'))
+                                   for chat_id in self.typing])
+            # 最后一个设备下线时通知在线好友
+            if not await get_presence().async_get_online_users([self.user.user_id]):
+                await self.broadcast_presence('offline',
+                                              await get_presence().async_get_online_users(self.friend_ids))
+            print(f'Channel {self.channel_name} disconnected, user_id:{self.user.user_id}, '
+                  f'outbound max depth: {self.outbound.max_depth}, coalesced: {self.outbound.coalesced}, '
+                  f'dropped: {self.outbound.dropped}')
         except Exception as e:
             print(e)
 
+    async def heartbeat(self):
+        """
+        定期发送 ping 并为在线状态续期，条目丢失（如过期）时重新登记；
+        前端长时间无响应时断开连接；顺带执行集群内的过期连接清理
+        """
+        presence = get_presence()
+        while True:
+            await asyncio.sleep(min(self.ping_interval, presence.ttl / 3))
+            if time.monotonic() - self.last_seen > self.idle_timeout:
+                print(f'Channel {self.channel_name} idle timeout, user_id:{self.user.user_id}')
+                await self.close()
+                return
+            self.outbound.put({'type': 'ping'}, key='ping')
+            if not await presence.async_refresh(self.user.user_id, self.channel_name):
+                await presence.async_register(self.user.user_id, self.channel_name)
+            if await presence.async_acquire_sweep():
+                await sweep_stale_connections(self.channel_layer)
+
+    def get_last_seqs(self):
+        """
+        从查询参数 `last_seqs` 中获取各聊天最后收到的事件序号，如 `?last_seqs={"1": 10, "2": 5}`
+        :return: {chat_id: seq}，未提供或格式错误时返回 None
+        """
+        query = urllib.parse.parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        if 'last_seqs' not in query:
+            return None
+        try:
+            return {int(chat_id): int(seq) for chat_id, seq in json.loads(query['last_seqs'][0]).items()}
+        except Exception as e:
+            print(f'Error: invalid last_seqs {str(e)}')
+            return None
+
+    async def replay(self, last_seqs):
+        """
+        按序重放各聊天中序号大于最后收到序号的事件，错过的事件已被清理时发送该聊天的重新同步标记；
+        重放在加入群组后、处理实时事件前完成，重复的事件由前端按序号忽略
+        :param last_seqs: {chat_id: 最后收到的事件序号}
+        """
+        for chat_id, last_seq in last_seqs.items():
+            if chat_id not in self.chat_ids:
+                continue
+            events = await self.get_chat_events(chat_id, last_seq)
+            if events is None:
+                await self.outbound.put_wait({'type': 'resync', 'chat_id': chat_id})
+                continue
+            for event in events:
+                await self.outbound.put_wait(event)
+
+    async def writer(self):
+        """
+        依次将发送队列中的事件发送给前端
+        """
+        while True:
+            data = await self.outbound.get()
+            if data is RESYNC_MARKER:
+                print(f'Channel {self.channel_name} outbound queue overflowed, user_id:{self.user.user_id}')
+            await self.send(**self.codec.encode(data))
+
+    # === 前端通信处理 ===
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        处理前端发来的数据，目前支持：
+        `type` == `chat.send`：发送文本消息
+        `type` == `chat.typing`：正在输入/停止输入
+        `type` == `ping`：回复 pong
+        `type` == `pong`：心跳响应
+        """
+        self.last_seen = time.monotonic()
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+            data_type = require(data, 'type', 'string')
+        except Exception as e:
+            print(f'Error: {str(e)}')
+            return
+        if data_type == 'chat.send':
+            await self.send_message(data)
+        elif data_type == 'chat.typing':
+            await self.send_typing(data)
+        elif data_type == 'ping':
+            self.outbound.put({'type': 'pong'}, key='pong')
+
+    async def send_message(self, data):
+        """
+        通过 websocket 发送文本消息，用客户端生成的 `client_msg_id` 确认与去重，
+        重复发送时不再新建消息与推送，只返回原消息的确认
+        :param data: {'type': 'chat.send', 'client_msg_id', 'chat_id', 'msg_text', 'reply_to'（可选）}
+        """
+        client_msg_id = data.get('client_msg_id')
+        try:
+            client_msg_id = require(data, 'client_msg_id', 'string')
+            chat_id = require(data, 'chat_id', 'int')
+            msg_text = require(data, 'msg_text', 'string')
+            reply_to = require(data, 'reply_to', 'int', is_essential=False)
+
+            message, event = await self.create_msg(chat_id=chat_id, msg_text=msg_text,
+                                                   client_msg_id=client_msg_id, reply_to=reply_to)
+            if event is not None:
+                # 直接推送“发送消息”通知
+                await self.channel_layer.group_send(f'chat_{chat_id}', event)
+            ack = {'code': 0, 'info': 'Success', 'msg_id': message.msg_id, 'create_time': message.create_time}
+        except Exception as e:
+            # 与 HTTP 接口的错误码保持一致
+            if isinstance(e, KeyError):
+                ack = {'code': -7, 'info': str(e)}
+            elif isinstance(e, ObjectDoesNotExist):
+                ack = {'code': -1, 'info': str(e)}
+            elif isinstance(e, ValueError) and str(e).startswith('Unauthorized'):
+                ack = {'code': -2, 'info': str(e)}
+            else:
+                ack = {'code': -4, 'info': f'Server error: {e}'}
+        # 向前端发送确认
+        self.outbound.put({'type': 'chat.send.ack', 'client_msg_id': client_msg_id, **ack})
+
+    # === 前端通信处理 ===
+
     # === 后端client之间通信处理 ===
+    def typing_event(self, chat_id, status):
+        return {
+            'type': 'chat.typing',
+            'status': status,
+            'user_id': self.user.user_id,
+            'chat_id': chat_id,
+        }
+
+    async def send_typing(self, data):
+        """
+        转发“正在输入”/“停止输入”，不写数据库；
+        “正在输入”每个聊天每`TYPING_INTERVAL`秒最多转发一次，“停止输入”仅在转发过“正在输入”后转发
+        :param data: {'type': 'chat.typing', 'chat_id': 聊天 id, 'status': 'typing' | 'stopped typing'}
+        """
+        try:
+            chat_id = require(data, 'chat_id', 'int')
+            status = require(data, 'status', 'string')
+        except Exception as e:
+            print(f'Error: {str(e)}')
+            return
+        # 仅限已加入的聊天
+        if chat_id not in self.chat_ids:
+            return
+        now = time.monotonic()
+        if status == 'typing':
+            last_time = self.typing.get(chat_id)
+            if last_time is not None and now - last_time < TYPING_INTERVAL:
+                return
+            self.typing[chat_id] = now
+        elif status == 'stopped typing':
+            if self.typing.pop(chat_id, None) is None:
+                return
+        else:
+            return
+        await self.channel_layer.group_send(f'chat_{chat_id}', self.typing_event(chat_id, status))
+
+    async def broadcast_presence(self, status, friend_ids):
+        """
+        向在线好友推送上下线通知（并发发送）
+        :param status: 'online' | 'offline'
+        :param friend_ids: 在线好友
+        """
+        event = {
+            'type': 'user.presence',
+            'status': status,
+            'user_id': self.user.user_id,
+        }
+        await asyncio.gather(*[self.channel_layer.group_send(f'user_{friend_id}', event) for friend_id in friend_ids])
+
     async def user_friend_request(self, event):
         """
         后端处理 `type` == `user.friend.request` 的事件
@@ -80,13 +293,13 @@ class WSConsumer(AsyncWebsocketConsumer):
         status = require(event, 'status', 'string')
         is_approved = require(event, 'is_approved', 'bool')
         # 向前端发送消息
-        await self.send(text_data=json.dumps(
+        self.outbound.put(
             {
                 'type': 'user.friend.request',
                 'status': status,
                 'user_id': friend_id,
                 'is_approved': is_approved
-            })
+            }
         )
 
     async def chat_message(self, event):
@@ -100,16 +313,54 @@ class WSConsumer(AsyncWebsocketConsumer):
         msg_id = require(event, 'msg_id', 'int')
         status = require(event, 'status', 'string')
         update_time = require(event, 'update_time', 'float')
-        # 向前端发送消息
-        await self.send(text_data=json.dumps(
+        data = {
+            'type': 'chat.message',
+            'status': status,
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'msg_id': msg_id,
+            'update_time': update_time
+        }
+        # 事件序号与完整消息（如有）
+        for key in ['seq', 'message']:
+            if key in event:
+                data[key] = event[key]
+        # 向前端发送消息，同一用户在同一聊天的已读通知只保留最新一条；
+        # 带事件序号的事件不合并，否则前端会把被合并的序号当作丢失的事件而重放
+        coalesce = status == 'read message' and 'seq' not in data
+        self.outbound.put(data, key=('read message', chat_id, user_id) if coalesce else None)
+
+    async def chat_typing(self, event):
+        """
+        后端处理 `type` == `chat.typing` 的事件，不发给本人
+        :param event: 事件数据
+        """
+        user_id = require(event, 'user_id', 'int')
+        chat_id = require(event, 'chat_id', 'int')
+        if user_id == self.user.user_id:
+            return
+        self.outbound.put(
             {
-                'type': 'chat.message',
-                'status': status,
+                'type': 'chat.typing',
+                'status': require(event, 'status', 'string'),
                 'user_id': user_id,
                 'chat_id': chat_id,
-                'msg_id': msg_id,
-                'update_time': update_time
-            }))
+            }, key=('typing', chat_id, user_id)
+        )
+
+    async def user_presence(self, event):
+        """
+        后端处理 `type` == `user.presence` 的事件，同一好友只保留最新状态
+        :param event: 事件数据
+        """
+        user_id = require(event, 'user_id', 'int')
+        self.outbound.put(
+            {
+                'type': 'user.presence',
+                'status': require(event, 'status', 'string'),
+                'user_id': user_id,
+            }, key=('presence', user_id)
+        )
 
     async def chat_management(self, event):
         """
@@ -122,35 +373,33 @@ class WSConsumer(AsyncWebsocketConsumer):
         status = require(event, 'status', 'string')
         is_approved = require(event, 'is_approved', 'bool')
         # 向前端发送消息
-        await self.send(text_data=json.dumps(
+        self.outbound.put(
             {
                 'type': 'user.friend.request',
                 'status': status,
                 'user_id': user_id,
                 'chat_id': chat_id,
                 'is_approved': is_approved
-            })
+            }
         )
 
+    async def chat_subscription(self, event):
+        """
+        后端处理 `type` == `chat.subscription` 的事件，成员关系变化时实时加入/退出聊天群组
+        :param event: 事件数据
+        """
+        chat_id = require(event, 'chat_id', 'int')
+        subscribe = require(event, 'subscribe', 'bool')
+        if subscribe:
+            await self.channel_layer.group_add(f'chat_{chat_id}', self.channel_name)
+            self.chat_ids.add(chat_id)
+        else:
+            await self.channel_layer.group_discard(f'chat_{chat_id}', self.channel_name)
+            self.chat_ids.discard(chat_id)
+
     # === 后端client之间通信处理 ===
 
     # === DJANGO ORM I/O ===
-    @database_sync_to_async
-    def create_client(self, user_id):
-        Client.objects.create(user_id=user_id, channel_name=self.channel_name)
-
-    @database_sync_to_async
-    def delete_client(self):
-        Client.objects.filter(user_id=self.user.user_id).delete()
-
-    @database_sync_to_async
-    def get_client(self, user_id):
-        return Client.objects.get(user_id=user_id)
-
-    @database_sync_to_async
-    def client_exists(self, user_id):
-        return Client.objects.filter(user_id=user_id).exists()
-
     @database_sync_to_async
     def get_user(self, user_id):
         return User.objects.get(user_id=user_id)
@@ -164,26 +413,65 @@ class WSConsumer(AsyncWebsocketConsumer):
             return [item['chat'] for item in chats]
 
     @database_sync_to_async
-    def create_msg(self, chat_id, msg_text, msg_type):
-        msg = Message.objects.create(sender=self.user, chat_id=chat_id,
-                                     msg_text=msg_text, msg_type=msg_type)
-        msg.read_users.add(self.user)
-        msg.save()
-        return msg
+    def get_friend_ids(self, user):
+        return [item['friend'] for item in user.get_friends()]
+
+    @database_sync_to_async
+    def create_msg(self, chat_id, msg_text, client_msg_id, reply_to=None):
+        """
+        新建文本消息，同一发送者的同一 `client_msg_id` 只新建一次；新消息与“发送消息”事件在同一事务中提交
+        :return: (消息, “发送消息”事件)，重复发送时事件为 None
+        """
+        if len(msg_text) > MAX_MESSAGE_LENGTH:
+            raise KeyError("Invalid msg_text : msg_text length exceed")
+        if len(client_msg_id) > MAX_CLIENT_MSG_ID_LENGTH:
+            raise KeyError("Invalid client_msg_id : client_msg_id length exceed")
+        # 去重
+        message = Message.objects.filter(sender_id=self.user.user_id, client_msg_id=client_msg_id).first()
+        if message is not None:
+            return message, None
+        # membership check
+        if not Membership.objects.filter(chat_id=chat_id, user_id=self.user.user_id, is_approved=True).exists():
+            raise ValueError(f"Unauthorized : user {self.user.user_id} not in chat {chat_id}")
+        # reply to check
+        if reply_to is not None and not Message.objects.filter(chat_id=chat_id, msg_id=reply_to).exists():
+            raise Message.DoesNotExist("Not found : reply_to message not found")
+        try:
+            with transaction.atomic():
+                msg = Message.objects.create(sender=self.user, chat_id=chat_id, msg_text=msg_text, msg_type='T',
+                                             reply_to=reply_to if reply_to is not None else -1,
+                                             client_msg_id=client_msg_id)
+                # 发送者已读自己的消息
+                read_messages(user_id=self.user.user_id, chat_id=chat_id, msg_id=msg.msg_id)
+                event = record_chat_event(generate_send_event(msg))
+        except IntegrityError:  # 并发的重复发送
+            return Message.objects.get(sender_id=self.user.user_id, client_msg_id=client_msg_id), None
+        return msg, event
+
+    @database_sync_to_async
+    def get_chat_events(self, chat_id, last_seq):
+        return get_chat_events(chat_id, last_seq)
 
     # === DJANGO ORM I/O ===
 
 
 # 公开论坛
 class PiazzaConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = RateLimiter()
+
     async def connect(self):
-        self.room_group_name = "piazza"
-        # 加入群组
+        # 按分片加入群组
+        self.room_group_name = get_shard_group(self.channel_name)
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         await self.accept()
+        # 发送最近的消息
+        for event in await get_piazza_history().async_get():
+            await self.send(text_data=json.dumps(event))
 
     async def disconnect(self, close_code):
         # 离开群组
@@ -193,22 +481,25 @@ class PiazzaConsumer(AsyncWebsocketConsumer):
         )
 
     async def receive(self, text_data):
+        # 限流
+        if not self.rate_limiter.allow():
+            await self.send(text_data=json.dumps({'type': 'rate limited'}))
+            return
         text_data_json = json.loads(text_data)
         message = text_data_json['message']
         sender_id = text_data_json['sender_id']
         sender_name = text_data_json['sender_name']
         now = timezone.now()
-        # 将消息发到群组
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'datetime': now.isoformat(),
-                'sender_id': sender_id,
-                'sender_name': sender_name,
-            }
-        )
+        event = {
+            'type': 'chat_message',
+            'message': message,
+            'datetime': now.isoformat(),
+            'sender_id': sender_id,
+            'sender_name': sender_name,
+        }
+        await get_piazza_history().async_append(event)
+        # 将消息并行发到各分片群组
+        await asyncio.gather(*[self.channel_layer.group_send(group, event) for group in get_shard_groups()])
 
     async def chat_message(self, event):
         await self.send(text_data=json.dumps(event))
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from channels_redis.core import RedisChannelLayer
+
+
+# 批量执行依赖的 channels_redis 内部接口（requirements.txt 中已固定版本），缺失时退回逐个调用公开接口
+REDIS_LAYER_INTERNALS = ['_group_key', 'connection', 'consistent_hash', 'group_expiry']
+
+
+def supports_pipeline(channel_layer) -> bool:
+    return isinstance(channel_layer, RedisChannelLayer) and \
+        all(hasattr(channel_layer, name) for name in REDIS_LAYER_INTERNALS)
+
+
+def group_by_shard(channel_layer, groups):
+    """
+    按 Redis 分片对群组分类
+    :return: {shard index: [group]}
+    """
+    shards = defaultdict(list)
+    for group in groups:
+        assert channel_layer.require_valid_group_name(group), 'Group name not valid'
+        shards[channel_layer.consistent_hash(group)].append(group)
+    return shards
+
+
+async def group_add_many(channel_layer, groups, channel_name):
+    """
+    将 channel 加入多个群组；使用 Redis channel layer 时，每个分片只需一次 pipeline 往返，
+    连接耗时不随群组数增长，其他 channel layer（或 channels_redis 内部接口变化时）则并发调用`group_add`
+    """
+    groups = list(groups)
+    if not supports_pipeline(channel_layer):
+        await asyncio.gather(*[channel_layer.group_add(group, channel_name) for group in groups])
+        return
+    assert channel_layer.require_valid_channel_name(channel_name), 'Channel name not valid'
+
+    async def add(index, shard_groups):
+        pipeline = channel_layer.connection(index).pipeline(transaction=False)
+        now = time.time()
+        for group in shard_groups:
+            group_key = channel_layer._group_key(group)
+            pipeline.zadd(group_key, {channel_name: now})
+            pipeline.expire(group_key, channel_layer.group_expiry)
+        await pipeline.execute()
+
+    await asyncio.gather(*[add(index, shard_groups)
+                           for index, shard_groups in group_by_shard(channel_layer, groups).items()])
+
+
+async def group_discard_many(channel_layer, groups, channel_name):
+    """
+    将 channel 移出多个群组，与`group_add_many`相同，按分片批量执行
+    """
+    groups = list(groups)
+    if not supports_pipeline(channel_layer):
+        await asyncio.gather(*[channel_layer.group_discard(group, channel_name) for group in groups])
+        return
+    assert channel_layer.require_valid_channel_name(channel_name), 'Channel name not valid'
+
+    async def discard(index, shard_groups):
+        pipeline = channel_layer.connection(index).pipeline(transaction=False)
+        for group in shard_groups:
+            pipeline.zrem(channel_layer._group_key(group), channel_name)
+        await pipeline.execute()
+
+    await asyncio.gather(*[discard(index, shard_groups)
+                           for index, shard_groups in group_by_shard(channel_layer, groups).items()])
@@ -0,0 +1,135 @@
+import asyncio
+import random
+import string
+import threading
+import time
+from collections import deque
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    进程内 channel layer，用于测试与压测，无需运行 redis；
+    与`InMemoryChannelLayer`不同，它可以在多个线程与事件循环之间使用（例如同步视图经`async_to_sync`发送、
+    consumer 在测试的事件循环中接收）
+    :var channels: {channel name: deque[(expire time, message)]}
+    :var groups: {group name: {channel name: join time}}
+    :var waiters: {channel name: [(loop, future)]}，等待接收的协程
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.groups = {}
+        self.waiters = {}
+
+    def wake(self, channel):
+        """
+        唤醒等待`channel`的协程，调用时需持有锁
+        """
+        for loop, future in self.waiters.pop(channel, []):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def put(self, channel, message):
+        """
+        消息入队，调用时需持有锁
+        """
+        queue = self.channels.setdefault(channel, deque())
+        if len(queue) >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.append((time.time() + self.expiry, deepcopy(message)))
+        self.wake(channel)
+
+    def clean_expired(self):
+        """
+        清除过期消息（其 channel 同时退出所有群组）与过期的群组成员，调用时需持有锁
+        """
+        now = time.time()
+        for channel, queue in list(self.channels.items()):
+            while len(queue) > 0 and queue[0][0] < now:
+                queue.popleft()
+                for members in self.groups.values():
+                    members.pop(channel, None)
+            if len(queue) == 0:
+                self.channels.pop(channel, None)
+        timeout = now - self.group_expiry
+        for members in self.groups.values():
+            for channel, join_time in list(members.items()):
+                if join_time < timeout:
+                    members.pop(channel, None)
+
+    # === channel layer API ===
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.require_valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        with self.lock:
+            self.put(channel, message)
+
+    async def receive(self, channel):
+        assert self.require_valid_channel_name(channel), 'Channel name not valid'
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                self.clean_expired()
+                queue = self.channels.get(channel)
+                if queue:
+                    message = queue.popleft()[1]
+                    if len(queue) == 0:
+                        self.channels.pop(channel, None)
+                    return message
+                future = loop.create_future()
+                self.waiters.setdefault(channel, []).append((loop, future))
+            try:
+                await future
+            finally:
+                with self.lock:
+                    waiters = self.waiters.get(channel, [])
+                    if (loop, future) in waiters:
+                        waiters.remove((loop, future))
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.local!{"".join(random.choice(string.ascii_letters) for _ in range(12))}'
+
+    async def flush(self):
+        with self.lock:
+            self.channels = {}
+            self.groups = {}
+
+    async def close(self):
+        pass
+
+    # === groups ===
+    async def group_add(self, group, channel):
+        assert self.require_valid_group_name(group), 'Group name not valid'
+        assert self.require_valid_channel_name(channel), 'Channel name not valid'
+        with self.lock:
+            self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        assert self.require_valid_group_name(group), 'Group name not valid'
+        assert self.require_valid_channel_name(channel), 'Channel name not valid'
+        with self.lock:
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if len(members) == 0:
+                    self.groups.pop(group, None)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.require_valid_group_name(group), 'Group name not valid'
+        with self.lock:
+            self.clean_expired()
+            for channel in list(self.groups.get(group, {})):
+                try:
+                    self.put(channel, message)
+                except ChannelFull:
+                    pass
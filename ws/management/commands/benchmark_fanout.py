@@ -0,0 +1,30 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ws.benchmark import run_fanout_benchmark
+
+
+class Command(BaseCommand):
+    help = 'WebSocket 扇出压测：在临时测试数据库中建立 N 个连接、M 个群聊并发送消息，统计投递延迟与吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=100, help='连接（用户）数 N')
+        parser.add_argument('--chats', type=int, default=10, help='群聊数 M')
+        parser.add_argument('--messages', type=int, default=50, help='发送的消息数')
+        parser.add_argument('--verbose', action='store_true', help='保留 consumer 的日志输出')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            result = async_to_sync(run_fanout_benchmark)(options['connections'], options['chats'],
+                                                         options['messages'], verbose=options['verbose'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(f'{result["connections"]} connections, {result["chats"]} chats, '
+                          f'{result["messages"]} messages, {result["deliveries"]} deliveries '
+                          f'in {result["elapsed"]:.2f} s')
+        self.stdout.write(f'throughput: {result["throughput"]:.1f} deliveries/s')
+        self.stdout.write(f'latency (ms): p50 {result["p50"]:.1f}, p90 {result["p90"]:.1f}, '
+                          f'p99 {result["p99"]:.1f}, max {result["max"]:.1f}')
@@ -0,0 +1,41 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from ws.groups import group_add_many, group_discard_many
+
+
+class Command(BaseCommand):
+    help = '对比逐个与批量 group_add / group_discard 的耗时（模拟加入 1/100/1000 个群聊的用户连接）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, nargs='+', default=[1, 100, 1000],
+                            help='每个连接加入的群聊数')
+        parser.add_argument('--rounds', type=int, default=5, help='每种情形的重复次数')
+
+    def handle(self, *args, **options):
+        async_to_sync(self.benchmark)(options['chats'], options['rounds'])
+
+    async def benchmark(self, chat_counts, rounds):
+        channel_layer = get_channel_layer()
+        self.stdout.write(f'{"chats":>6} {"sequential (ms)":>16} {"batched (ms)":>13}')
+        for chat_count in chat_counts:
+            groups = [f'benchmark_{index}' for index in range(chat_count)]
+            sequential, batched = 0, 0
+            for _ in range(rounds):
+                channel_name = await channel_layer.new_channel()
+
+                start = time.perf_counter()
+                for group in groups:
+                    await channel_layer.group_add(group, channel_name)
+                for group in groups:
+                    await channel_layer.group_discard(group, channel_name)
+                sequential += time.perf_counter() - start
+
+                start = time.perf_counter()
+                await group_add_many(channel_layer, groups, channel_name)
+                await group_discard_many(channel_layer, groups, channel_name)
+                batched += time.perf_counter() - start
+            self.stdout.write(f'{chat_count:>6} {sequential / rounds * 1000:>16.2f} {batched / rounds * 1000:>13.2f}')
@@ -0,0 +1,24 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from ws.presence import get_presence, sweep_stale_connections
+
+
+class Command(BaseCommand):
+    help = '清理失效的 websocket 在线状态与群组成员（启动时执行）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='清除全部在线状态与 channel layer 数据，仅在全部 worker 重启时使用')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if options['all']:
+            get_presence().clear()
+            if hasattr(channel_layer, 'flush'):
+                async_to_sync(channel_layer.flush)()
+            self.stdout.write('Cleared all websocket state')
+        else:
+            stale = async_to_sync(sweep_stale_connections)(channel_layer)
+            self.stdout.write(f'Swept {len(stale)} stale connections')
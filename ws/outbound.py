@@ -0,0 +1,90 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+
+# 每个连接的待发送事件上限
+MAX_OUTBOUND_QUEUE_SIZE = 100
+
+# 溢出后发送给前端的标记，前端收到后应通过增量同步接口重新同步
+RESYNC_MARKER = {'type': 'resync'}
+
+# 进程内所有连接的累计统计
+metrics = {
+    'enqueued': 0,  # 入队事件数
+    'coalesced': 0,  # 被合并的事件数
+    'dropped': 0,  # 溢出丢弃的事件数
+    'resyncs': 0,  # 发出的重新同步标记数
+    'max_depth': 0,  # 队列深度峰值
+}
+
+
+class OutboundQueue:
+    """
+    单个连接的有界发送队列：事件处理只负责入队，由单独的协程发送给前端，慢客户端不会阻塞 channel layer；
+    相同 key 的事件合并为最新的一条，队列已满时丢弃积压事件，改为发送一个重新同步标记
+    :var maxsize: 队列上限
+    :var depth: 当前队列深度
+    :var max_depth: 队列深度峰值
+    :var coalesced: 被合并的事件数
+    :var dropped: 溢出丢弃的事件数
+    """
+
+    def __init__(self, maxsize=MAX_OUTBOUND_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.seq = itertools.count()
+        self.ready = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.max_depth = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    def put(self, data, key=None):
+        """
+        事件入队
+        :param data: 发送给前端的数据
+        :param key: （可选）合并键，队列中已有相同 key 的事件时，移除旧事件并将新事件排到队尾，保持事件序号递增
+        """
+        metrics['enqueued'] += 1
+        if key is not None and key in self.items:
+            self.items[key] = data
+            self.items.move_to_end(key)
+            self.coalesced += 1
+            metrics['coalesced'] += 1
+            return
+        if len(self.items) >= self.maxsize:
+            # 溢出，丢弃积压事件，改为重新同步标记
+            dropped = sum(1 for item in self.items.values() if item is not RESYNC_MARKER)
+            self.dropped += dropped
+            metrics['dropped'] += dropped
+            metrics['resyncs'] += 1
+            self.items.clear()
+            self.items[('resync', next(self.seq))] = RESYNC_MARKER
+        self.items[key if key is not None else next(self.seq)] = data
+        self.max_depth = max(self.max_depth, len(self.items))
+        metrics['max_depth'] = max(metrics['max_depth'], len(self.items))
+        self.ready.set()
+
+    async def put_wait(self, data, key=None):
+        """
+        事件入队，队列已满时等待而不丢弃，用于可以等待的批量发送（如重放）
+        """
+        while len(self.items) >= self.maxsize:
+            self.not_full.clear()
+            await self.not_full.wait()
+        self.put(data, key)
+
+    async def get(self):
+        """
+        取出最早的事件，队列为空时等待
+        """
+        while len(self.items) == 0:
+            self.ready.clear()
+            await self.ready.wait()
+        data = self.items.popitem(last=False)[1]
+        self.not_full.set()
+        return data
@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+import zlib
+from collections import deque
+from importlib import import_module
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+# 新连接可以看到的最近消息数
+PIAZZA_HISTORY_SIZE = 50
+
+# 群组分片数，每个连接只加入其中一个分片
+PIAZZA_SHARDS = 8
+
+# 每个连接在`PIAZZA_RATE_PERIOD`秒内最多发送`PIAZZA_RATE_LIMIT`条消息
+PIAZZA_RATE_LIMIT = 5
+PIAZZA_RATE_PERIOD = 10
+
+
+def get_shard_group(channel_name):
+    """
+    按 channel name 确定连接所在的分片群组
+    """
+    return f'piazza_{zlib.crc32(channel_name.encode("utf-8")) % PIAZZA_SHARDS}'
+
+
+def get_shard_groups():
+    return [f'piazza_{shard}' for shard in range(PIAZZA_SHARDS)]
+
+
+class RateLimiter:
+    """
+    令牌桶限流：平均每`period / limit`秒恢复一个令牌，最多积攒`limit`个
+    """
+
+    def __init__(self, limit=PIAZZA_RATE_LIMIT, period=PIAZZA_RATE_PERIOD):
+        self.limit = limit
+        self.period = period
+        self.tokens = limit
+        self.last_time = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.last_time) * self.limit / self.period)
+        self.last_time = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class BasePiazzaHistory:
+    """
+    公开论坛的最近消息环形缓冲区
+    """
+
+    def __init__(self, size=PIAZZA_HISTORY_SIZE):
+        self.size = size
+
+    def append(self, event):
+        raise NotImplementedError()
+
+    def get(self) -> list:
+        """
+        获取最近的消息，按时间先后排列
+        """
+        raise NotImplementedError()
+
+    # === async ===
+    async def async_append(self, event):
+        return await sync_to_async(self.append, thread_sensitive=False)(event)
+
+    async def async_get(self) -> list:
+        return await sync_to_async(self.get, thread_sensitive=False)()
+
+
+class LocalPiazzaHistory(BasePiazzaHistory):
+    """
+    进程内环形缓冲区，用于测试与单进程部署
+    """
+
+    def __init__(self, size=PIAZZA_HISTORY_SIZE):
+        super().__init__(size)
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=size)
+
+    def append(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def get(self) -> list:
+        with self.lock:
+            return list(self.events)
+
+
+class RedisPiazzaHistory(BasePiazzaHistory):
+    """
+    基于 Redis 列表的环形缓冲区，各 worker 共享
+    """
+
+    def __init__(self, hosts=(('127.0.0.1', 6379),), key='piazza:history', size=PIAZZA_HISTORY_SIZE):
+        super().__init__(size)
+        host, port = hosts[0]
+        self.key = key
+        self.redis = redis.Redis(host=host, port=port, decode_responses=True)
+
+    def append(self, event):
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(self.key, json.dumps(event))
+        pipeline.ltrim(self.key, -self.size, -1)
+        pipeline.execute()
+
+    def get(self) -> list:
+        return [json.loads(event) for event in self.redis.lrange(self.key, 0, -1)]
+
+
+piazza_history = None
+
+
+def get_piazza_history() -> BasePiazzaHistory:
+    """
+    按 settings.PIAZZA 创建（并缓存）公开论坛的最近消息缓冲区，未配置时使用进程内缓冲区
+    """
+    global piazza_history
+    if piazza_history is None:
+        config = getattr(settings, 'PIAZZA', {'BACKEND': 'ws.piazza.LocalPiazzaHistory'})
+        module_name, class_name = config['BACKEND'].rsplit('.', 1)
+        piazza_history = getattr(import_module(module_name), class_name)(**config.get('CONFIG', {}))
+    return piazza_history
@@ -0,0 +1,295 @@
+import threading
+import time
+from importlib import import_module
+
+import redis
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from chat.models import Membership
+from .groups import group_discard_many
+
+# 在线状态的默认过期时间（秒），连接需在过期前发送心跳
+DEFAULT_PRESENCE_TTL = 60
+
+# 应用层心跳：服务端每隔`PING_INTERVAL`秒发送 ping，超过`IDLE_TIMEOUT`秒未收到前端任何数据则断开
+PING_INTERVAL = 20
+IDLE_TIMEOUT = 60
+
+# 过期连接的清理间隔（秒），集群内每个间隔只清理一次
+SWEEP_INTERVAL = 60
+
+
+class BasePresence:
+    """
+    在线状态注册表：记录每个用户当前所有 websocket 连接（多设备）的 channel name，
+    每个连接带有过期时间，连接通过心跳续期，worker 崩溃后条目自动过期
+    """
+
+    def __init__(self, ttl=DEFAULT_PRESENCE_TTL):
+        self.ttl = ttl
+
+    def register(self, user_id, channel_name) -> int:
+        """
+        登记用户的一个连接
+        :return: 登记后用户的在线连接数，为 1 时说明用户刚上线
+        """
+        raise NotImplementedError()
+
+    def unregister(self, user_id, channel_name) -> bool:
+        """
+        注销用户的一个连接
+        :return: 是否注销成功
+        """
+        raise NotImplementedError()
+
+    def refresh(self, user_id, channel_name) -> bool:
+        """
+        心跳续期
+        :return: 条目是否仍然存在
+        """
+        raise NotImplementedError()
+
+    def get_channel_names(self, user_id) -> list:
+        """
+        获取用户所有未过期连接的 channel name
+        """
+        raise NotImplementedError()
+
+    def is_online(self, user_id) -> bool:
+        return len(self.get_channel_names(user_id)) > 0
+
+    def get_online_users(self, user_ids) -> list:
+        """
+        批量查询在线状态
+        :return: `user_ids`中在线的用户
+        """
+        return [user_id for user_id in user_ids if self.is_online(user_id)]
+
+    def sweep(self) -> list:
+        """
+        移除所有过期的连接
+        :return: [(user_id, channel_name)]
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        移除所有连接，仅用于全部 worker 重启时
+        """
+        raise NotImplementedError()
+
+    def acquire_sweep(self, interval=SWEEP_INTERVAL) -> bool:
+        """
+        获取本轮清理的执行权，每个间隔内只有一次返回 True
+        """
+        raise NotImplementedError()
+
+    # === async ===
+    async def async_register(self, user_id, channel_name) -> int:
+        return await sync_to_async(self.register, thread_sensitive=False)(user_id, channel_name)
+
+    async def async_unregister(self, user_id, channel_name) -> bool:
+        return await sync_to_async(self.unregister, thread_sensitive=False)(user_id, channel_name)
+
+    async def async_refresh(self, user_id, channel_name) -> bool:
+        return await sync_to_async(self.refresh, thread_sensitive=False)(user_id, channel_name)
+
+    async def async_get_channel_names(self, user_id) -> list:
+        return await sync_to_async(self.get_channel_names, thread_sensitive=False)(user_id)
+
+    async def async_get_online_users(self, user_ids) -> list:
+        return await sync_to_async(self.get_online_users, thread_sensitive=False)(user_ids)
+
+    async def async_sweep(self) -> list:
+        return await sync_to_async(self.sweep, thread_sensitive=False)()
+
+    async def async_acquire_sweep(self, interval=SWEEP_INTERVAL) -> bool:
+        return await sync_to_async(self.acquire_sweep, thread_sensitive=False)(interval)
+
+
+class LocalPresence(BasePresence):
+    """
+    进程内在线状态注册表，用于测试与单进程部署
+    """
+
+    def __init__(self, ttl=DEFAULT_PRESENCE_TTL):
+        super().__init__(ttl)
+        self.lock = threading.Lock()
+        self.entries = {}  # user_id -> {channel_name: expire_time}
+        self.next_sweep_time = 0
+
+    def get_connections(self, user_id) -> dict:
+        """
+        获取用户未过期的连接，过期的连接由`sweep`移除
+        """
+        now = time.time()
+        return {name: expire_time for name, expire_time in self.entries.get(user_id, {}).items() if expire_time > now}
+
+    def register(self, user_id, channel_name) -> int:
+        with self.lock:
+            self.entries.setdefault(user_id, {})[channel_name] = time.time() + self.ttl
+            return len(self.get_connections(user_id))
+
+    def unregister(self, user_id, channel_name) -> bool:
+        with self.lock:
+            connections = self.entries.get(user_id, {})
+            if channel_name not in connections:
+                return False
+            del connections[channel_name]
+            if len(connections) == 0:
+                del self.entries[user_id]
+            return True
+
+    def refresh(self, user_id, channel_name) -> bool:
+        with self.lock:
+            if channel_name not in self.get_connections(user_id):
+                return False
+            self.entries[user_id][channel_name] = time.time() + self.ttl
+            return True
+
+    def get_channel_names(self, user_id) -> list:
+        with self.lock:
+            return list(self.get_connections(user_id).keys())
+
+    def sweep(self) -> list:
+        with self.lock:
+            now = time.time()
+            removed = []
+            for user_id, connections in list(self.entries.items()):
+                for channel_name, expire_time in list(connections.items()):
+                    if expire_time <= now:
+                        del connections[channel_name]
+                        removed.append((user_id, channel_name))
+                if len(connections) == 0:
+                    del self.entries[user_id]
+            return removed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def acquire_sweep(self, interval=SWEEP_INTERVAL) -> bool:
+        with self.lock:
+            now = time.time()
+            if now < self.next_sweep_time:
+                return False
+            self.next_sweep_time = now + interval
+            return True
+
+
+class RedisPresence(BasePresence):
+    """
+    基于 Redis 的在线状态注册表，每个用户一个有序集合，成员为 channel name，分值为过期时间，
+    每次查询只需一次往返
+    """
+    # 登记连接，返回在线连接数
+    REGISTER_SCRIPT = """
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return redis.call('ZCOUNT', KEYS[1], '(' .. ARGV[1], '+inf')
+    """
+    # 仅当连接仍未过期时才续期
+    REFRESH_SCRIPT = """
+    local expire_time = redis.call('ZSCORE', KEYS[1], ARGV[3])
+    if expire_time and tonumber(expire_time) > tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return 1
+    end
+    return 0
+    """
+    # 取出并移除过期连接
+    SWEEP_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    if #expired > 0 then
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    end
+    return expired
+    """
+
+    def __init__(self, hosts=(('127.0.0.1', 6379),), prefix='presence', ttl=DEFAULT_PRESENCE_TTL):
+        super().__init__(ttl)
+        host, port = hosts[0]
+        self.prefix = prefix
+        self.redis = redis.Redis(host=host, port=port, decode_responses=True)
+        self.register_script = self.redis.register_script(self.REGISTER_SCRIPT)
+        self.refresh_script = self.redis.register_script(self.REFRESH_SCRIPT)
+        self.sweep_script = self.redis.register_script(self.SWEEP_SCRIPT)
+        # 键的过期时间长于连接的过期时间，使过期的连接在键被删除前能被清理任务看到
+        self.key_ttl = self.ttl * 3
+
+    def key(self, user_id):
+        return f'{self.prefix}:{user_id}'
+
+    def register(self, user_id, channel_name) -> int:
+        now = time.time()
+        return self.register_script(keys=[self.key(user_id)],
+                                    args=[now, now + self.ttl, channel_name, self.key_ttl])
+
+    def unregister(self, user_id, channel_name) -> bool:
+        return bool(self.redis.zrem(self.key(user_id), channel_name))
+
+    def refresh(self, user_id, channel_name) -> bool:
+        now = time.time()
+        return bool(self.refresh_script(keys=[self.key(user_id)], args=[now, now + self.ttl, channel_name, self.key_ttl]))
+
+    def get_channel_names(self, user_id) -> list:
+        return self.redis.zrangebyscore(self.key(user_id), f'({time.time()}', '+inf')
+
+    def get_online_users(self, user_ids) -> list:
+        # 一次往返查询所有用户
+        user_ids = list(user_ids)
+        now = time.time()
+        pipeline = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zcount(self.key(user_id), f'({now}', '+inf')
+        return [user_id for user_id, count in zip(user_ids, pipeline.execute()) if count > 0]
+
+    def sweep(self) -> list:
+        now = time.time()
+        removed = []
+        for key in self.redis.scan_iter(match=f'{self.prefix}:*'):
+            user_id = int(key.split(':', 1)[1])
+            removed += [(user_id, channel_name) for channel_name in self.sweep_script(keys=[key], args=[now])]
+        return removed
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(match=f'{self.prefix}:*'))
+        if len(keys) > 0:
+            self.redis.delete(*keys)
+
+    def acquire_sweep(self, interval=SWEEP_INTERVAL) -> bool:
+        return bool(self.redis.set(f'{self.prefix}-sweep', 1, nx=True, ex=max(1, int(interval))))
+
+
+presence = None
+
+
+def get_presence() -> BasePresence:
+    """
+    按 settings.PRESENCE 创建（并缓存）在线状态注册表，未配置时使用进程内注册表
+    """
+    global presence
+    if presence is None:
+        config = getattr(settings, 'PRESENCE', {'BACKEND': 'ws.presence.LocalPresence'})
+        module_name, class_name = config['BACKEND'].rsplit('.', 1)
+        presence = getattr(import_module(module_name), class_name)(**config.get('CONFIG', {}))
+    return presence
+
+
+async def sweep_stale_connections(channel_layer):
+    """
+    清理过期的连接（如 worker 崩溃后未能注销的连接），并将其移出用户群组与聊天群组，避免继续向失效的 channel 发送
+    :return: [(user_id, channel_name)]
+    """
+    stale = await get_presence().async_sweep()
+    for user_id, channel_name in stale:
+        chat_ids = await database_sync_to_async(
+            lambda: list(Membership.objects.filter(user_id=user_id, is_approved=True)
+                         .values_list('chat_id', flat=True)))()
+        await group_discard_many(channel_layer, [f'user_{user_id}', *[f'chat_{chat_id}' for chat_id in chat_ids]],
+                                 channel_name)
+    if len(stale) > 0:
+        print(f'Swept {len(stale)} stale connections')
+    return stale
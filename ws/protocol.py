@@ -0,0 +1,103 @@
+import json
+import zlib
+
+import msgpack
+
+# 可协商的子协议（`ws/main`），未协商时使用 JSON 文本帧
+MSGPACK_SUBPROTOCOL = 'cotalk.msgpack'
+MSGPACK_DEFLATE_SUBPROTOCOL = 'cotalk.msgpack.deflate'
+
+# 超过该长度（字节）的帧才压缩
+COMPRESS_THRESHOLD = 512
+
+# MessagePack 帧中字段名的短编码
+FIELD_CODES = {
+    'type': 't',
+    'status': 's',
+    'user_id': 'u',
+    'user_ids': 'us',
+    'chat_id': 'c',
+    'msg_id': 'm',
+    'update_time': 'ut',
+    'create_time': 'ct',
+    'is_approved': 'a',
+    'seq': 'q',
+    'message': 'd',
+    'client_msg_id': 'k',
+    'code': 'e',
+    'info': 'i',
+    'sender_id': 'sd',
+    'msg_text': 'x',
+    'msg_type': 'mt',
+    'msg_file_url': 'f',
+    'read_users': 'ru',
+    'unable_to_see_users': 'uu',
+    'reply_to': 'r',
+    'is_system': 'sy',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def rename_fields(data, mapping):
+    """
+    按`mapping`递归替换字典中的字段名，未知字段保持不变
+    """
+    if isinstance(data, dict):
+        return {mapping.get(key, key): rename_fields(value, mapping) for key, value in data.items()}
+    if isinstance(data, list):
+        return [rename_fields(value, mapping) for value in data]
+    return data
+
+
+class JSONCodec:
+    """
+    默认协议：JSON 文本帧
+    """
+    subprotocol = None
+
+    def encode(self, data) -> dict:
+        """
+        :return: `send` 的参数
+        """
+        return {'text_data': json.dumps(data)}
+
+    def decode(self, text_data=None, bytes_data=None) -> dict:
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackCodec:
+    """
+    MessagePack 二进制帧，字段名使用短编码；启用压缩时，超过阈值的帧用 zlib 压缩，
+    压缩帧以 zlib 头 0x78 开头，而 MessagePack 帧总是以 map 开头（0x80 ~ 0x8f, 0xde, 0xdf），可据此区分
+    """
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.subprotocol = MSGPACK_DEFLATE_SUBPROTOCOL if compress else MSGPACK_SUBPROTOCOL
+
+    def encode(self, data) -> dict:
+        frame = msgpack.packb(rename_fields(data, FIELD_CODES))
+        if self.compress and len(frame) > COMPRESS_THRESHOLD:
+            compressed = zlib.compress(frame)
+            if len(compressed) < len(frame):
+                frame = compressed
+        return {'bytes_data': frame}
+
+    def decode(self, text_data=None, bytes_data=None) -> dict:
+        if bytes_data is None:
+            return json.loads(text_data)
+        if bytes_data[:1] == b'\x78':
+            bytes_data = zlib.decompress(bytes_data)
+        return rename_fields(msgpack.unpackb(bytes_data), FIELD_NAMES)
+
+
+def select_codec(subprotocols):
+    """
+    按客户端提供的子协议（优先级从高到低）选择编码方式
+    """
+    for subprotocol in subprotocols or []:
+        if subprotocol == MSGPACK_DEFLATE_SUBPROTOCOL:
+            return MsgpackCodec(compress=True)
+        if subprotocol == MSGPACK_SUBPROTOCOL:
+            return MsgpackCodec()
+    return JSONCodec()
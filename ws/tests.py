@@ -1,14 +1,42 @@
+import asyncio
+import io
+import os
+import time
+import json
+import urllib.parse
+import msgpack
+from unittest import skipIf
 from django.test import TestCase
 from channels.testing import WebsocketCommunicator
-from .consumers import WSConsumer
+from .consumers import WSConsumer, PiazzaConsumer
+from .piazza import (LocalPiazzaHistory, RedisPiazzaHistory, RateLimiter, get_piazza_history, PIAZZA_SHARDS,
+                     PIAZZA_RATE_LIMIT)
+from .presence import get_presence, sweep_stale_connections, LocalPresence, RedisPresence
+from .layers import LocalChannelLayer
+from .benchmark import run_fanout_benchmark
+from . import groups
+from .groups import group_add_many, group_discard_many, supports_pipeline
+from .outbound import OutboundQueue, RESYNC_MARKER, metrics
+from .protocol import (JSONCodec, MsgpackCodec, select_codec, FIELD_CODES, MSGPACK_SUBPROTOCOL,
+                       MSGPACK_DEFLATE_SUBPROTOCOL)
 from channels.db import database_sync_to_async
-from user.models import User
+from asgiref.sync import sync_to_async, async_to_sync
+from user.models import User, Friendship
 from chat.models import Chat, Membership
+from message.models import Message, ChatEvent
 from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from channels.layers import get_channel_layer, InMemoryChannelLayer
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from utils.utils_require import MAX_MESSAGE_LENGTH
+
+# 使用进程内实现时，跳过直接访问 redis 的测试
+requires_redis = skipIf(os.getenv('LOCAL_LAYERS'), 'redis is not used (LOCAL_LAYERS)')
 
 
 class WSTests(TestCase):
-    # 执行此单元测试前一定要运行redis!
+    # 执行此单元测试前一定要运行redis，或设置环境变量 LOCAL_LAYERS 使用进程内实现
     def setUp(self):
         # create 2 users and 1 chat
         self.admin = User.objects.create(user_name='admin', password=make_password('admin_pwd'))
@@ -55,7 +83,90 @@ class WSTests(TestCase):
         communicator.scope['url_route'] = {'kwargs': {'user_id': admin_id, 'token': token}}
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
+        self.assertTrue(await sync_to_async(get_presence().is_online)(admin_id))
+        await communicator.disconnect()
+        self.assertFalse(await sync_to_async(get_presence().is_online)(admin_id))
+
+    async def test_ws_idle_timeout(self):
+        """
+        应用层心跳：ping/pong 与空闲超时断开
+        """
+        class FastHeartbeatConsumer(WSConsumer):
+            ping_interval = 0.1
+            idle_timeout = 0.5
+
+        communicator = WebsocketCommunicator(FastHeartbeatConsumer.as_asgi(),
+                                             f'/ws/main/{self.admin.user_id}/{self.admin_token}')
+        communicator.scope['url_route'] = {'kwargs': {'user_id': self.admin.user_id, 'token': self.admin_token}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # 前端 ping
+        await communicator.send_json_to({'type': 'ping'})
+        types = set()
+        while 'pong' not in types:
+            types.add((await communicator.receive_json_from(timeout=5))['type'])
+        # 不响应 ping，超时后断开
+        while True:
+            output = await communicator.receive_output(timeout=5)
+            if output['type'] == 'websocket.close':
+                break
         await communicator.disconnect()
+        self.assertFalse(await sync_to_async(get_presence().is_online)(self.admin.user_id))
+
+    async def connect_user(self, user_id, token):
+        communicator = WebsocketCommunicator(WSConsumer.as_asgi(), f'/ws/main/{user_id}/{token}')
+        communicator.scope['url_route'] = {'kwargs': {'user_id': user_id, 'token': token}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_ws_typing(self):
+        admin = await self.connect_user(self.admin.user_id, self.admin_token)
+        guest = await self.connect_user(self.guest.user_id, self.guest_token)
+        event_count = await database_sync_to_async(ChatEvent.objects.count)()
+        # 连续的“正在输入”只转发一次，不发给本人
+        for _ in range(3):
+            await admin.send_json_to({'type': 'chat.typing', 'chat_id': self.chat.chat_id, 'status': 'typing'})
+        self.assertEqual(await guest.receive_json_from(), {'type': 'chat.typing', 'status': 'typing',
+                                                           'user_id': self.admin.user_id,
+                                                           'chat_id': self.chat.chat_id})
+        self.assertTrue(await guest.receive_nothing(timeout=0.2))
+        self.assertTrue(await admin.receive_nothing(timeout=0.1))
+        # 停止输入
+        await admin.send_json_to({'type': 'chat.typing', 'chat_id': self.chat.chat_id, 'status': 'stopped typing'})
+        self.assertEqual((await guest.receive_json_from())['status'], 'stopped typing')
+        await admin.send_json_to({'type': 'chat.typing', 'chat_id': self.chat.chat_id, 'status': 'stopped typing'})
+        # 未加入的聊天
+        await admin.send_json_to({'type': 'chat.typing', 'chat_id': self.chat.chat_id + 1, 'status': 'typing'})
+        self.assertTrue(await guest.receive_nothing(timeout=0.2))
+        # 断开时结束“正在输入”
+        await admin.send_json_to({'type': 'chat.typing', 'chat_id': self.chat.chat_id, 'status': 'typing'})
+        self.assertEqual((await guest.receive_json_from())['status'], 'typing')
+        await admin.disconnect()
+        self.assertEqual((await guest.receive_json_from())['status'], 'stopped typing')
+        await guest.disconnect()
+        # 不写数据库
+        self.assertEqual(await database_sync_to_async(ChatEvent.objects.count)(), event_count)
+
+    async def test_ws_friend_presence(self):
+        await database_sync_to_async(Friendship.objects.create)(user=self.admin, friend=self.guest, is_approved=True)
+        await database_sync_to_async(Friendship.objects.create)(user=self.guest, friend=self.admin, is_approved=True)
+        guest = await self.connect_user(self.guest.user_id, self.guest_token)
+        # 没有在线好友
+        self.assertTrue(await guest.receive_nothing(timeout=0.1))
+        admin = await self.connect_user(self.admin.user_id, self.admin_token)
+        self.assertEqual(await admin.receive_json_from(), {'type': 'user.presence.list',
+                                                           'user_ids': [self.guest.user_id]})
+        self.assertEqual(await guest.receive_json_from(), {'type': 'user.presence', 'status': 'online',
+                                                           'user_id': self.admin.user_id})
+        # 其他设备上下线不通知
+        admin_2 = await self.connect_user(self.admin.user_id, self.admin_token)
+        await admin_2.disconnect()
+        self.assertTrue(await guest.receive_nothing(timeout=0.2))
+        await admin.disconnect()
+        self.assertEqual(await guest.receive_json_from(), {'type': 'user.presence', 'status': 'offline',
+                                                           'user_id': self.admin.user_id})
+        await guest.disconnect()
 
     async def test_ws_fail(self):
         admin_response = await database_sync_to_async(self.register)(user_name='test_ws_fail_admin',
@@ -100,6 +211,12 @@ class WSTests(TestCase):
         self.assertEqual(admin_response.status_code, 200)
         token = admin_response.json()['token']
         admin_id = admin_response.json()['user_id']
+        guest_response = await database_sync_to_async(self.register)(user_name='test_ws_twice_guest',
+                                                                     password='guest_pwd')
+        self.assertEqual(guest_response.status_code, 200)
+        guest_id = guest_response.json()['user_id']
+
+        # 同一用户的两个设备
         communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
                                              f'/ws/main/{admin_id}/{token}')
         communicator.scope['url_route'] = {'kwargs': {'user_id': admin_id, 'token': token}}
@@ -110,16 +227,33 @@ class WSTests(TestCase):
                                               f'/ws/main/{admin_id}/{token}')
         communicator1.scope['url_route'] = {'kwargs': {'user_id': admin_id, 'token': token}}
         connected2, _ = await communicator1.connect()
-        self.assertFalse(connected2)
+        self.assertTrue(connected2)
+        self.assertEqual(len(await get_presence().async_get_channel_names(admin_id)), 2)
+
+        # 两个设备都收到通知
+        response = await database_sync_to_async(self.client.put)(path=f'/api/user/private/{guest_id}/friends',
+                                                                 data={
+                                                                     'friend_id': admin_id,
+                                                                     'approve': 'true'
+                                                                 },
+                                                                 content_type='application/json',
+                                                                 HTTP_AUTHORIZATION=guest_response.json()['token'])
+        self.assertEqual(response.status_code, 200)
+        for device in [communicator, communicator1]:
+            response = await device.receive_json_from(timeout=5)
+            self.assertEqual(response['status'], 'make request')
+            self.assertEqual(response['user_id'], guest_id)
 
         await communicator.disconnect()
+        self.assertEqual(len(await get_presence().async_get_channel_names(admin_id)), 1)
         await communicator1.disconnect()
+        self.assertEqual(len(await get_presence().async_get_channel_names(admin_id)), 0)
 
         communicator2 = WebsocketCommunicator(WSConsumer.as_asgi(),
                                               f'/ws/main/{admin_id}/{token}')
         communicator2.scope['url_route'] = {'kwargs': {'user_id': admin_id, 'token': token}}
         connected3, _ = await communicator2.connect()
-        # self.assertTrue(connected3)
+        self.assertTrue(connected3)
         await communicator2.disconnect()
 
     async def test_friend_request_success(self):
@@ -363,6 +497,12 @@ class WSTests(TestCase):
                                                                  content_type='application/json',
                                                                  HTTP_AUTHORIZATION=aristotle_token)
         self.assertEqual(response.status_code, 200)
+        # 无需重连即可收到该聊天的消息
+        self.assertTrue(await aristotle_communicator.receive_nothing(timeout=0.5))
+        await self.post_a_message(socrates_id, socrates_token, _chat.chat_id)
+        response = await aristotle_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['status'], 'send message')
+        self.assertEqual(response['chat_id'], _chat.chat_id)
 
         # plato kicked aristotle out
         response = await database_sync_to_async(self.client.put)(f'/api/chat/{_chat.chat_id}/members',
@@ -378,6 +518,9 @@ class WSTests(TestCase):
         self.assertEqual(response['status'], 'kicked out')
         self.assertEqual(response['user_id'], plato_id)
         self.assertEqual(response['chat_id'], _chat.chat_id)
+        # 被移出后不再收到该聊天的消息
+        await self.post_a_message(socrates_id, socrates_token, _chat.chat_id)
+        self.assertTrue(await aristotle_communicator.receive_nothing(timeout=0.5))
 
         await socrates_communicator.disconnect()
         await plato_communicator.disconnect()
@@ -475,6 +618,11 @@ class WSTests(TestCase):
         self.assertEqual(response['msg_id'], msg_id)
         self.assertEqual(response['user_id'], self.admin.user_id)
         self.assertEqual(response['chat_id'], self.chat.chat_id)
+        # 完整消息随通知推送
+        self.assertEqual(response['message']['msg_id'], msg_id)
+        self.assertEqual(response['message']['msg_text'], 'Hello World!')
+        self.assertEqual(response['message']['sender_id'], self.admin.user_id)
+        self.assertEqual(response['message']['read_users'], [self.admin.user_id])
         # skip admin's websocket
         response = await admin_communicator.receive_json_from(timeout=5)
         self.assertEqual(response['status'], 'send message')
@@ -515,6 +663,181 @@ class WSTests(TestCase):
         await admin_communicator.disconnect()
         await guest_communicator.disconnect()
 
+    async def test_message_payload_size(self):
+        """
+        超过推送大小限制的消息不随通知推送
+        """
+        guest_communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                                   f'/ws/main/{self.guest.user_id}/&{self.guest_token}')
+        guest_communicator.scope['url_route'] = {'kwargs': {'user_id': self.guest.user_id, 'token': self.guest_token}}
+        connected, _ = await guest_communicator.connect()
+        self.assertTrue(connected)
+
+        for msg_text, pushed in [('短消息', True), ('长' * MAX_MESSAGE_LENGTH, False)]:
+            response = await database_sync_to_async(self.client.post)('/api/message/send',
+                                                                      data={
+                                                                          'user_id': self.admin.user_id,
+                                                                          'chat_id': self.chat.chat_id,
+                                                                          'msg_text': msg_text,
+                                                                          'msg_type': 'text',
+                                                                      }, format='multipart',
+                                                                      HTTP_AUTHORIZATION=self.admin_token)
+            self.assertEqual(response.status_code, 200)
+            response = await guest_communicator.receive_json_from(timeout=5)
+            self.assertEqual(response['status'], 'send message')
+            self.assertEqual('message' in response, pushed)
+            if pushed:
+                self.assertEqual(response['message']['msg_text'], msg_text)
+
+        await guest_communicator.disconnect()
+
+    async def test_send_message_over_ws(self):
+        """
+        通过 websocket 发送消息，确认与去重
+        """
+        admin_communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                                   f'/ws/main/{self.admin.user_id}/&{self.admin_token}')
+        admin_communicator.scope['url_route'] = {'kwargs': {'user_id': self.admin.user_id, 'token': self.admin_token}}
+        connected, _ = await admin_communicator.connect()
+        self.assertTrue(connected)
+        guest_communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                                   f'/ws/main/{self.guest.user_id}/&{self.guest_token}')
+        guest_communicator.scope['url_route'] = {'kwargs': {'user_id': self.guest.user_id, 'token': self.guest_token}}
+        connected, _ = await guest_communicator.connect()
+        self.assertTrue(connected)
+
+        data = {'type': 'chat.send', 'client_msg_id': 'client-1', 'chat_id': self.chat.chat_id, 'msg_text': 'Hi!'}
+        await admin_communicator.send_json_to(data)
+        # admin 收到确认与推送（顺序不定）
+        responses = [await admin_communicator.receive_json_from(timeout=5) for _ in range(2)]
+        ack = [response for response in responses if response['type'] == 'chat.send.ack'][0]
+        self.assertEqual(ack['code'], 0)
+        self.assertEqual(ack['client_msg_id'], 'client-1')
+        msg_id = ack['msg_id']
+        # guest 收到推送
+        response = await guest_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['status'], 'send message')
+        self.assertEqual(response['msg_id'], msg_id)
+        self.assertEqual(response['message']['msg_text'], 'Hi!')
+
+        # 重复发送：只返回原消息的确认
+        await admin_communicator.send_json_to(data)
+        response = await admin_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['type'], 'chat.send.ack')
+        self.assertEqual(response['msg_id'], msg_id)
+        self.assertTrue(await guest_communicator.receive_nothing(timeout=0.5))
+        count = await database_sync_to_async(
+            lambda: Message.objects.filter(sender=self.admin, client_msg_id='client-1').count())()
+        self.assertEqual(count, 1)
+
+        # 不在聊天中
+        await admin_communicator.send_json_to({**data, 'client_msg_id': 'client-2', 'chat_id': 2 ** 40})
+        response = await admin_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['code'], -2)
+        # 缺少参数
+        await admin_communicator.send_json_to({'type': 'chat.send', 'client_msg_id': 'client-3'})
+        response = await admin_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['code'], -7)
+        self.assertEqual(response['client_msg_id'], 'client-3')
+
+        await admin_communicator.disconnect()
+        await guest_communicator.disconnect()
+
+    async def test_reconnect_replay(self):
+        """
+        断线期间的聊天事件在重连时按序号重放
+        """
+        msg_ids = [await self.post_a_message(self.admin.user_id, self.admin_token, self.chat.chat_id) for _ in range(2)]
+
+        last_seqs = urllib.parse.quote(json.dumps({self.chat.chat_id: 0}))
+        guest_communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                                   f'/ws/main/{self.guest.user_id}/{self.guest_token}'
+                                                   f'?last_seqs={last_seqs}')
+        guest_communicator.scope['url_route'] = {'kwargs': {'user_id': self.guest.user_id, 'token': self.guest_token}}
+        connected, _ = await guest_communicator.connect()
+        self.assertTrue(connected)
+        for seq, msg_id in enumerate(msg_ids, start=1):
+            response = await guest_communicator.receive_json_from(timeout=5)
+            self.assertEqual(response['status'], 'send message')
+            self.assertEqual(response['seq'], seq)
+            self.assertEqual(response['msg_id'], msg_id)
+        self.assertTrue(await guest_communicator.receive_nothing(timeout=0.5))
+        await guest_communicator.disconnect()
+
+        # 错过的事件已被清理，需重新同步
+        await database_sync_to_async(lambda: ChatEvent.objects.filter(chat=self.chat, seq=1).delete())()
+        guest_communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                                   f'/ws/main/{self.guest.user_id}/{self.guest_token}'
+                                                   f'?last_seqs={last_seqs}')
+        guest_communicator.scope['url_route'] = {'kwargs': {'user_id': self.guest.user_id, 'token': self.guest_token}}
+        connected, _ = await guest_communicator.connect()
+        self.assertTrue(connected)
+        response = await guest_communicator.receive_json_from(timeout=5)
+        self.assertEqual(response, {'type': 'resync', 'chat_id': self.chat.chat_id})
+        await guest_communicator.disconnect()
+
+    async def test_read_events_keep_seq(self):
+        consumer = WSConsumer()
+        consumer.user = self.admin
+        event = {'type': 'chat.message', 'status': 'read message', 'user_id': self.guest.user_id,
+                 'chat_id': self.chat.chat_id, 'update_time': time.time()}
+        for seq in range(1, 4):
+            await consumer.chat_message({**event, 'msg_id': seq, 'seq': seq})
+        # 带事件序号的已读通知不合并，序号连续
+        self.assertEqual(consumer.outbound.coalesced, 0)
+        self.assertEqual([(await consumer.outbound.get())['seq'] for _ in range(3)], [1, 2, 3])
+        # 不带事件序号的已读通知只保留最新一条
+        for msg_id in range(1, 4):
+            await consumer.chat_message({**event, 'msg_id': msg_id})
+        self.assertEqual(consumer.outbound.depth, 1)
+        self.assertEqual((await consumer.outbound.get())['msg_id'], 3)
+
+    async def test_msgpack_subprotocol(self):
+        """
+        协商 MessagePack 子协议后收发二进制帧
+        """
+        communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                             f'/ws/main/{self.admin.user_id}/{self.admin_token}',
+                                             subprotocols=[MSGPACK_SUBPROTOCOL])
+        communicator.scope['url_route'] = {'kwargs': {'user_id': self.admin.user_id, 'token': self.admin_token}}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+
+        await communicator.send_to(bytes_data=msgpack.packb({'t': 'chat.send', 'k': 'client-1',
+                                                             'c': self.chat.chat_id, 'x': 'Hi!'}))
+        responses = [MsgpackCodec().decode(bytes_data=await communicator.receive_from(timeout=5))
+                     for _ in range(2)]
+        ack = [response for response in responses if response['type'] == 'chat.send.ack'][0]
+        self.assertEqual(ack['code'], 0)
+        event = [response for response in responses if response['type'] == 'chat.message'][0]
+        self.assertEqual(event['msg_id'], ack['msg_id'])
+        self.assertEqual(event['message']['msg_text'], 'Hi!')
+        await communicator.disconnect()
+
+        # 默认为 JSON
+        communicator = WebsocketCommunicator(WSConsumer.as_asgi(),
+                                             f'/ws/main/{self.admin.user_id}/{self.admin_token}',
+                                             subprotocols=['unknown'])
+        communicator.scope['url_route'] = {'kwargs': {'user_id': self.admin.user_id, 'token': self.admin_token}}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        await communicator.disconnect()
+
+    @database_sync_to_async
+    def post_a_message(self, user_id, token, chat_id):
+        response = self.client.post('/api/message/send',
+                                    data={
+                                        'user_id': user_id,
+                                        'chat_id': chat_id,
+                                        'msg_text': 'Hello World!',
+                                        'msg_type': 'text',
+                                    }, format='multipart',
+                                    HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['msg_id']
+
     @database_sync_to_async
     def create_a_chat(self, chat_name, user_ids):
         _chat = Chat.objects.create(chat_name=chat_name, is_private=False)
@@ -525,3 +848,293 @@ class WSTests(TestCase):
         membership.privilege = 'O'
         membership.save()
         return _chat
+
+
+class PresenceTests(TestCase):
+    # 执行此单元测试前一定要运行redis，或设置环境变量 LOCAL_LAYERS 使用进程内实现
+    def check_presence(self, presence):
+        user_id = 2 ** 40
+        for channel_name in presence.get_channel_names(user_id):
+            presence.unregister(user_id, channel_name)
+        self.assertFalse(presence.is_online(user_id))
+        # 登记多个设备
+        self.assertEqual(presence.register(user_id, 'channel_a'), 1)
+        self.assertEqual(presence.register(user_id, 'channel_b'), 2)
+        self.assertEqual(sorted(presence.get_channel_names(user_id)), ['channel_a', 'channel_b'])
+        self.assertTrue(presence.is_online(user_id))
+        self.assertEqual(presence.get_online_users([user_id + 1, user_id]), [user_id])
+        # 续期
+        self.assertTrue(presence.refresh(user_id, 'channel_a'))
+        self.assertFalse(presence.refresh(user_id, 'channel_c'))
+        # 注销
+        self.assertFalse(presence.unregister(user_id, 'channel_c'))
+        self.assertTrue(presence.unregister(user_id, 'channel_a'))
+        self.assertEqual(presence.get_channel_names(user_id), ['channel_b'])
+        self.assertFalse(presence.refresh(user_id, 'channel_a'))
+        self.assertTrue(presence.unregister(user_id, 'channel_b'))
+        self.assertFalse(presence.is_online(user_id))
+
+    def test_local_presence(self):
+        self.check_presence(LocalPresence())
+        # 过期
+        presence = LocalPresence(ttl=0)
+        presence.register(1, 'channel_a')
+        self.assertFalse(presence.is_online(1))
+        self.assertFalse(presence.refresh(1, 'channel_a'))
+        # 清理过期连接
+        self.assertEqual(presence.sweep(), [(1, 'channel_a')])
+        self.assertEqual(presence.sweep(), [])
+        self.assertTrue(presence.acquire_sweep(60))
+        self.assertFalse(presence.acquire_sweep(60))
+        presence = LocalPresence()
+        presence.register(1, 'channel_a')
+        presence.clear()
+        self.assertFalse(presence.is_online(1))
+
+    @requires_redis
+    def test_redis_presence(self):
+        self.check_presence(RedisPresence(prefix='presence_test'))
+        # 过期
+        presence = RedisPresence(prefix='presence_test', ttl=0)
+        presence.register(1, 'channel_a')
+        self.assertFalse(presence.is_online(1))
+        self.assertFalse(presence.refresh(1, 'channel_a'))
+        # 清理过期连接
+        presence = RedisPresence(prefix='presence_test', ttl=1)
+        presence.clear()
+        presence.register(1, 'channel_a')
+        presence.register(2, 'channel_b')
+        time.sleep(1.1)
+        presence.register(2, 'channel_c')
+        self.assertEqual(sorted(presence.sweep()), [(1, 'channel_a'), (2, 'channel_b')])
+        self.assertEqual(presence.sweep(), [])
+        self.assertEqual(presence.get_channel_names(2), ['channel_c'])
+        presence.redis.delete('presence_test-sweep')
+        self.assertTrue(presence.acquire_sweep(60))
+        self.assertFalse(presence.acquire_sweep(60))
+        presence.clear()
+        self.assertFalse(presence.is_online(2))
+
+    async def test_sweep_stale_connections(self):
+        user = await database_sync_to_async(User.objects.create)(user_name='sweep', password='sweep_pwd')
+        presence = get_presence()
+        # 模拟 worker 崩溃后遗留的连接
+        presence.register(user.user_id, 'stale.channel')
+        if isinstance(presence, RedisPresence):
+            presence.redis.zadd(presence.key(user.user_id), {'stale.channel': time.time() - 1})
+        else:
+            presence.entries[user.user_id]['stale.channel'] = time.time() - 1
+        stale = await sweep_stale_connections(get_channel_layer())
+        self.assertIn((user.user_id, 'stale.channel'), stale)
+        self.assertFalse(presence.is_online(user.user_id))
+
+        out = io.StringIO()
+        await database_sync_to_async(call_command)('cleanup_websocket', stdout=out)
+        self.assertIn('Swept', out.getvalue())
+
+
+class OutboundQueueTests(TestCase):
+    async def test_outbound_queue(self):
+        queue = OutboundQueue(maxsize=3)
+        # 队列为空时等待
+        task = asyncio.create_task(queue.get())
+        queue.put({'msg_id': 1})
+        self.assertEqual(await asyncio.wait_for(task, timeout=1), {'msg_id': 1})
+
+        # 合并相同 key 的事件
+        queue.put({'status': 'read message', 'msg_id': 1}, key=('read message', 1, 1))
+        queue.put({'status': 'send message', 'msg_id': 2})
+        queue.put({'status': 'read message', 'msg_id': 2}, key=('read message', 1, 1))
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(await queue.get(), {'status': 'send message', 'msg_id': 2})
+        self.assertEqual(await queue.get(), {'status': 'read message', 'msg_id': 2})
+
+    async def test_outbound_queue_coalesce_order(self):
+        queue = OutboundQueue()
+        queue.put({'status': 'read message', 'seq': 5}, key=('read message', 1, 1))
+        queue.put({'status': 'send message', 'seq': 6})
+        queue.put({'status': 'read message', 'seq': 7}, key=('read message', 1, 1))
+        queue.put({'status': 'send message', 'seq': 8})
+        queue.put({'status': 'read message', 'seq': 9}, key=('read message', 1, 1))
+        seqs = [(await queue.get())['seq'] for _ in range(queue.depth)]
+        # 合并后事件序号仍然递增，不会丢失中间的发送事件
+        self.assertEqual(seqs, [6, 8, 9])
+        self.assertEqual(seqs, sorted(seqs))
+
+    async def test_outbound_queue_overflow(self):
+        queue = OutboundQueue(maxsize=3)
+        dropped = metrics['dropped']
+        resyncs = metrics['resyncs']
+        for msg_id in range(4):
+            queue.put({'msg_id': msg_id})
+        # 积压事件被丢弃，改为重新同步标记
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(queue.max_depth, 3)
+        self.assertEqual(metrics['dropped'] - dropped, 3)
+        self.assertEqual(metrics['resyncs'] - resyncs, 1)
+        self.assertIs(await queue.get(), RESYNC_MARKER)
+        self.assertEqual(await queue.get(), {'msg_id': 3})
+
+
+class GroupTests(TestCase):
+    async def check_group_add_many(self, channel_layer):
+        channel_name = await channel_layer.new_channel()
+        groups = [f'group_test_{index}' for index in range(20)]
+        await group_add_many(channel_layer, groups, channel_name)
+        for group in groups:
+            await channel_layer.group_send(group, {'type': 'chat.message', 'group': group})
+        received = [(await asyncio.wait_for(channel_layer.receive(channel_name), timeout=1))['group']
+                    for _ in groups]
+        self.assertEqual(sorted(received), sorted(groups))
+
+        await group_discard_many(channel_layer, groups, channel_name)
+        for group in groups:
+            await channel_layer.group_send(group, {'type': 'chat.message', 'group': group})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), timeout=0.2)
+
+    @requires_redis
+    async def test_group_add_many_redis(self):
+        await self.check_group_add_many(RedisChannelLayer())
+
+    @requires_redis
+    async def test_group_add_many_fallback(self):
+        self.assertTrue(supports_pipeline(RedisChannelLayer()))
+        self.assertFalse(supports_pipeline(InMemoryChannelLayer()))
+        # channels_redis 内部接口缺失时退回公开接口
+        internals = groups.REDIS_LAYER_INTERNALS
+        groups.REDIS_LAYER_INTERNALS = internals + ['_removed_internal']
+        try:
+            self.assertFalse(supports_pipeline(RedisChannelLayer()))
+            await self.check_group_add_many(RedisChannelLayer())
+        finally:
+            groups.REDIS_LAYER_INTERNALS = internals
+
+    async def test_group_add_many_local(self):
+        await self.check_group_add_many(InMemoryChannelLayer())
+        await self.check_group_add_many(LocalChannelLayer())
+
+    async def test_local_channel_layer(self):
+        channel_layer = LocalChannelLayer(capacity=2)
+        channel_name = await channel_layer.new_channel()
+        # 从其他线程（事件循环）发送
+        task = asyncio.create_task(channel_layer.receive(channel_name))
+        await asyncio.sleep(0)
+        await sync_to_async(async_to_sync(channel_layer.send), thread_sensitive=False)(channel_name, {'type': 'a'})
+        self.assertEqual(await asyncio.wait_for(task, timeout=1), {'type': 'a'})
+        # 容量
+        await channel_layer.send(channel_name, {'type': 'b'})
+        await channel_layer.send(channel_name, {'type': 'c'})
+        with self.assertRaises(ChannelFull):
+            await channel_layer.send(channel_name, {'type': 'd'})
+        self.assertEqual(await channel_layer.receive(channel_name), {'type': 'b'})
+        await channel_layer.flush()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), timeout=0.1)
+
+    async def test_fanout_benchmark(self):
+        result = await run_fanout_benchmark(connections=6, chats=2, messages=4)
+        self.assertEqual(result['chats'], 2)
+        # 每条消息投递给群聊的 3 个成员
+        self.assertEqual(result['deliveries'], 12)
+        self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_group_add', chats=[1, 10], rounds=1, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+class ProtocolTests(TestCase):
+    def test_codec(self):
+        data = {'type': 'chat.message', 'status': 'send message', 'chat_id': 1, 'msg_id': 2, 'seq': 3,
+                'message': {'msg_id': 2, 'msg_text': '你好' * 200, 'read_users': [1]}, 'unknown_field': None}
+        # 字段编码一一对应
+        self.assertEqual(len(set(FIELD_CODES.values())), len(FIELD_CODES))
+        self.assertEqual(JSONCodec().decode(**JSONCodec().encode(data)), data)
+
+        frame = MsgpackCodec().encode(data)['bytes_data']
+        self.assertEqual(msgpack.unpackb(frame)['t'], 'chat.message')
+        self.assertEqual(MsgpackCodec().decode(bytes_data=frame), data)
+        self.assertLess(len(frame), len(JSONCodec().encode(data)['text_data'].encode('utf-8')))
+
+        # 压缩
+        compressed = MsgpackCodec(compress=True).encode(data)['bytes_data']
+        self.assertLess(len(compressed), len(frame))
+        self.assertEqual(MsgpackCodec(compress=True).decode(bytes_data=compressed), data)
+        small = {'type': 'resync'}
+        self.assertEqual(MsgpackCodec(compress=True).encode(small), MsgpackCodec().encode(small))
+
+    def test_select_codec(self):
+        self.assertIsInstance(select_codec(None), JSONCodec)
+        self.assertIsInstance(select_codec(['unknown']), JSONCodec)
+        self.assertEqual(select_codec(['unknown', MSGPACK_SUBPROTOCOL]).subprotocol, MSGPACK_SUBPROTOCOL)
+        self.assertEqual(select_codec([MSGPACK_DEFLATE_SUBPROTOCOL, MSGPACK_SUBPROTOCOL]).subprotocol,
+                         MSGPACK_DEFLATE_SUBPROTOCOL)
+
+
+class PiazzaTests(TestCase):
+    # 执行此单元测试前一定要运行redis，或设置环境变量 LOCAL_LAYERS 使用进程内实现
+    def test_piazza_history(self):
+        history = LocalPiazzaHistory(size=3)
+        for i in range(5):
+            history.append({'message': i})
+        self.assertEqual(history.get(), [{'message': i} for i in range(2, 5)])
+
+    @requires_redis
+    def test_redis_piazza_history(self):
+        history = RedisPiazzaHistory(key='piazza_test:history', size=3)
+        history.redis.delete(history.key)
+        for i in range(5):
+            history.append({'message': i})
+        self.assertEqual(history.get(), [{'message': i} for i in range(2, 5)])
+
+    def test_rate_limiter(self):
+        rate_limiter = RateLimiter(limit=2, period=1000)
+        self.assertTrue(rate_limiter.allow())
+        self.assertTrue(rate_limiter.allow())
+        self.assertFalse(rate_limiter.allow())
+        # 令牌恢复
+        rate_limiter.last_time -= 500
+        self.assertTrue(rate_limiter.allow())
+        self.assertFalse(rate_limiter.allow())
+
+    async def test_piazza_consumer(self):
+        sender = WebsocketCommunicator(PiazzaConsumer.as_asgi(), '/ws/piazza')
+        connected, _ = await sender.connect()
+        self.assertTrue(connected)
+        # 跳过最近消息
+        while not await sender.receive_nothing(timeout=0.1):
+            await sender.receive_json_from()
+        receivers = [WebsocketCommunicator(PiazzaConsumer.as_asgi(), '/ws/piazza') for _ in range(PIAZZA_SHARDS)]
+        for receiver in receivers:
+            connected, _ = await receiver.connect()
+            self.assertTrue(connected)
+            while not await receiver.receive_nothing(timeout=0.1):
+                await receiver.receive_json_from()
+
+        # 消息发到所有分片
+        await sender.send_json_to({'message': 'Hello piazza!', 'sender_id': 1, 'sender_name': 'socrates'})
+        for communicator in [sender, *receivers]:
+            response = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(response['message'], 'Hello piazza!')
+
+        # 新连接收到最近的消息
+        newcomer = WebsocketCommunicator(PiazzaConsumer.as_asgi(), '/ws/piazza')
+        connected, _ = await newcomer.connect()
+        self.assertTrue(connected)
+        history = await get_piazza_history().async_get()
+        for _ in range(len(history)):
+            response = await newcomer.receive_json_from(timeout=5)
+        self.assertEqual(response['message'], 'Hello piazza!')
+
+        # 限流
+        for _ in range(PIAZZA_RATE_LIMIT):
+            await sender.send_json_to({'message': 'spam', 'sender_id': 1, 'sender_name': 'socrates'})
+        statuses = [(await sender.receive_json_from(timeout=5))['type'] for _ in range(PIAZZA_RATE_LIMIT)]
+        self.assertIn('rate limited', statuses)
+
+        for communicator in [sender, newcomer, *receivers]:
+            await communicator.disconnect()